@@ -0,0 +1,45 @@
+'''
+Compares the single-pass hit flattener with the previous path (unlist_singles,
+LayeredDataframe.unfold and extract) on a synthetic payload of expanded cases.
+
+Run from the repository root: python -m benchmarks.bench_flatten [ncases]
+'''
+import copy
+import sys
+from time import perf_counter
+import pandas as pd
+from gdc_data_processing import unlist_singles, LayeredDataframe
+from gdc_flatten import flatten_hits
+from benchmarks.synthetic import make_case_hits
+
+
+def layered_path(hits):
+    unlist_singles(hits)
+    cases = LayeredDataframe(pd.DataFrame(hits))
+    cases.unfold("case_id")
+    files = LayeredDataframe(cases.extract("files", "case_id"))
+    files.unfold("file_id")
+    files = LayeredDataframe(files.data)
+    files.unfold("file_id")
+    return cases.data, files.data
+
+
+def flattener_path(hits):
+    cases, children = flatten_hits(hits, key="case_id", explode=("files",))
+    return cases, children["files"]
+
+
+def timed(f, hits):
+    start = perf_counter()
+    result = f(hits)
+    return perf_counter() - start, result
+
+
+if __name__ == "__main__":
+    ncases = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    hits = make_case_hits(ncases)
+    print("Synthetic payload:", ncases, "cases,", sum(len(h["files"]) for h in hits), "files")
+    elapsed, (cases, files) = timed(flattener_path, copy.deepcopy(hits))
+    print("flatten_hits:      {:.2f}s - cases {} files {}".format(elapsed, cases.shape, files.shape))
+    elapsed, (cases, files) = timed(layered_path, copy.deepcopy(hits))
+    print("LayeredDataframe:  {:.2f}s - cases {} files {}".format(elapsed, cases.shape, files.shape))
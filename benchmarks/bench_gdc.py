@@ -0,0 +1,157 @@
+'''
+End-to-end benchmarks of gdc_rest and gdc_data_processing against a local mock of
+the GDC API (see benchmarks.mock_gdc), at several scales. For each number of cases
+it measures:
+
+    metadata        paginated fetch and flatten of the expanded cases
+    metadata-stream the same, with pages parsed while they are received
+    files-tsv       a TSV query of the files endpoint
+    download        download of every file, one request per file (4 workers)
+    download-batch  download of the same files as tar archives
+    md5             validation of the downloaded files, hashing every file
+    md5-manifest    the same validation, with the checksums of the manifest
+    matrix-<n>      assembly of the gene expression matrix with n parse processes
+                    (1 and --workers)
+    pipelined       download and parsing overlapped (getDataMatrix pipelined=True)
+
+The time of each step, its throughput where it applies and the split given by
+gdc_metrics are printed. With --save the results are written to a JSON file and
+with --compare they are compared with a previous run: steps more than --tolerance
+times slower are reported and the exit status is 1, so that regressions can be
+caught offline.
+
+Run from the repository root:
+    python -m benchmarks.bench_gdc [--cases 50 200] [--files-per-case 2] [--genes 60483]
+                                   [--save results.json] [--compare baseline.json]
+'''
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+from time import perf_counter
+import pandas as pd
+from gdc_data_processing import GDCCaseMetadataHandler, GeneExpressionQuantification
+from gdc_metrics import get_metrics
+from gdc_rest import RequestEndpoint, http_post
+from benchmarks.mock_gdc import MockGDC
+
+CASE_FIELDS = ["demographic", "diagnoses", "diagnoses.treatments", "exposures", "files", "files.analysis",
+               "files.cases.samples", "summary"]
+
+
+class Run(object):
+    '''
+    Times the steps of a benchmark and collects the gdc_metrics accumulated by each
+    '''
+
+    def __init__(self, scale):
+        self.scale = scale
+        self.results = {}
+
+    def step(self, name, f, nbytes=None):
+        metrics = get_metrics()
+        before = metrics.snapshot()
+        start = perf_counter()
+        result = f()
+        elapsed = perf_counter() - start
+        delta = metrics.since(before)
+        entry = {"time": elapsed, "stages": delta["times"], "counters": delta["counters"]}
+        nbytes = nbytes if nbytes is not None else delta["counters"].get("bytes_downloaded") or \
+            delta["counters"].get("bytes_hashed")
+        if nbytes:
+            entry["MBps"] = nbytes / 1048576.0 / elapsed
+        self.results[name] = entry
+        stages = ", ".join("{} {:.2f}s".format(k, v) for k, v in sorted(delta["times"].items()))
+        print("  " + name.ljust(16) + "{:.3f}s".format(elapsed).rjust(9) +
+              ("{:.1f} MB/s".format(entry["MBps"]).rjust(13) if "MBps" in entry else "".rjust(13)) +
+              ("   " + stages if stages else ""))
+        return result
+
+
+def run_scale(ncases, filesPerCase, ngenes, workers):
+    print("{} cases, {} files, {} genes per file".format(ncases, ncases * filesPerCase, ngenes))
+    run = Run(ncases)
+    folder = tempfile.mkdtemp(prefix="bench_gdc_")
+    start = perf_counter()
+    with MockGDC(ncases, filesPerCase, ngenes) as gdc:
+        print("  mock data generated in {:.1f}s".format(perf_counter() - start))
+        handler = lambda stream: GDCCaseMetadataHandler(expand=CASE_FIELDS, pageSize=100, workers=4,
+                                                        baseUrl=gdc.url, stream=stream)
+        mh = run.step("metadata", lambda: handler(False))
+        run.step("metadata-stream", lambda: handler(True))
+        files = RequestEndpoint(RequestEndpoint.FILES, baseUrl=gdc.url, format="tsv", size=ncases * filesPerCase)
+        run.step("files-tsv", lambda: files.request(http_post))
+
+        fh = GeneExpressionQuantification(mh, "case_id")
+        fd = fh.getFileData()
+        nbytes = int(fd["file_size"].sum())
+        single, batched = folder + "/single/", folder + "/batched/"
+        os.makedirs(single)
+        os.makedirs(batched)
+        run.step("download", lambda: fh.confirmLocalStorage(single, workers=4, useManifest=False), nbytes)
+        run.step("download-batch", lambda: fh.confirmLocalStorage(batched, batched=True, workers=2,
+                                                                  useManifest=False), nbytes)
+        run.step("md5", lambda: fh.confirmLocalStorage(single, useManifest=False), nbytes)
+        fh.confirmLocalStorage(single)
+        run.step("md5-manifest", lambda: fh.confirmLocalStorage(single))
+        X = run.step("matrix-1", lambda: fh.getDataMatrix(single, parseWorkers=1, download=False))
+        if workers > 1:
+            run.step("matrix-" + str(workers), lambda: fh.getDataMatrix(single, parseWorkers=workers,
+                                                                        download=False))
+        pipelined = folder + "/pipelined/"
+        os.makedirs(pipelined)
+        Y = run.step("pipelined", lambda: fh.getDataMatrix(pipelined, downloadWorkers=4, pipelined=True,
+                                                           parseWorkers=workers))
+        assert X.shape == (fd.shape[0], ngenes) and X.equals(Y), "Matrices do not match"
+    shutil.rmtree(folder, ignore_errors=True)
+    return run.results
+
+
+def compare(results, baseline, tolerance, minTime=0.05):
+    '''
+    Returns the steps (scale, name, ratio) of results that are more than tolerance
+    times slower than in baseline. Steps that took less than minTime seconds in
+    baseline are too noisy to compare and are left out.
+    '''
+    slower = []
+    for scale, steps in results.items():
+        for name, entry in steps.items():
+            previous = baseline.get(scale, {}).get(name)
+            if previous is not None and previous["time"] >= minTime and entry["time"] > tolerance * previous["time"]:
+                slower.append((scale, name, entry["time"] / previous["time"]))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks against a local mock of the GDC API")
+    parser.add_argument("--cases", type=int, nargs="+", default=[50, 200])
+    parser.add_argument("--files-per-case", type=int, default=2)
+    parser.add_argument("--genes", type=int, default=60483)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="parse processes")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=1.25)
+    parser.add_argument("--min-time", type=float, default=0.05, help="shortest baseline step compared (s)")
+    args = parser.parse_args(argv)
+
+    # load pandas before the first step, which would otherwise include its import
+    pd.DataFrame()
+    results = {str(n): run_scale(n, args.files_per_case, args.genes, args.workers) for n in args.cases}
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=1)
+    if args.compare:
+        with open(args.compare, "r") as f:
+            slower = compare(results, json.load(f), args.tolerance, args.min_time)
+        for scale, name, ratio in slower:
+            print("Regression: {} at {} cases is {:.2f}x slower".format(name, scale, ratio))
+        if slower:
+            return 1
+        print("No step is more than {:.2f}x slower than the baseline".format(args.tolerance))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,59 @@
+'''
+Measures the cold import time of each module of the package, each in a fresh
+interpreter with python -X importtime, and whether pandas/numpy were loaded by the
+import. The last column is the time of the import plus the first use of pandas, i.e.
+the cost that is deferred rather than avoided by the lazy imports.
+
+Run from the repository root: python -m benchmarks.bench_import [repeats]
+'''
+import subprocess
+import sys
+
+MODULES = ["file_utils", "gdc_cache", "gdc_manifest", "gdc_rest", "gdc_flatten", "gdc_query", "gdc_matrix",
+           "gdc_dataset", "gdc_data_processing", "gdc_pipeline", "gdc_metrics", "bio_utils"]
+
+
+def import_time(statement):
+    '''
+    Runs statement in a new interpreter. Returns the cumulative import time (in ms) of
+    each top level import and the names of every module imported
+    '''
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], capture_output=True, text=True,
+                            check=True)
+    top, names = {}, set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        names.add(name.strip())
+        if not name[1:].startswith(" "):
+            top[name.strip()] = int(cumulative_us) / 1000.0
+    return top, names
+
+
+def first_use_time(module):
+    '''
+    Returns the time (in ms) to import module and then use pandas, in a new
+    interpreter. Lazily imported modules are loaded on first use, which importtime
+    does not report, so this is measured with a clock.
+    '''
+    statement = ("from time import perf_counter; start = perf_counter(); import " + module +
+                 "; import pandas; pandas.DataFrame; print(perf_counter() - start)")
+    result = subprocess.run([sys.executable, "-c", statement], capture_output=True, text=True, check=True)
+    return float(result.stdout.strip()) * 1000.0
+
+
+def main(repeats=5):
+    print("module".ljust(22) + "import (ms)".rjust(12) + "pandas".rjust(8) + "numpy".rjust(8) +
+          "+ first use (ms)".rjust(18))
+    for module in MODULES:
+        runs = [import_time("import " + module) for _ in range(repeats)]
+        best = min(top[module] for top, names in runs)
+        names = runs[0][1]
+        first_use = min(first_use_time(module) for _ in range(repeats))
+        print(module.ljust(22) + "{:.1f}".format(best).rjust(12) + str("pandas" in names).rjust(8) +
+              str("numpy" in names).rjust(8) + "{:.1f}".format(first_use).rjust(18))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
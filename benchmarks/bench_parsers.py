@@ -0,0 +1,68 @@
+'''
+Compares the parsers of gdc_parsers, through the preallocated/parallel assembly of
+gdc_matrix.build_matrix and gdc_parsers.build_table, with ad-hoc serial readers
+(pandas.read_csv of every column of each file, then concat) on synthetic files of
+the size of the files of each GDC workflow.
+
+Run from the repository root: python -m benchmarks.bench_parsers [nfiles]
+'''
+import os
+import random
+import sys
+import tempfile
+from time import perf_counter
+import pandas as pd
+from gdc_matrix import build_matrix
+from gdc_parsers import get_parser, build_table
+from benchmarks.synthetic import make_htseq_file, make_star_file, make_mirna_file, make_segment_file, make_maf_file
+
+FORMATS = [
+    # name, data_type, workflow, file generator, extension, ad-hoc reader
+    ("HTSeq - FPKM", "Gene Expression Quantification", "HTSeq - FPKM", make_htseq_file, ".txt",
+     lambda p: pd.read_csv(p, sep="\t", header=None, index_col=0)[1]),
+    ("STAR - Counts", "Gene Expression Quantification", "STAR - Counts", make_star_file, ".tsv",
+     lambda p: pd.read_csv(p, sep="\t", comment="#", index_col=0).iloc[4:]["unstranded"]),
+    ("miRNA", "miRNA Expression Quantification", None, make_mirna_file, ".txt",
+     lambda p: pd.read_csv(p, sep="\t", index_col=0)["reads_per_million_miRNA_mapped"]),
+    ("Copy Number Segment", "Copy Number Segment", None, make_segment_file, ".seg.txt",
+     lambda p: pd.read_csv(p, sep="\t")),
+    ("Masked Somatic Mutation", "Masked Somatic Mutation", None, make_maf_file, ".maf.gz",
+     lambda p: pd.read_csv(p, sep="\t", comment="#", low_memory=False)),
+]
+
+
+def timed(f):
+    start = perf_counter()
+    result = f()
+    return perf_counter() - start, result
+
+
+def main(nfiles=40):
+    rng = random.Random(0)
+    folder = tempfile.mkdtemp(prefix="gdc_parsers_")
+    print("format".ljust(26) + "ad-hoc (s)".rjust(12) + "registry, 1 worker (s)".rjust(24) +
+          "registry, all CPUs (s)".rjust(24))
+    for name, data_type, workflow, make_file, extension, adhoc in FORMATS:
+        paths = [os.path.join(folder, name.replace(" ", "_") + str(i) + extension) for i in range(nfiles)]
+        for path in paths:
+            make_file(path, rng)
+        parser = get_parser(data_type, workflow)
+        if parser.kind == "matrix":
+            t_adhoc, reference = timed(lambda: pd.concat([adhoc(p) for p in paths], axis=1).T)
+            t_serial, (ids, matrix) = timed(lambda: build_matrix(paths, workers=1, parser=parser))
+            t_parallel, _ = timed(lambda: build_matrix(paths, parser=parser))
+            assert (reference.to_numpy() == matrix).all() and list(reference.columns) == list(ids)
+        else:
+            t_adhoc, reference = timed(lambda: pd.concat([adhoc(p) for p in paths], ignore_index=True))
+            t_serial, table = timed(lambda: build_table(paths, parser, workers=1))
+            t_parallel, _ = timed(lambda: build_table(paths, parser))
+            assert table.shape[0] == reference.shape[0]
+        print(name.ljust(26) + "{:.2f}".format(t_adhoc).rjust(12) + "{:.2f}".format(t_serial).rjust(24) +
+              "{:.2f}".format(t_parallel).rjust(24))
+        for path in paths:
+            os.remove(path)
+    os.rmdir(folder)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 40)
@@ -0,0 +1,318 @@
+'''
+Local mock of the GDC API for the benchmarks. It serves synthetic data through the
+endpoints used by the package:
+
+    cases, files, projects  paginated JSON (data.hits and data.pagination) or TSV
+                            results, with the from/size/format parameters sent by
+                            GET query strings, form-encoded or JSON POST bodies.
+                            Other parameters (filters, fields, expand) are ignored:
+                            every query returns the whole synthetic payload.
+    data/<file_id>          the content of a file, with Range request support
+    data/ (POST ids)        several files as a gzipped tar archive of
+                            <file_id>/<file_name> members, as the real data endpoint
+
+The cases follow benchmarks.synthetic.make_case_hits, with every file being a gzipped
+HTSeq - FPKM gene expression file written to disk with its real md5sum and size.
+The server runs in a separate process, so that serializing responses does not
+compete for the interpreter lock of the client being measured.
+
+Run from the repository root to serve it until interrupted:
+    python -m benchmarks.mock_gdc [ncases] [filesPerCase] [ngenes] [port]
+'''
+import gzip
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from benchmarks.synthetic import make_case_hits, gene_ids, PROJECTS
+
+CHUNK_SIZE = 1048576
+
+
+def write_expression_file(path, rng, genes):
+    '''
+    Writes a gzipped HTSeq - FPKM file with a random value for each gene id in genes
+    '''
+    text = "".join(g + "\t%.6f\n" % (rng.random() * 100) for g in genes)
+    with gzip.open(path, "wt", compresslevel=6) as f:
+        f.write(text)
+
+
+def make_project(project_id, cases):
+    ncases = sum(1 for c in cases if c["project"]["project_id"] == project_id)
+    return {"project_id": project_id,
+            "id": project_id,
+            "name": "Synthetic " + project_id,
+            "primary_site": ["Breast", "Colon", "Ovary", "Lung", "Kidney"],
+            "disease_type": ["Adenomas and Adenocarcinomas"],
+            "program": {"name": project_id.split("-")[0], "program_id": project_id.split("-")[0]},
+            "summary": {"case_count": ncases, "file_count": 0, "file_size": 0}}
+
+
+class MockData(object):
+    '''
+    Synthetic cases, files and projects of the mock server, with the data files
+    written to <folder>/data/.
+    Constructor parameters:
+        folder: folder for the data files (created if needed)
+        ncases: number of cases
+        filesPerCase: number of gene expression files of each case
+        ngenes: number of genes of each file (60483 in the HTSeq files of the GDC)
+        seed: seed of the random generator, the same seed gives the same data
+    '''
+
+    def __init__(self, folder, ncases=100, filesPerCase=2, ngenes=60483, seed=0):
+        self.folder = folder
+        self.cases = make_case_hits(ncases, filesPerCase, seed)
+        self.paths = {}
+        rng = random.Random(seed)
+        genes = gene_ids(ngenes)
+        dataFolder = os.path.join(folder, "data")
+        if not os.path.exists(dataFolder):
+            os.makedirs(dataFolder)
+        for case in self.cases:
+            for f in case["files"]:
+                f["data_type"] = "Gene Expression Quantification"
+                f["analysis"]["workflow_type"] = "HTSeq - FPKM"
+                path = os.path.join(dataFolder, f["file_id"])
+                write_expression_file(path, rng, genes)
+                with open(path, "rb") as content:
+                    f["md5sum"] = hashlib.md5(content.read()).hexdigest()
+                f["file_size"] = os.path.getsize(path)
+                self.paths[f["file_id"]] = (f["file_name"], path)
+        self.files = [dict(f, cases=[dict(f["cases"][0], project=case["project"])])
+                      for case in self.cases for f in case["files"]]
+        self.projects = [make_project(p, self.cases) for p in PROJECTS]
+        for project in self.projects:
+            files = [f for f in self.files if f["cases"][0]["project"]["project_id"] == project["project_id"]]
+            project["summary"].update(file_count=len(files), file_size=sum(f["file_size"] for f in files))
+
+    def hits(self, endpoint):
+        return {"cases": self.cases, "files": self.files, "projects": self.projects}[endpoint]
+
+
+def flatten_hit(hit, prefix=""):
+    '''
+    Flattens the nested dictionaries of a hit into dotted column names, as in the
+    TSV responses of the API (lists are kept as JSON)
+    '''
+    row = {}
+    for k, v in hit.items():
+        if isinstance(v, dict):
+            row.update(flatten_hit(v, prefix + k + "."))
+        else:
+            row[prefix + k] = json.dumps(v) if isinstance(v, list) else v
+    return row
+
+
+def to_tsv(hits):
+    rows = [flatten_hit(h) for h in hits]
+    columns = sorted({c for row in rows for c in row})
+    lines = ["\t".join(columns)]
+    lines += ["\t".join("" if row.get(c) is None else str(row[c]) for c in columns) for row in rows]
+    return "\n".join(lines) + "\n"
+
+
+class MockGDCHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    data = None
+    latency = 0.0
+
+    def log_message(self, *args):
+        pass
+
+    def params(self):
+        query = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            body = self.rfile.read(length).decode("utf-8")
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                query.update(json.loads(body))
+            else:
+                query.update({k: v[0] for k, v in parse_qs(body).items()})
+        return query
+
+    def send(self, status, body, contentType, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.route()
+
+    def do_POST(self):
+        self.route()
+
+    def route(self):
+        if self.latency:
+            time.sleep(self.latency)
+        parts = [p for p in urlparse(self.path).path.split("/") if p]
+        params = self.params()
+        if parts and parts[0] in ("cases", "files", "projects"):
+            self.search(parts[0], params)
+        elif parts and parts[0] == "data":
+            ids = parts[1:] if len(parts) > 1 else params.get("ids", [])
+            ids = [ids] if isinstance(ids, str) else ids
+            if len(ids) == 1:
+                self.sendFile(ids[0])
+            else:
+                self.sendArchive(ids)
+        else:
+            self.send(404, b"Not found", "text/plain")
+
+    def search(self, endpoint, params):
+        hits = self.data.hits(endpoint)
+        start, size = int(params.get("from", 0)), int(params.get("size", 10))
+        page = hits[start:start + size]
+        if params.get("format", "json").lower() == "tsv":
+            self.send(200, to_tsv(page).encode("utf-8"), "text/tab-separated-values")
+            return
+        pagination = {"count": len(page), "total": len(hits), "size": size, "from": start, "sort": "",
+                      "page": start // size + 1 if size else 1, "pages": -(-len(hits) // size) if size else 1}
+        body = json.dumps({"data": {"hits": page, "pagination": pagination}, "warnings": {}})
+        self.send(200, body.encode("utf-8"), "application/json")
+
+    def sendFile(self, file_id):
+        if file_id not in self.data.paths:
+            self.send(404, b"File not found", "text/plain")
+            return
+        file_name, path = self.data.paths[file_id]
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        status = 200
+        headers = {"Content-Disposition": "attachment; filename=" + file_name, "Accept-Ranges": "bytes"}
+        requested = self.headers.get("Range")
+        if requested and requested.startswith("bytes="):
+            first, _, last = requested[len("bytes="):].partition("-")
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+            if start >= size:
+                self.send(416, b"", "text/plain", {"Content-Range": "bytes */" + str(size)})
+                return
+            status = 206
+            headers["Content-Range"] = "bytes {}-{}/{}".format(start, end, size)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end + 1 - start))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end + 1 - start
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    def sendArchive(self, ids):
+        buffer = io.BytesIO()
+        manifest = ["id\tfilename"]
+        with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+            for file_id in ids:
+                if file_id not in self.data.paths:
+                    continue
+                file_name, path = self.data.paths[file_id]
+                tar.add(path, arcname=file_id + "/" + file_name)
+                manifest.append(file_id + "\t" + file_name)
+            content = ("\n".join(manifest) + "\n").encode("utf-8")
+            info = tarfile.TarInfo("MANIFEST.txt")
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+        name = "gdc_download_" + time.strftime("%Y%m%d_%H%M%S") + ".tar.gz"
+        self.send(200, buffer.getvalue(), "application/x-tar",
+                  {"Content-Disposition": "attachment; filename=" + name})
+
+
+def make_server(data, port=0, latency=0.0):
+    '''
+    Returns a ThreadingHTTPServer serving data (a MockData) on localhost. latency
+    adds a delay (in seconds) before every response.
+    '''
+    handler = type("Handler", (MockGDCHandler,), {"data": data, "latency": latency})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def serve(folder, ncases, filesPerCase, ngenes, seed, port, latency, ready):
+    server = make_server(MockData(folder, ncases, filesPerCase, ngenes, seed), port, latency)
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+class MockGDC(object):
+    '''
+    Mock GDC API running in a background process, used as a context manager:
+
+        with MockGDC(ncases=100) as gdc:
+            GDCCaseMetadataHandler(baseUrl=gdc.url, ...)
+
+    Constructor parameters:
+        ncases, filesPerCase, ngenes, seed: size of the synthetic data (see MockData)
+        latency: delay in seconds added to every response
+        folder: folder for the data files (a temporary folder, removed on exit, if None)
+        port: port of the server (any free port if 0)
+    '''
+
+    def __init__(self, ncases=100, filesPerCase=2, ngenes=60483, seed=0, latency=0.0, folder=None, port=0):
+        self.options = (ncases, filesPerCase, ngenes, seed)
+        self.latency = latency
+        self.folder = folder
+        self.port = port
+        self.temporary = folder is None
+        self.process = None
+        self.url = None
+
+    def start(self, timeout=600):
+        if self.temporary:
+            self.folder = tempfile.mkdtemp(prefix="mock_gdc_")
+        ready = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=serve, args=(self.folder,) + self.options +
+                                               (self.port, self.latency, ready), daemon=True)
+        self.process.start()
+        self.url = "http://127.0.0.1:{}/".format(ready.get(timeout=timeout))
+        return self
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+        if self.temporary and self.folder is not None:
+            shutil.rmtree(self.folder, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    ncases, filesPerCase, ngenes, port = (args + [100, 2, 60483, 8000][len(args):])[:4]
+    folder = tempfile.mkdtemp(prefix="mock_gdc_")
+    try:
+        server = make_server(MockData(folder, ncases, filesPerCase, ngenes), port)
+        print("Serving", ncases, "cases at http://127.0.0.1:{}/".format(server.server_address[1]))
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
@@ -0,0 +1,140 @@
+'''
+Synthetic GDC payloads for the benchmarks. The structure of the hits follows the
+responses of the cases endpoint with fields and expand options such as those of
+tests/data_download_example.py.
+'''
+import gzip
+import hashlib
+import random
+import uuid
+
+PROJECTS = ["TCGA-BRCA", "TCGA-COAD", "TCGA-OV", "TCGA-LUAD", "TCGA-KIRC"]
+WORKFLOWS = ["HTSeq - FPKM", "HTSeq - Counts", "HTSeq - FPKM-UQ"]
+DATA_TYPES = ["Gene Expression Quantification", "Masked Somatic Mutation", "Copy Number Segment",
+              "miRNA Expression Quantification"]
+SAMPLE_TYPES = ["Primary Tumor", "Solid Tissue Normal", "Metastatic"]
+
+
+def make_uuid(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128)))
+
+
+def make_file(rng, case_id):
+    file_id = make_uuid(rng)
+    data_type = rng.choice(DATA_TYPES)
+    return {"file_id": file_id,
+            "file_name": file_id + ".FPKM.txt.gz",
+            "md5sum": hashlib.md5(file_id.encode("utf-8")).hexdigest(),
+            "file_size": rng.randint(400000, 600000),
+            "access": "open",
+            "data_type": data_type,
+            "data_category": "Transcriptome Profiling",
+            "data_format": "TXT",
+            "state": "released",
+            "analysis": {"workflow_type": rng.choice(WORKFLOWS), "analysis_id": make_uuid(rng)},
+            "cases": [{"case_id": case_id,
+                       "samples": [{"sample_type": rng.choice(SAMPLE_TYPES), "sample_id": make_uuid(rng)}]}]}
+
+
+def make_case(rng, filesPerCase=6):
+    case_id = make_uuid(rng)
+    ntreatments = rng.randint(1, 3)
+    return {"case_id": case_id,
+            "submitter_id": "TCGA-" + str(rng.randint(1000, 9999)),
+            "project": {"project_id": rng.choice(PROJECTS)},
+            "primary_site": rng.choice(["Breast", "Colon", "Ovary", "Lung", "Kidney"]),
+            "demographic": {"race": rng.choice(["white", "asian", "black or african american"]),
+                            "gender": rng.choice(["female", "male"]),
+                            "ethnicity": rng.choice(["not hispanic or latino", "hispanic or latino"]),
+                            "year_of_birth": rng.randint(1920, 1990),
+                            "year_of_death": rng.choice([None, rng.randint(1995, 2015)]),
+                            "vital_status": rng.choice(["Alive", "Dead"])},
+            "diagnoses": [{"tumor_stage": rng.choice(["stage i", "stage ii", "stage iii", "stage iv"]),
+                           "age_at_diagnosis": rng.randint(9000, 30000),
+                           "vital_status": rng.choice(["alive", "dead"]),
+                           "treatments": [{"treatment_id": make_uuid(rng),
+                                           "therapeutic_agents": rng.choice(["Cisplatin", "Tamoxifen"])}
+                                          for _ in range(ntreatments)]}],
+            "exposures": [{"bmi": round(rng.uniform(16, 40), 1), "cigarettes_per_day": rng.randint(0, 20)}],
+            "summary": {"file_count": filesPerCase, "file_size": filesPerCase * 500000},
+            "files": [make_file(rng, case_id) for _ in range(filesPerCase)]}
+
+
+def make_case_hits(n, filesPerCase=6, seed=0):
+    rng = random.Random(seed)
+    return [make_case(rng, filesPerCase) for _ in range(n)]
+
+
+# Data files, with the layout and approximate size of the files of each GDC workflow
+
+CHROMOSOMES = ["chr" + str(c) for c in list(range(1, 23)) + ["X", "Y"]]
+VARIANT_CLASSES = ["Missense_Mutation", "Silent", "Nonsense_Mutation", "Frame_Shift_Del", "Splice_Site", "3'UTR",
+                   "Intron", "In_Frame_Del"]
+
+
+def gene_ids(n):
+    return ["ENSG%011d.%d" % (i, i % 20) for i in range(n)]
+
+
+def make_htseq_file(path, rng, ngenes=60483):
+    with open(path, "w") as f:
+        f.write("".join("%s\t%.6f\n" % (g, rng.random() * 100) for g in gene_ids(ngenes)))
+
+
+def make_star_file(path, rng, ngenes=60660):
+    columns = ["gene_id", "gene_name", "gene_type", "unstranded", "stranded_first", "stranded_second",
+               "tpm_unstranded", "fpkm_unstranded", "fpkm_uq_unstranded"]
+    lines = ["# gene-model: GENCODE v36", "\t".join(columns)]
+    lines += ["%s\t\t\t%d\t%d\t%d\t\t\t" % (n, rng.randint(0, 10 ** 6), rng.randint(0, 10 ** 6),
+                                          rng.randint(0, 10 ** 6))
+              for n in ("N_unmapped", "N_multimapping", "N_noFeature", "N_ambiguous")]
+    for g in gene_ids(ngenes):
+        counts = rng.randint(0, 5000)
+        lines.append("%s\tG%s\tprotein_coding\t%d\t%d\t%d\t%.4f\t%.4f\t%.4f" % (
+            g, g[4:15], counts, counts // 2, counts - counts // 2, rng.random() * 50, rng.random() * 20,
+            rng.random() * 40))
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def make_mirna_file(path, rng, nmirnas=1881):
+    lines = ["miRNA_ID\tread_count\treads_per_million_miRNA_mapped\tcross-mapped"]
+    for i in range(nmirnas):
+        count = rng.randint(0, 20000)
+        lines.append("hsa-mir-%d\t%d\t%.6f\t%s" % (i, count, count / 3.7, rng.choice("NY")))
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def make_segment_file(path, rng, nsegments=400):
+    aliquot = make_uuid(rng)
+    lines = ["GDC_Aliquot\tChromosome\tStart\tEnd\tNum_Probes\tSegment_Mean"]
+    for i in range(nsegments):
+        start = rng.randint(1, 2 * 10 ** 8)
+        lines.append("%s\t%s\t%d\t%d\t%d\t%.4f" % (aliquot, rng.choice(CHROMOSOMES)[3:], start,
+                                                   start + rng.randint(1000, 10 ** 7), rng.randint(5, 5000),
+                                                   rng.gauss(0, 0.5)))
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def make_maf_file(path, rng, nmutations=300, ncolumns=140):
+    named = ["Hugo_Symbol", "Entrez_Gene_Id", "Center", "NCBI_Build", "Chromosome", "Start_Position",
+             "End_Position", "Strand", "Variant_Classification", "Variant_Type", "Reference_Allele",
+             "Tumor_Seq_Allele1", "Tumor_Seq_Allele2", "Tumor_Sample_Barcode", "HGVSp_Short", "t_depth",
+             "t_ref_count", "t_alt_count", "IMPACT"]
+    columns = named + ["extra_%d" % i for i in range(ncolumns - len(named))]
+    barcode = "TCGA-%02d-%04d-01A" % (rng.randint(10, 99), rng.randint(1000, 9999))
+    lines = ["#version gdc-1.0.0", "#annotation.spec gdc-1.0.1-public", "\t".join(columns)]
+    for i in range(nmutations):
+        start = rng.randint(1, 2 * 10 ** 8)
+        depth = rng.randint(10, 300)
+        alt = rng.randint(1, depth)
+        values = ["GENE%d" % rng.randint(1, 2000), str(rng.randint(1, 10 ** 5)), "WUGSC", "GRCh38",
+                  rng.choice(CHROMOSOMES), str(start), str(start), "+", rng.choice(VARIANT_CLASSES), "SNP",
+                  rng.choice("ACGT"), rng.choice("ACGT"), rng.choice("ACGT"), barcode, "p.R%dQ" % rng.randint(1, 900),
+                  str(depth), str(depth - alt), str(alt), rng.choice(["HIGH", "MODERATE", "LOW", "MODIFIER"])]
+        values += [rng.choice(["", ".", "0.01", "rs%d" % rng.randint(1, 10 ** 7)]) for _ in columns[len(named):]]
+        lines.append("\t".join(values))
+    with gzip.open(path, "wt") as f:
+        f.write("\n".join(lines) + "\n")
@@ -1,11 +1,165 @@
-import pandas as pd
+from os.path import exists, getmtime
+from threading import Lock
+from file_utils import resource_path, lazy_import
+from gdc_metrics import get_logger
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+log = get_logger("bio_utils")
+
+HGNC_FILE = resource_path("non_alt_loci_set.txt")
+ID_COLUMNS = ("hgnc_id", "symbol", "ensembl_gene_id", "entrez_id")
+MULTI_COLUMNS = ("alias_symbol", "prev_symbol")  # several "|" separated values per gene
+
+
+class GeneIndex(object):
+    '''
+    Lookup index between the identifier systems of the HGNC table (ensembl_gene_id,
+    symbol, entrez_id, hgnc_id and the alias/previous symbols). The hash table of an
+    identifier system is built the first time it is converted from, and whole arrays
+    of identifiers are converted at once.
+    Constructor parameters:
+        columns: dictionary mapping each identifier column to an object array with one
+        value (or None) per gene
+    '''
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.keys = {}
+        self.__lock = Lock()
+
+    @classmethod
+    def fromTable(cls, hgnc):
+        '''
+        Builds the index from a DataFrame with the HGNC table
+        '''
+        names = [c for c in ID_COLUMNS + MULTI_COLUMNS if c in hgnc.columns]
+        return cls({c: hgnc[c].astype(object).where(hgnc[c].notna(), None).to_numpy() for c in names})
+
+    @classmethod
+    def fromFile(cls, path):
+        '''
+        Reads the index saved with save (a .npz file of string arrays, with empty
+        strings for missing values)
+        '''
+        with np.load(path) as data:
+            columns = {}
+            for c in data.files:
+                values = data[c].astype(object)
+                values[values == ""] = None
+                columns[c] = values
+        return cls(columns)
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            np.savez(f, **{c: np.array(["" if v is None else str(v) for v in values], dtype=str)
+                           for c, values in self.columns.items()})
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def lookupTable(self, column):
+        '''
+        Returns a tuple with the identifiers of a column (as a pandas Index without
+        duplicates) and the position of the gene each one belongs to. Identifiers
+        shared by several genes (e.g. aliases) map to the first one.
+        '''
+        if column not in self.keys:
+            if column not in self.columns:
+                raise KeyError("Unknown identifier system: " + column)
+            values = self.columns[column]
+            if column in MULTI_COLUMNS:
+                pairs = [(v, i) for i, entry in enumerate(values) if entry is not None for v in entry.split("|")]
+                values = np.array([p[0] for p in pairs], dtype=object)
+                genes = np.array([p[1] for p in pairs], dtype=np.int64)
+            else:
+                genes = np.flatnonzero(pd.notna(values))
+                values = values[genes]
+            keys = pd.Index(values)
+            first = ~keys.duplicated()
+            with self.__lock:
+                self.keys[column] = (keys[first], genes[first])
+        return self.keys[column]
+
+    def positions(self, names, format_from):
+        '''
+        Returns the positions of the genes with identifiers names (-1 if not found)
+        '''
+        keys, genes = self.lookupTable(format_from)
+        found = keys.get_indexer(pd.Index(names, dtype=object).astype(str))
+        # only the found positions are looked up, genes may be empty
+        positions = np.full(len(found), -1, dtype=np.int64)
+        ok = found >= 0
+        positions[ok] = genes[found[ok]]
+        return positions
+
+    def convert(self, names, format_from, format_to):
+        '''
+        Converts an array of identifiers from one identifier system to another.
+        Unknown identifiers are converted to None. A Series is converted to a Series
+        with the same index, other sequences to an object array.
+        '''
+        if format_to not in self.columns:
+            raise KeyError("Unknown identifier system: " + format_to)
+        rows = self.positions(np.asarray(names, dtype=object), format_from)
+        converted = np.where(rows >= 0, self.columns[format_to][rows], None)
+        if isinstance(names, pd.Series):
+            return pd.Series(converted, index=names.index, name=format_to)
+        return converted
+
+
+_gene_index = None
+_gene_index_lock = Lock()
+
+
+def load_gene_index(path=HGNC_FILE, cache=True):
+    '''
+    Builds the GeneIndex of an HGNC table (tab separated, as downloaded from
+    genenames.org). With cache=True the index is saved next to the table
+    (<path>.index.npz) and read from there while it is newer than the table.
+    '''
+    cached = path + ".index.npz"
+    if cache and exists(cached) and (not exists(path) or getmtime(cached) >= getmtime(path)):
+        return GeneIndex.fromFile(cached)
+    hgnc = pd.read_csv(path, sep="\t", dtype=str, usecols=lambda c: c in ID_COLUMNS + MULTI_COLUMNS)
+    index = GeneIndex.fromTable(hgnc)
+    if cache:
+        try:
+            index.save(cached)
+        except IOError as e:
+            log.warning("Unable to save the gene index: %s", e)
+    return index
+
+
+def get_gene_index():
+    '''
+    Returns the GeneIndex of the bundled HGNC table, loaded on first use
+    '''
+    global _gene_index
+    if _gene_index is None:
+        with _gene_index_lock:
+            if _gene_index is None:
+                _gene_index = load_gene_index(HGNC_FILE)
+    return _gene_index
 
-hgnc = pd.read_csv("resources/non_alt_loci_set.txt", sep = "\t", dtype=str).astype(str).applymap(lambda x: x if (not x == "nan") else None)
 
 def convertGeneName(name, format_from, format_to):
-    return hgnc[hgnc[format_from] == name][format_to]
+    return pd.Series(get_gene_index().convert([name], format_from, format_to)).dropna()
+
+
+def convertGeneNames(names, format_from, format_to):
+    '''
+    Converts an array (or Series) of gene identifiers, see GeneIndex.convert
+    '''
+    return get_gene_index().convert(names, format_from, format_to)
+
 
-def drop_GEQ_genes(X,genelist):
-    gns = hgnc.apply(lambda x: x.isin(genelist), axis=0).apply(any, axis=1)
-    names = hgnc["ensembl_gene_id"][gns].dropna()
-    return X[names]
+def drop_GEQ_genes(X, genelist):
+    '''
+    Returns the columns of X (Ensembl gene ids) of the genes with any identifier in
+    genelist
+    '''
+    index = get_gene_index()
+    rows = np.unique(np.concatenate([index.positions(genelist, c) for c in index.columns]))
+    names = index.columns["ensembl_gene_id"][rows[rows >= 0]]
+    return X[[n for n in names if n is not None]]
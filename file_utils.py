@@ -1,4 +1,59 @@
 import gzip
+import hashlib
+import sys
+import importlib
+from threading import RLock
+from os.path import dirname, join
+from gdc_metrics import get_metrics
+
+
+def resource_path(*parts):
+    '''
+    Returns the path of a file in the resources folder of the package, independently
+    of the current working directory
+    '''
+    return join(dirname(__file__), "resources", *parts)
+
+
+class LazyModule(object):
+    '''
+    Stand-in for a module that is imported when one of its attributes is first used.
+    The import runs under a lock and the module is only published once it is
+    complete, so threads that use it at the same time never see a half-loaded
+    module.
+    '''
+    __lock = RLock()
+
+    def __init__(self, name):
+        self.__name = name
+        self.__module = None
+
+    def __getattr__(self, attribute):
+        if attribute.startswith("_LazyModule__"):
+            # not set yet, e.g. on a copy made without calling __init__
+            raise AttributeError(attribute)
+        module = self.__module
+        if module is None:
+            with LazyModule.__lock:
+                if self.__module is None:
+                    self.__module = importlib.import_module(self.__name)
+                module = self.__module
+        return getattr(module, attribute)
+
+    def __repr__(self):
+        return "<lazy module " + repr(self.__name) + ">"
+
+
+def lazy_import(name):
+    '''
+    Returns a module that is only loaded when one of its attributes is first used
+    (e.g. pd = lazy_import("pandas")), so that heavy dependencies are not paid for by
+    scripts and worker processes that never use them (see LazyModule)
+    '''
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
+
 
 def generic_file_reader(path, fx):
     cont = None
@@ -11,6 +66,14 @@ None : lambda x: open(x, "r"),
 "gz": lambda x: gzip.open(x, "rb")
 }
 
+def read_bytes(path):
+    '''
+    Returns the content of a file as bytes, decompressing gzip files
+    '''
+    opener = gzip.open if getExtension(path) == "gz" else open
+    with opener(path, "rb") as f:
+        return f.read()
+
 def getExtension(path):
     name = path.split("/")[-1]
     ext = name.split(".")
@@ -26,3 +89,19 @@ def read_file(path):
     else:
         return generic_file_reader(path, FILE_READERS[ext])
 
+
+def file_hasher(path):
+    '''
+    Returns an md5 hash object updated with the content of path
+    '''
+    metrics = get_metrics()
+    hash_md5 = hashlib.md5()
+    with metrics.timer("md5"), open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1048576), b""):
+            hash_md5.update(chunk)
+            metrics.count("bytes_hashed", len(chunk))
+    return hash_md5
+
+
+def md5(fname):
+    return file_hasher(fname).hexdigest()
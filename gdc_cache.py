@@ -0,0 +1,136 @@
+import gzip
+import hashlib
+import json
+import os
+from os.path import exists, expanduser, join
+from threading import Lock
+from time import time
+from gdc_metrics import get_metrics
+
+DEFAULT_CACHE_DIR = join(expanduser("~"), ".cache", "gdc-portal-py")
+
+
+def canonical_params(params):
+    '''
+    Returns a canonical JSON string for a dictionary of query parameters. Filters
+    (serialized Operation objects) are decoded and re-encoded with sorted keys so
+    that equivalent queries map to the same string.
+    '''
+    canon = {}
+    for k, v in params.items():
+        if k == "filters" and isinstance(v, str):
+            v = json.loads(v)
+        canon[k] = v
+    return json.dumps(canon, sort_keys=True, separators=(",", ":"))
+
+
+class ResponseCache(object):
+    '''
+    Persistent on-disk cache of API responses, keyed by endpoint URL and query
+    parameters. Each response is stored as a gzip-compressed file.
+    Constructor parameters:
+        directory: folder where the cached responses are kept
+        ttl: number of seconds an entry remains valid (None for no expiry)
+        maxSize: maximum total size in bytes of the compressed entries. When exceeded,
+        the least recently used entries are removed.
+    '''
+    EXTENSION = ".gz"
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, ttl=86400, maxSize=1073741824):
+        self.directory = directory
+        self.ttl = ttl
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self.__lock = Lock()
+        if not exists(directory):
+            os.makedirs(directory)
+
+    def key(self, url, params):
+        return hashlib.sha256((url + "?" + canonical_params(params)).encode("utf-8")).hexdigest()
+
+    def path(self, url, params):
+        return join(self.directory, self.key(url, params) + ResponseCache.EXTENSION)
+
+    def get(self, url, params):
+        '''
+        Returns the cached response content for the query, or None if it is missing
+        or expired
+        '''
+        path = self.path(url, params)
+        try:
+            stat = os.stat(path)
+            valid = self.ttl is None or time() - stat.st_mtime <= self.ttl
+            if valid:
+                with gzip.open(path, "rt", encoding="utf-8") as f:
+                    content = f.read()
+                # the access time records recency for LRU eviction
+                os.utime(path, (time(), stat.st_mtime))
+        except (OSError, EOFError):
+            valid = False
+        with self.__lock:
+            if valid:
+                self.hits += 1
+            else:
+                self.misses += 1
+        get_metrics().count("cache_hits" if valid else "cache_misses")
+        return content if valid else None
+
+    def put(self, url, params, content):
+        '''
+        Stores the content of a response and evicts old entries if needed
+        '''
+        path = self.path(url, params)
+        tmp = path + "." + str(os.getpid()) + ".tmp"
+        with gzip.open(tmp, "wt", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(tmp, path)
+        if self.maxSize is not None:
+            self.evict()
+
+    def entries(self):
+        '''
+        Returns a list of (path, stat) tuples for every cached response
+        '''
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(ResponseCache.EXTENSION):
+                path = join(self.directory, name)
+                try:
+                    entries.append((path, os.stat(path)))
+                except OSError:
+                    pass
+        return entries
+
+    def evict(self):
+        '''
+        Removes expired entries, then the least recently used ones until the cache
+        fits in maxSize
+        '''
+        entries = sorted(self.entries(), key=lambda e: e[1].st_atime)
+        now = time()
+        size = sum(stat.st_size for _, stat in entries)
+        for path, stat in entries:
+            expired = self.ttl is not None and now - stat.st_mtime > self.ttl
+            if expired or (self.maxSize is not None and size > self.maxSize):
+                try:
+                    os.remove(path)
+                    size -= stat.st_size
+                except OSError:
+                    pass
+
+    def clear(self):
+        for path, _ in self.entries():
+            os.remove(path)
+
+    def stats(self):
+        '''
+        Returns a dictionary with hit/miss counters and the size of the cache
+        '''
+        entries = self.entries()
+        total = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total > 0 else 0.0,
+                "entries": len(entries),
+                "size": sum(stat.st_size for _, stat in entries)}
@@ -1,10 +1,23 @@
 import operator
 
-import pandas as pd
 from io import StringIO
-from numpy import where
-from functools import reduce
-from gdc_rest import RequestEndpoint, http_post
+from gdc_rest import RequestEndpoint, http_post, DownloadStatus, BASE_URL, check_downloads
+from gdc_manifest import Md5Manifest
+from gdc_matrix import build_matrix, MatrixBuilder
+from gdc_parsers import get_parser, build_table
+from gdc_flatten import flatten_hits, compact_frame, frame_memory
+from gdc_query import FrameIndex, filter_frame, predicate_mask
+from gdc_dataset import save_dataset, load_dataset, update_dataset, read_dataset_metadata, read_dataset_index, \
+    read_dataset_columns, create_matrix, write_dataset_labels, finish_update, OnDiskMatrix, METADATA_FILE
+from os.path import exists
+from time import perf_counter
+from file_utils import lazy_import
+from gdc_metrics import get_logger, get_metrics, Metrics
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+log = get_logger("data_processing")
+metrics = get_metrics()
 
 
 def unfold_dataframe(df, identifier, meta, sep="."):
@@ -42,11 +55,16 @@ def unlist_singles(iterable, parent=None, index=None):
 OPERATORS = {"and": operator.and_, "or": operator.or_, "is": operator.is_, "not": operator.not_}
 
 
-def dataframe_filter(dataframe, operator_function, conditions):
-    truthvalues = [dataframe[k] == v for k, v in iter(conditions.items())]
-    intersect = list(set(where(reduce(operator_function, truthvalues))[0]))
-    if len(intersect) > 0:
-        return dataframe.iloc[intersect,]
+def dataframe_filter(dataframe, operator_function, conditions, index=None):
+    '''
+    Returns the rows of dataframe, in their original order, that satisfy conditions:
+    either a dictionary of {column: value} equality conditions (values can be lists
+    of accepted values) combined with operator_function, or an Operation tree as
+    used in API queries. index is an optional gdc_query.FrameIndex of dataframe.
+    '''
+    df = filter_frame(dataframe, conditions, operator_function, index)
+    if df.shape[0] > 0:
+        return df
     else:
         raise Exception("No columns were selected. Filtering resulted in an empty DataFrame")
 
@@ -62,8 +80,8 @@ class LayeredDataframe():
         self.__update_indexes()
 
     def __update_indexes(self):
-        self.listids = self.data.columns[where(self.data.apply(lambda x: list in [type(i) for i in x]))]
-        self.dictids = self.data.columns[where(self.data.apply(lambda x: dict in [type(i) for i in x]))]
+        self.listids = self.data.columns[np.where(self.data.apply(lambda x: list in [type(i) for i in x]))]
+        self.dictids = self.data.columns[np.where(self.data.apply(lambda x: dict in [type(i) for i in x]))]
 
     def extract(self, identifier, metacolumn):
         records = self.data[identifier].tolist()
@@ -73,10 +91,10 @@ class LayeredDataframe():
         return dataframe
 
 class GDCProjectData(object):
-    def __init__(self):
-        request = RequestEndpoint(RequestEndpoint.PROJECTS,format="tsv",size=1000,fields="*")
-        data = request.request(http_post, convert=False)
-        self.data = pd.read_csv(StringIO(data.decode("utf-8")), sep="\t")
+    def __init__(self, cache=None, refresh=False):
+        request = RequestEndpoint(RequestEndpoint.PROJECTS, cache=cache, format="tsv", size=1000, fields="*")
+        data = request.request(http_post, convert=False, refresh=refresh)
+        self.data = pd.read_csv(StringIO(data), sep="\t")
         self.data.index = self.data["project_id"]
 
     def getProjectNames(self):
@@ -89,10 +107,36 @@ class GDCProjectData(object):
         return self.data.loc[projectNames,:]
 
 class GDCCaseMetadataHandler(object):
-    def __init__(self, filter=None, fields="*", expand=None, maxEntries=10000):
+    '''
+    Retrieves case metadata and flattens it into a case table (getData) and child
+    tables with one row per element of the lists in explode (getBranch), e.g. one
+    row per file of each case. If stream is True, each page is parsed incrementally
+    while it is received and its hits are flattened one at a time, so memory use
+    does not grow with pageSize (pages are then fetched sequentially and not cached).
+    If compact is True, low-cardinality string columns of the tables are stored as
+    categoricals (see gdc_flatten.compact_frame).
+    If report is True, a summary of the time spent fetching and flattening the
+    metadata, the requests sent and the cache hit rate is logged once the tables are
+    built (see gdc_metrics).
+    baseUrl and session are passed to the RequestEndpoint used for the metadata and
+    the downloads of the file classes (e.g. to use a mirror or a local server).
+    tables is an optional tuple with a case table and a dictionary of child tables
+    retrieved earlier with the same filter (e.g. read back from files), used
+    instead of requesting the metadata.
+    '''
+    def __init__(self, filter=None, fields="*", expand=None, maxEntries=None, pageSize=1000, workers=4, cache=None,
+                 refresh=False, explode=("files",), stream=False, compact=False, report=False, baseUrl=BASE_URL,
+                 session=None, tables=None):
+        self.explode = tuple(explode)
+        self.filter = filter
+        self.stream = stream
+        self.compact = compact
+        self.maxEntries = maxEntries
+        self.pageSize = pageSize
+        self.workers = workers
+        self.refresh = refresh
         params = {
             "format": "json",
-            "size": maxEntries,
             "pretty": "false",
             "fields": ','.join(fields) if isinstance(fields, list) else fields, }
 
@@ -101,103 +145,242 @@ class GDCCaseMetadataHandler(object):
         if expand is not None:
             params["expand"] = ','.join(expand) if isinstance(expand, list) else expand
 
-        self.req = RequestEndpoint(endpoint=RequestEndpoint.CASES, **params)
-        self.__frame = self.fetch()
-        self.__frame.unfold("case_id")
+        self.req = RequestEndpoint(endpoint=RequestEndpoint.CASES, baseUrl=baseUrl, session=session, cache=cache,
+                                   **params)
+        before = metrics.snapshot()
+        self.__data, self.__branches = self.fetch() if tables is None else tables
+        # False if maxEntries cut the retrieval short
+        self.complete = maxEntries is None or self.__data.shape[0] < maxEntries
+        self.__index = None
+        if report:
+            log.info("Metadata summary:\n" + metrics.report(before))
 
     def getData(self):
-        return self.__frame.data
+        return self.__data
+
+    def getIndex(self):
+        '''
+        Returns the gdc_query.FrameIndex of the case table, built on first use
+        '''
+        if self.__index is None:
+            self.__index = FrameIndex(self.__data)
+        return self.__index
 
     def fetch(self):
-        print("Retrieving case/file metadata")
-        data = self.req.request(http_post, convert=True)
-        unlist_singles(data)
-        print("Data retrieval is now complete")
-        return LayeredDataframe(pd.DataFrame(data))
+        log.info("Retrieving case/file metadata")
+        start = perf_counter()
+        if self.stream:
+            hits = self.req.iterHits(http_post, self.pageSize, self.maxEntries, stream=True)
+        else:
+            hits = (hit for page in self.req.iterPages(http_post, self.pageSize, self.maxEntries, self.workers,
+                                                       ordered=True, refresh=self.refresh)
+                    for hit in page)
+        # pages are flattened as they arrive, so the time spent waiting for them is
+        # measured separately and the rest is attributed to flattening
+        received = Metrics()
+        data, branches = flatten_hits(received.timedIterator(hits, "fetch"), key="case_id", explode=self.explode)
+        fetched = received.times.get("fetch", 0.0)
+        metrics.addTime("fetch", fetched)
+        metrics.addTime("flatten", perf_counter() - start - fetched)
+        if self.compact:
+            with metrics.timer("compact"):
+                data = compact_frame(data, verbose=True)
+                branches = {path: compact_frame(branch, verbose=True) for path, branch in branches.items()}
+        log.info("Data retrieval is now complete")
+        return data, branches
 
     def getBranch(self, identifier, metacolumn):
-        df = self.__frame.extract(identifier, metacolumn)
-        # df.index = self.__frame.data[metacolumn]
-        return df
+        if identifier not in self.__branches:
+            return LayeredDataframe(self.__data).extract(identifier, metacolumn)
+        df = self.__branches[identifier]
+        if metacolumn not in df.columns:
+            df = pd.merge(df, self.__data[["case_id", metacolumn]], how="left", on="case_id")
+        return df.copy()
 
 
 class GDCFileData(object):
+    '''
+    Table of the files of the cases of a GDCCaseMetadataHandler, filtered by
+    filterparams, and their metadata (file data joined with the case table).
+    If compact is True, low-cardinality string columns of the file data are stored
+    as categoricals. If normalize is True, the join with the case table is not kept
+    in memory: getMetadata builds it on demand and getOutputVector maps case columns
+    to the files through case_id.
+    '''
     filterparams = None
 
-    def __init__(self, handler, metacolumn="case_id", fileidcolumn="file_id", filterparams=None):
+    def __init__(self, handler, metacolumn="case_id", fileidcolumn="file_id", filterparams=None, compact=False,
+                 normalize=False):
         self.handler = handler
         self.metacolumn = metacolumn
         self.fileidcolumn = fileidcolumn
+        self.compact = compact
+        self.normalize = normalize
         self.dataindex = None
         if filterparams is not None:
             if self.filterparams is None:
                 self.filterparams = filterparams
             else:
+                # copy, so that the class defaults are not modified
+                self.filterparams = dict(self.filterparams)
                 self.filterparams.update(filterparams)
-        ld = LayeredDataframe(self.handler.getBranch(identifier="files", metacolumn=self.metacolumn))
-        ld.unfold(fileidcolumn)
-        data = ld.data
+        data = self.handler.getBranch(identifier="files", metacolumn=self.metacolumn)
 
         if self.filterparams is not None:
             data = dataframe_filter(data, OPERATORS["and"], self.filterparams)
+        if compact:
+            data = compact_frame(data, verbose=True)
 
-        self.__dataframe = LayeredDataframe(data)
-        self.__dataframe.unfold(fileidcolumn)
+        self.__data = data
+        self.__index = None
         self.updateIndex()
         self.updateMetadata()
 
+    def joinMetadata(self, columns=None):
+        '''
+        Joins the file data with the case table (restricted to columns, if given)
+        '''
+        cases = self.handler.getData().drop(["files"], axis=1, errors="ignore")
+        if columns is not None:
+            cases = cases[[c for c in cases.columns if c in columns or c == self.metacolumn]]
+        return pd.merge(self.getFileData(), cases, how="left", on=self.metacolumn)
+
     def updateMetadata(self):
         # df = pd.concat([self.getFileData(), self.handler.getData().drop(["files"], axis=1)],
         #                keys=[self.metacolumn],
         #                axis=1,
         #                ignore_index=False)
-        df = pd.merge(self.getFileData(), self.handler.getData().drop(["files"], axis=1), how="left", on=self.metacolumn)
-        self.__metadata = df
-        self.metafeatures = self.__metadata.columns
-        print("Metadata for the requested cases has been updated")
+        if self.normalize:
+            self.__metadata = None
+            cases = self.handler.getData().columns.drop(["files", self.metacolumn], errors="ignore")
+            self.metafeatures = self.getFileData().columns.append(cases)
+        else:
+            self.__metadata = self.joinMetadata()
+            self.metafeatures = self.__metadata.columns
+        log.info("Metadata for the requested cases has been updated")
 
     def getFileData(self):
-        return self.__dataframe.data
+        return self.__data
+
+    def getFileIndex(self):
+        '''
+        Returns the gdc_query.FrameIndex of the file data, built on first use
+        '''
+        if self.__index is None:
+            self.__index = FrameIndex(self.__data)
+        return self.__index
 
     def filterByCaseMetadata(self, d, operator="and", update=False):
-        cases = dataframe_filter(self.handler.getData(), OPERATORS[operator], d)
-        df = self.__dataframe.data[self.__dataframe.data[self.metacolumn].apply(lambda x: x in cases[self.metacolumn])]
+        '''
+        Keeps the files of the cases that satisfy d, a dictionary of {column: value}
+        conditions combined with operator or an Operation tree
+        '''
+        cases = dataframe_filter(self.handler.getData(), OPERATORS[operator], d, self.handler.getIndex())
+        index = self.getFileIndex().get(self.metacolumn)
+        if index is not None:
+            mask = index.mask(cases[self.metacolumn].unique())
+        else:
+            mask = self.__data[self.metacolumn].isin(cases[self.metacolumn]).to_numpy()
+        df = self.__data[mask]
         if update:
-            self.__dataframe.data = df
+            self.__data = df
+            self.__index = None
         else:
             return df
         self.updateIndex()
         self.updateMetadata()
 
     def filterByFileData(self, d, operator="and", update=False):
-        df = dataframe_filter(self.__dataframe.data, OPERATORS[operator], d)
+        '''
+        Keeps the files that satisfy d, a dictionary of {column: value} conditions
+        combined with operator or an Operation tree
+        '''
+        df = dataframe_filter(self.__data, OPERATORS[operator], d, self.getFileIndex())
         if update:
-            self.__dataframe.data = df
+            self.__data = df
+            self.__index = None
         else:
             return df
         self.updateIndex()
         self.updateMetadata()
 
-    def confirmLocalStorage(self, path, download=True, file_name_col="file_name"):
-        fd = self.getFileData()
-        self.handler.req.downloadFromTSVMetadata(fd, writeFolder=path)
+    def confirmLocalStorage(self, path, download=True, file_name_col="file_name", workers=1, maxPerHost=None,
+                            batched=False, useManifest=True, verify=False, files=None, callback=None):
+        fd = self.getFileData() if files is None else files
+        manifest = Md5Manifest(path, force=verify) if useManifest else None
+        if batched:
+            return self.handler.req.downloadBatchesFromTSVMetadata(fd, colnm_file_name=file_name_col,
+                                                                   writeFolder=path, workers=workers,
+                                                                   manifest=manifest, callback=callback)
+        return self.handler.req.downloadFromTSVMetadata(fd, colnm_file_name=file_name_col, writeFolder=path,
+                                                        workers=workers, maxPerHost=maxPerHost, manifest=manifest,
+                                                        callback=callback)
 
     def updateIndex(self):
         fileids = self.getFileData()[self.fileidcolumn].tolist()
         caseids = self.getFileData()[self.metacolumn].tolist()
         idx = pd.MultiIndex.from_tuples(list(zip(*[caseids,fileids])),
             names=[self.metacolumn, self.fileidcolumn])
-        print("Sample index has been updated")
+        log.info("Sample index has been updated")
         self.dataindex = idx
 
-    def getMetadata(self):
+    def getMetadata(self, columns=None):
+        if self.__metadata is None:
+            return self.joinMetadata(columns)
         return self.__metadata
 
     def getOutputVector(self, column):
-        col = self.getMetadata()[column]
+        if self.__metadata is not None:
+            col = self.getMetadata()[column]
+        elif column in self.getFileData().columns:
+            col = self.getFileData()[column]
+        else:
+            # map the case values to the files through case_id
+            cases = self.handler.getData()
+            values = pd.Series(cases[column].to_numpy(), index=cases["case_id"].to_numpy(), name=column)
+            col = values.reindex(self.getFileData()["case_id"].to_numpy())
+        col = col.copy()
         col.index = self.dataindex
         return col
 
+    def selectFiles(self, samples=None):
+        '''
+        Returns the files whose rows of getMetadata() satisfy samples (an Operation, a
+        dictionary of conditions or a function, see gdc_query.predicate_mask) and
+        their part of dataindex
+        '''
+        if samples is None:
+            return self.getFileData(), self.dataindex
+        mask = predicate_mask(self.getMetadata(), samples)
+        log.info("Selected %d of %d files", mask.sum(), len(mask))
+        return self.getFileData()[mask], self.dataindex[mask]
+
+    def getParser(self, files=None):
+        '''
+        Returns the parser (see gdc_parsers) of the files, chosen by their data_type
+        and analysis.workflow_type, or None if there are no files or no data_type
+        column. Raises a KeyError if no parser is registered for their data type and
+        a ValueError if files of different formats are selected.
+        '''
+        files = self.getFileData() if files is None else files
+        if "data_type" not in files.columns:
+            return None
+        workflows = files["analysis.workflow_type"] if "analysis.workflow_type" in files.columns else None
+        pairs = set(zip(files["data_type"], workflows if workflows is not None else [None] * files.shape[0]))
+        parsers = {id(get_parser(*pair)): get_parser(*pair) for pair in pairs}
+        if len(parsers) > 1:
+            raise ValueError("The files have different formats, filter them first: " + str(sorted(map(str, pairs))))
+        return next(iter(parsers.values())) if parsers else None
+
+    def memoryUsage(self):
+        '''
+        Returns the memory (in bytes) used by the case table, the file data and the
+        metadata join (0 if it is built on demand)
+        '''
+        return {"cases": frame_memory(self.handler.getData()),
+                "files": frame_memory(self.getFileData()),
+                "metadata": frame_memory(self.__metadata) if self.__metadata is not None else 0}
+
 class GeneExpressionQuantification(GDCFileData):
     filterparams = {
         "access": "open",
@@ -207,25 +390,249 @@ class GeneExpressionQuantification(GDCFileData):
     # Function to read files with FPKM counts and convert into a dataframe
     def parse_file(self, path, verbose=False):
         if verbose:
-            print("Reading file: ", path)
+            log.info("Reading file: %s", path)
         return pd.read_csv(path, sep='\t', header=None, index_col=0)
 
-    def __getDataFrameFromFiles(self, filepath):
-        filelist = self.getFileData()["file_name"].tolist()
-        df = pd.concat((self.parse_file(filepath + path, False) for path in filelist), axis=1).T
+    def __getDataFrameFromFiles(self, filepath, dtype="float64", workers=None, files=None, genes=None, key=None,
+                                allocate=None):
+        files = self.getFileData() if files is None else files
+        filelist = files["file_name"].tolist()
+        genes, matrix = build_matrix([filepath + path for path in filelist], dtype=dtype, workers=workers,
+                                     features=genes, key=key, allocate=allocate, parser=self.getParser(files))
+        return pd.DataFrame(matrix, columns=genes, copy=False)
+
+    def __getDataFrameWhileDownloading(self, filepath, dtype="float64", workers=None, downloadWorkers=1,
+                                       batched=False, verify=False, files=None, genes=None, key=None, allocate=None):
+        # each file is parsed as soon as it is downloaded (or found valid on disk)
+        files = self.getFileData() if files is None else files
+        builder = MatrixBuilder(files.shape[0], dtype=dtype, workers=workers, features=genes, key=key,
+                                allocate=allocate, parser=self.getParser(files))
+
+        def collect(i, result):
+            if result.status in (DownloadStatus.OK, DownloadStatus.SKIPPED):
+                builder.add(i, filepath + result.file_name)
+            else:
+                builder.fail(i, "Unable to download " + str(result.file_name) + ": " +
+                             str(result.error or result.status))
+
+        self.confirmLocalStorage(filepath, workers=downloadWorkers, batched=batched, verify=verify, files=files,
+                                 callback=collect)
+        genes, matrix = builder.finish()
+        return pd.DataFrame(matrix, columns=genes, copy=False)
+
+    def getDataMatrix(self, filepath, caseMetaColumn="case_id", fileIdColumn="file_name", removeEnsemblRevisionId=True,
+                      downloadWorkers=1, batchedDownload=False, verifyChecksums=False, dtype="float64",
+                      parseWorkers=None, download=True, pipelined=False, genes=None, samples=None, allocate=None,
+                      report=False):
+        '''
+        Downloads missing files and assembles the sample x gene expression matrix.
+        dtype sets the type of the matrix (e.g. np.float32) and parseWorkers the
+        number of processes used to parse files (None uses every CPU). Set download
+        to False if the files were already downloaded with confirmLocalStorage.
+        With pipelined=True, files are parsed while the others are still being
+        downloaded instead of after every download has finished.
+        genes restricts the matrix to a list of genes, in that order (Ensembl ids,
+        without revision if removeEnsemblRevisionId is True); only their values are
+        converted. samples selects the files to download and parse with a predicate
+        on the rows of getMetadata(): an Operation, a dictionary of conditions or a
+        function returning a boolean vector (see gdc_query.predicate_mask). Output
+        vectors can then be aligned with getOutputVector(column).loc[X.index].
+        allocate is passed to gdc_matrix.build_matrix (see getOnDiskMatrix).
+        If report is True, a summary of the time spent downloading, hashing and
+        parsing files, the bytes downloaded and the throughput is logged at the end
+        (see gdc_metrics).
+        '''
+        assert isinstance(filepath, str), "File path must be a string."
+        before = metrics.snapshot()
+        files, index = self.selectFiles(samples)
+        key = strip_revision if removeEnsemblRevisionId else None
+        if download and pipelined:
+            df = self.__getDataFrameWhileDownloading(filepath, dtype, parseWorkers, downloadWorkers, batchedDownload,
+                                                     verifyChecksums, files, genes, key, allocate)
+        else:
+            if download:
+                results = self.confirmLocalStorage(filepath, workers=downloadWorkers, batched=batchedDownload,
+                                                   verify=verifyChecksums, files=files)
+                # failed files would otherwise be parsed from stale data or be missing
+                check_downloads(results)
+            df = self.__getDataFrameFromFiles(filepath, dtype, parseWorkers, files, genes, key, allocate)
+        df.index = index
+        if removeEnsemblRevisionId:
+            df.columns = [strip_revision(f) for f in df.columns]
+        if report:
+            log.info("Data matrix summary:\n" + metrics.report(before))
         return df
 
-    def getDataMatrix(self, filepath, caseMetaColumn="case_id", fileIdColumn="file_name", removeEnsemblRevisionId=True):
+    def getOnDiskMatrix(self, filepath, datasetPath, outputs=(), dtype="float64", **options):
+        '''
+        Out-of-core version of getDataMatrix for matrices that do not fit in memory:
+        each row is written into a memory-mapped matrix in the dataset folder
+        datasetPath as soon as its file is parsed, and the dataset (see gdc_dataset)
+        is completed with the sample index, gene names and the output vectors of the
+        metadata columns in outputs.
+        Other arguments (genes, samples, pipelined, parseWorkers, ...) are passed to
+        getDataMatrix.
+        Returns a gdc_dataset.OnDiskMatrix over the dataset
+        '''
+        allocated = []
+
+        def allocate(shape, dtype):
+            allocated.append(create_matrix(datasetPath, shape, dtype))
+            return allocated[-1]
+
+        X = self.getDataMatrix(filepath, dtype=dtype, allocate=allocate, **options)
+        if allocated:
+            allocated[0].flush()
+        else:
+            # no rows: nothing was allocated
+            save_dataset(datasetPath, X)
+        vectors = {column: self.getOutputVector(column).loc[X.index] for column in outputs}
+        write_dataset_labels(datasetPath, X.columns, X.index, str(np.dtype(dtype)), vectors)
+        del X, allocated
+        return OnDiskMatrix(datasetPath)
+
+    def updateDataMatrix(self, filepath, datasetPath, outputs=(), removeEnsemblRevisionId=True, downloadWorkers=1,
+                         dtype="float64", parseWorkers=None):
+        '''
+        Incrementally builds the gene expression matrix in a binary dataset (see
+        gdc_dataset) that keeps, for every row, the md5 checksum of its source file.
+        On the first run the full matrix is built and saved. On later runs, rows of
+        files no longer in getFileData() are dropped, rows of unchanged files are
+        kept as they are, and only new or changed files are downloaded and parsed
+        and their rows appended.
+        Parameters:
+            filepath: folder with the expression files
+            datasetPath: folder of the dataset
+            outputs: metadata columns saved as output vectors (see getOutputVector)
+            dtype: type of the matrix when it is first built
+        Returns a tuple with the matrix and the dictionary of output vectors, in the
+        order of the rows of the dataset
+        '''
+        fd = self.getFileData()
+        checksums = dict(zip(fd[self.fileidcolumn].astype(str), fd["md5sum"].astype(str)))
+        extra = {"files": checksums}
+        vectors = {column: self.getOutputVector(column) for column in outputs}
+        if exists(datasetPath):
+            finish_update(datasetPath)
+        if not exists(datasetPath + "/" + METADATA_FILE):
+            X = self.getDataMatrix(filepath, removeEnsemblRevisionId=removeEnsemblRevisionId,
+                                   downloadWorkers=downloadWorkers, dtype=dtype, parseWorkers=parseWorkers)
+            save_dataset(datasetPath, X, vectors, extra)
+            return load_dataset(datasetPath)
+
+        previous = read_dataset_metadata(datasetPath)["extra"].get("files", {})
+        index = read_dataset_index(datasetPath)
+        fileids = index.get_level_values(self.fileidcolumn)
+        keep = [i for i, f in enumerate(fileids) if checksums.get(f) is not None and checksums[f] == previous.get(f)]
+        kept = set(fileids[keep])
+        pending = (~fd[self.fileidcolumn].astype(str).isin(kept)).to_numpy()
+        changed = fd[pending]
+        log.info("Updating dataset: %d rows kept, %d dropped, %d files to parse", len(keep), len(fileids) - len(keep),
+                 changed.shape[0])
+
+        columns = read_dataset_columns(datasetPath)
+        if changed.shape[0] > 0:
+            check_downloads(self.confirmLocalStorage(filepath, workers=downloadWorkers, files=changed))
+            X = self.__getDataFrameFromFiles(filepath, dtype=read_dataset_metadata(datasetPath)["dtype"],
+                                             workers=parseWorkers, files=changed)
+            X.index = self.dataindex[pending]
+            if removeEnsemblRevisionId:
+                X.columns = [strip_revision(f) for f in X.columns]
+        else:
+            X = pd.DataFrame(columns=columns, index=self.dataindex[:0])
+        update_dataset(datasetPath, keep, X, vectors, extra)
+        return load_dataset(datasetPath)
+
+
+
+
+class MiRNAExpressionQuantification(GeneExpressionQuantification):
+    '''
+    miRNA expression files (one row per miRNA). getDataMatrix assembles the sample x
+    miRNA matrix of the reads_per_million_miRNA_mapped column.
+    '''
+    filterparams = {
+        "access": "open",
+        "data_type": "miRNA Expression Quantification"
+    }
+
+
+class TabularFileData(GDCFileData):
+    '''
+    Files with any number of rows per sample, read into a single long-format table
+    '''
+
+    def getDataTable(self, filepath, download=True, downloadWorkers=1, parseWorkers=None, samples=None,
+                     metaColumns=()):
+        '''
+        Downloads missing files and reads them into a long-format DataFrame, with the
+        file id and metacolumn (e.g. case_id) of each row, plus the metadata columns
+        in metaColumns. A file of several cases (e.g. a MAF of a tumor / normal pair)
+        is parsed once and its rows are repeated for each of its cases.
+        samples selects the files with a predicate on getMetadata() (see getDataMatrix)
+        '''
         assert isinstance(filepath, str), "File path must be a string."
-        self.confirmLocalStorage(filepath)
+        files = self.selectFiles(samples)[0]
+        if download:
+            check_downloads(self.confirmLocalStorage(filepath, workers=downloadWorkers, files=files))
+        parser = self.getParser(files)
+        if parser is not None and parser.kind != "table":
+            raise ValueError("The files are not read as tables, use a matrix parser instead")
+        unique = files.drop_duplicates(self.fileidcolumn)
+        table = build_table([filepath + f for f in unique["file_name"]], parser, unique[self.fileidcolumn].tolist(),
+                            self.fileidcolumn, parseWorkers) if parser is not None else pd.DataFrame()
+        columns = [self.metacolumn] + [c for c in metaColumns if c not in (self.metacolumn, self.fileidcolumn)]
+        if table.shape[0] > 0:
+            keys = [self.fileidcolumn, self.metacolumn]
+            metadata = self.getMetadata(columns)[[self.fileidcolumn] + columns].drop_duplicates(keys)
+            metadata = pd.merge(files[keys].drop_duplicates(), metadata, how="left", on=keys)
+            table = pd.merge(table, metadata, how="left", on=self.fileidcolumn)
+        return table
+
+
+class CopyNumberSegment(TabularFileData):
+    '''
+    Copy number segment files (one row per segment: chromosome, start, end, number
+    of probes and mean log2 ratio)
+    '''
+    filterparams = {
+        "access": "open",
+        "data_type": ["Copy Number Segment", "Masked Copy Number Segment"]
+    }
 
-        df = self.__getDataFrameFromFiles(filepath)
-        df.index = self.dataindex
-        if removeEnsemblRevisionId:
-            df.columns = [f.split(".")[0] for f in df.columns]
-        return df
 
+class MaskedSomaticMutation(TabularFileData):
+    '''
+    Masked somatic mutation (MAF) files, one row per mutation
+    '''
+    filterparams = {
+        "access": "open",
+        "data_type": "Masked Somatic Mutation"
+    }
 
+    def getMutationMatrix(self, filepath, column="Hugo_Symbol", variantClassifications=None, samples=None,
+                          **options):
+        '''
+        Returns a sample x gene matrix with the number of mutations of each gene
+        (or other column of the MAF files) in each file, indexed like dataindex.
+        variantClassifications optionally restricts the count to some classes of
+        Variant_Classification (e.g. ["Missense_Mutation", "Nonsense_Mutation"]).
+        Other arguments are passed to getDataTable.
+        '''
+        table = self.getDataTable(filepath, samples=samples, **options)
+        if variantClassifications is not None:
+            table = table[table["Variant_Classification"].isin(variantClassifications)]
+        counts = pd.crosstab([table[self.fileidcolumn], table[self.metacolumn]], table[column])
+        files, index = self.selectFiles(samples)
+        counts = counts.reindex(pd.MultiIndex.from_arrays([files[self.fileidcolumn].to_numpy(),
+                                                           files[self.metacolumn].to_numpy()]), fill_value=0)
+        counts.index = index
+        return counts
+
+
+def strip_revision(gene):
+    # ENSG00000000003.13 -> ENSG00000000003
+    return gene.split(".")[0]
 
 
 def filter_by_output_vector(X, y, outputs, outputType="class"):
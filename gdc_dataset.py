@@ -0,0 +1,325 @@
+import json
+from os import makedirs, remove, replace
+from os.path import exists, join
+from file_utils import lazy_import
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+MATRIX_FILE = "matrix.npy"
+COLUMNS_FILE = "columns.npy"
+INDEX_FILE = "index.npy"
+METADATA_FILE = "dataset.json"
+UPDATE_FILE = "update.json"
+TEMPORARY_SUFFIX = ".tmp"
+
+
+def encode_output_vector(y, index):
+    '''
+    Returns the JSON representation of an output vector, aligned with index
+    '''
+    values = y.reindex(index) if not y.index.equals(index) else y
+    return {"dtype": str(values.dtype), "values": [None if v != v else v for v in values.tolist()]}
+
+
+def save_dataset(path, X, outputs=None, extra=None):
+    '''
+    Saves a sample x feature matrix in a binary dataset folder:
+        matrix.npy - the values, as a NumPy array that can be memory-mapped
+        columns.npy, index.npy - feature names and sample index (e.g. the case_id /
+        file_id MultiIndex of GDCFileData.dataindex) as fixed width string arrays
+        dataset.json - index names, dtype and the output vectors
+    Parameters:
+        path: folder where the dataset is written (created if needed)
+        X: DataFrame with the matrix
+        outputs: dictionary of output vectors (as returned by getOutputVector)
+        indexed like X
+        extra: dictionary of additional JSON serializable information
+    '''
+    if not exists(path):
+        makedirs(path)
+    finish_update(path)
+    with open(temporary_path(path, MATRIX_FILE), "wb") as f:
+        np.save(f, np.ascontiguousarray(X.to_numpy()))
+    write_dataset_labels(path, X.columns, X.index, str(X.to_numpy().dtype) if X.shape[1] > 0 else None, outputs,
+                         extra)
+
+
+def create_matrix(path, shape, dtype="float64"):
+    '''
+    Creates the matrix file of a dataset as a writable memory-mapped array, so that
+    it can be filled row by row without holding it in memory. The array is a
+    temporary file that replaces the matrix of the dataset (if any) only when
+    write_dataset_labels is called, so a build that fails leaves the dataset as it
+    was.
+    '''
+    if not exists(path):
+        makedirs(path)
+    finish_update(path)
+    return np.lib.format.open_memmap(temporary_path(path, MATRIX_FILE), mode="w+", dtype=dtype, shape=tuple(shape))
+
+
+def write_dataset_labels(path, columns, index, dtype, outputs=None, extra=None):
+    '''
+    Writes the feature names, sample index and metadata of a dataset whose matrix
+    was already written to a temporary file (see save_dataset and create_matrix),
+    and moves them all into place (see replace_files)
+    '''
+    with open(temporary_path(path, COLUMNS_FILE), "wb") as f:
+        np.save(f, np.array([str(c) for c in columns], dtype=str))
+    with open(temporary_path(path, INDEX_FILE), "wb") as f:
+        np.save(f, index.to_frame(index=False).astype(str).to_numpy(dtype=str))
+    meta = {"index_names": list(index.names),
+            "shape": [len(index), len(columns)],
+            "dtype": dtype,
+            "outputs": {},
+            "extra": extra if extra is not None else {}}
+    for name, y in (outputs or {}).items():
+        meta["outputs"][name] = encode_output_vector(y, index)
+    with open(temporary_path(path, METADATA_FILE), "w") as f:
+        json.dump(meta, f)
+    names = [COLUMNS_FILE, INDEX_FILE, METADATA_FILE]
+    replace_files(path, ([MATRIX_FILE] if exists(temporary_path(path, MATRIX_FILE)) else []) + names)
+
+
+def temporary_path(path, name):
+    return join(path, name + TEMPORARY_SUFFIX)
+
+
+def replace_files(path, names):
+    '''
+    Moves the temporary files of names over the files of a dataset. The names are
+    recorded in update.json first, so that moves that are interrupted are detected
+    by the readers and completed by finish_update.
+    '''
+    with open(temporary_path(path, UPDATE_FILE), "w") as f:
+        json.dump(names, f)
+    replace(temporary_path(path, UPDATE_FILE), join(path, UPDATE_FILE))
+    finish_update(path)
+
+
+def finish_update(path):
+    '''
+    Completes a write or update of a dataset that was interrupted while its files
+    were being moved into place, and removes the temporary files of one that was
+    interrupted before (which left the dataset as it was)
+    '''
+    marker = join(path, UPDATE_FILE)
+    if exists(marker):
+        with open(marker, "r") as f:
+            names = json.load(f)
+        for name in names:
+            if exists(join(path, name + TEMPORARY_SUFFIX)):
+                replace(join(path, name + TEMPORARY_SUFFIX), join(path, name))
+        remove(marker)
+    for name in (MATRIX_FILE, COLUMNS_FILE, INDEX_FILE, METADATA_FILE, UPDATE_FILE):
+        if exists(join(path, name + TEMPORARY_SUFFIX)):
+            remove(join(path, name + TEMPORARY_SUFFIX))
+
+
+def read_dataset_metadata(path):
+    if exists(join(path, UPDATE_FILE)):
+        raise IOError("The write of the dataset at " + path + " was interrupted; call finish_update to complete it")
+    with open(join(path, METADATA_FILE), "r") as f:
+        return json.load(f)
+
+
+def read_dataset_index(path, meta=None):
+    '''
+    Returns the sample index of a dataset
+    '''
+    meta = meta if meta is not None else read_dataset_metadata(path)
+    levels = np.load(join(path, INDEX_FILE))
+    if levels.shape[1] == 1:
+        return pd.Index(levels[:, 0].astype(object), name=meta["index_names"][0])
+    return pd.MultiIndex.from_arrays([levels[:, i].astype(object) for i in range(levels.shape[1])],
+                                     names=meta["index_names"])
+
+
+def read_dataset_columns(path):
+    return pd.Index(np.load(join(path, COLUMNS_FILE)).astype(object))
+
+
+def select_positions(index, labels):
+    '''
+    Returns the positions of labels in index. For a MultiIndex, labels can be
+    tuples or values of its first level (e.g. case ids).
+    '''
+    if labels is None:
+        return None
+    labels = list(labels)
+    if isinstance(index, pd.MultiIndex) and len(labels) > 0 and not isinstance(labels[0], tuple):
+        return np.flatnonzero(index.get_level_values(0).isin(labels))
+    positions = index.get_indexer(labels)
+    if (positions < 0).any():
+        raise KeyError("Labels not found in the dataset: " + str([l for l, p in zip(labels, positions) if p < 0]))
+    return positions
+
+
+def load_dataset(path, samples=None, features=None, mmap=True):
+    '''
+    Loads a dataset saved with save_dataset.
+    Parameters:
+        samples: optional list of sample labels to load (index tuples, or case ids
+        for a case_id / file_id index)
+        features: optional list of feature names to load
+        mmap: memory-map the matrix instead of reading it. Without selections the
+        returned DataFrame is backed by the mapped file; with selections only the
+        requested rows and columns are read.
+    Returns a tuple with the DataFrame and a dictionary of output vectors
+    '''
+    meta = read_dataset_metadata(path)
+    index = read_dataset_index(path, meta)
+    columns = read_dataset_columns(path)
+    matrix = np.load(join(path, MATRIX_FILE), mmap_mode="r" if mmap else None)
+
+    rows = select_positions(index, samples)
+    cols = select_positions(columns, features)
+    if rows is not None:
+        matrix = matrix[rows]
+        index = index[rows]
+    if cols is not None:
+        matrix = matrix[:, cols]
+        columns = columns[cols]
+    X = pd.DataFrame(matrix, index=index, columns=columns, copy=False)
+
+    full_index = read_dataset_index(path, meta) if rows is not None else index
+    outputs = {}
+    for name, y in meta["outputs"].items():
+        values = pd.Series(y["values"], index=full_index, name=name)
+        if y["dtype"] != "object":
+            values = values.astype(y["dtype"])
+        outputs[name] = values.iloc[rows] if rows is not None else values
+    return X, outputs
+
+
+def load_output_vector(path, name):
+    '''
+    Returns a single output vector of a dataset without loading the matrix
+    '''
+    meta = read_dataset_metadata(path)
+    y = meta["outputs"][name]
+    values = pd.Series(y["values"], index=read_dataset_index(path, meta), name=name)
+    return values.astype(y["dtype"]) if y["dtype"] != "object" else values
+
+
+def update_dataset(path, keep, X, outputs=None, extra=None, chunkSize=1024):
+    '''
+    Updates a dataset: the existing rows at positions keep (in ascending order) are
+    retained and the rows of X are appended after them. The new matrix, index and
+    metadata are written to temporary files, copying the retained rows in chunks of
+    chunkSize rows, and then moved over the old ones, so that the dataset is never
+    left half rewritten and matrices memory-mapped by readers keep their content.
+    The moves are recorded in update.json first: if they are interrupted, loading
+    the dataset raises IOError until finish_update completes them (which the next
+    update does).
+    Parameters:
+        keep: ascending positions of the existing rows to retain
+        X: DataFrame with the new rows, with the same columns as the dataset
+        outputs: dictionary of output vectors for every row of the updated dataset
+        extra: dictionary of additional JSON serializable information
+    Returns the index of the updated dataset
+    '''
+    finish_update(path)
+    meta = read_dataset_metadata(path)
+    old_index = read_dataset_index(path, meta)
+    columns = read_dataset_columns(path)
+    if len(X.columns) > 0 and not pd.Index(X.columns).equals(columns):
+        raise ValueError("The columns of the new rows do not match those of the dataset")
+    keep = np.asarray(keep, dtype=np.int64)
+    old = np.load(join(path, MATRIX_FILE), mmap_mode="r")
+    new_shape = (len(keep) + X.shape[0], old.shape[1])
+
+    matrix = np.lib.format.open_memmap(temporary_path(path, MATRIX_FILE), mode="w+", dtype=old.dtype, shape=new_shape)
+    for start in range(0, len(keep), chunkSize):
+        rows = keep[start:start + chunkSize]
+        if rows[-1] - rows[0] == len(rows) - 1:
+            matrix[start:start + len(rows)] = old[rows[0]:rows[-1] + 1]
+        else:
+            matrix[start:start + len(rows)] = old[rows]
+    if X.shape[0] > 0:
+        matrix[len(keep):] = X.to_numpy(dtype=old.dtype)
+    matrix.flush()
+    del matrix, old
+
+    index = old_index[keep].append(X.index) if X.shape[0] > 0 else old_index[keep]
+    with open(temporary_path(path, INDEX_FILE), "wb") as f:
+        np.save(f, index.to_frame(index=False).astype(str).to_numpy(dtype=str))
+    meta["shape"] = list(new_shape)
+    meta["outputs"] = {}
+    for name, y in (outputs or {}).items():
+        meta["outputs"][name] = encode_output_vector(y, index)
+    if extra is not None:
+        meta["extra"] = extra
+    with open(temporary_path(path, METADATA_FILE), "w") as f:
+        json.dump(meta, f)
+    replace_files(path, [MATRIX_FILE, INDEX_FILE, METADATA_FILE])
+    return index
+
+
+class OnDiskMatrix(object):
+    '''
+    Read-only view of a dataset matrix that is memory-mapped rather than loaded, for
+    matrices larger than the available memory. Rows (samples) and columns (genes) are
+    read in chunks, and per-gene statistics are computed in a single streaming pass.
+    Constructor parameters:
+        path: folder of a dataset written by save_dataset or create_matrix
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.meta = read_dataset_metadata(path)
+        self.index = read_dataset_index(path, self.meta)
+        self.columns = read_dataset_columns(path)
+        self.matrix = np.load(join(path, MATRIX_FILE), mmap_mode="r")
+        self.shape = self.matrix.shape
+
+    def getOutputVector(self, name):
+        return load_output_vector(self.path, name)
+
+    def iterSamples(self, chunkSize=256):
+        '''
+        Yields DataFrames with chunkSize consecutive rows (samples) of the matrix
+        '''
+        for start in range(0, self.shape[0], chunkSize):
+            stop = min(start + chunkSize, self.shape[0])
+            yield pd.DataFrame(np.array(self.matrix[start:stop]), index=self.index[start:stop], columns=self.columns,
+                               copy=False)
+
+    def iterGenes(self, chunkSize=1000, rowChunkSize=1024):
+        '''
+        Yields DataFrames with every row and chunkSize consecutive columns (genes) of
+        the matrix. Since the matrix is stored by rows, each chunk is gathered from
+        blocks of rowChunkSize rows; larger chunks mean fewer passes over the file.
+        '''
+        for start in range(0, self.shape[1], chunkSize):
+            stop = min(start + chunkSize, self.shape[1])
+            block = np.empty((self.shape[0], stop - start), dtype=self.matrix.dtype)
+            for row in range(0, self.shape[0], rowChunkSize):
+                block[row:row + rowChunkSize] = self.matrix[row:row + rowChunkSize, start:stop]
+            yield pd.DataFrame(block, index=self.index, columns=self.columns[start:stop], copy=False)
+
+    def geneStatistics(self, chunkSize=256):
+        '''
+        Computes the mean, sample variance and number of nonzero values of every gene
+        in one pass over the rows, merging the statistics of each chunk of rows
+        (Chan et al.) so that only one chunk is in memory at a time.
+        Returns a DataFrame indexed by gene
+        '''
+        count = 0
+        mean = np.zeros(self.shape[1])
+        m2 = np.zeros(self.shape[1])
+        nonzero = np.zeros(self.shape[1], dtype=np.int64)
+        for start in range(0, self.shape[0], chunkSize):
+            chunk = np.asarray(self.matrix[start:start + chunkSize], dtype=np.float64)
+            n = chunk.shape[0]
+            chunk_mean = chunk.mean(axis=0)
+            chunk_m2 = ((chunk - chunk_mean) ** 2).sum(axis=0)
+            delta = chunk_mean - mean
+            total = count + n
+            mean += delta * n / total
+            m2 += chunk_m2 + delta ** 2 * count * n / total
+            count = total
+            nonzero += np.count_nonzero(chunk, axis=0)
+        variance = m2 / (count - 1) if count > 1 else np.full(self.shape[1], np.nan)
+        return pd.DataFrame({"mean": mean, "variance": variance, "nonzero": nonzero}, index=self.columns)
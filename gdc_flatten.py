@@ -0,0 +1,152 @@
+from file_utils import lazy_import
+from gdc_metrics import get_logger
+
+pd = lazy_import("pandas")
+log = get_logger("flatten")
+
+
+class ColumnBuilder(object):
+    '''
+    Builds a table column by column. Values are appended to per-column lists as
+    rows are walked; columns missing from a row are padded with None.
+    '''
+
+    def __init__(self):
+        self.columns = {}
+        self.nrows = 0
+
+    def set(self, name, value):
+        column = self.columns.get(name)
+        if column is None:
+            column = self.columns[name] = []
+        if len(column) > self.nrows:
+            # the column was already set in this row
+            column[self.nrows] = value
+            return
+        if len(column) < self.nrows:
+            column.extend([None] * (self.nrows - len(column)))
+        column.append(value)
+
+    def endRow(self):
+        self.nrows += 1
+
+    def toDataFrame(self):
+        for column in self.columns.values():
+            if len(column) < self.nrows:
+                column.extend([None] * (self.nrows - len(column)))
+        return pd.DataFrame(self.columns, index=range(self.nrows))
+
+
+class HitFlattener(object):
+    '''
+    Flattens nested JSON hits (as returned by the GDC API) in a single pass.
+    Nested dictionaries become dotted columns ("demographic.race"), lists with a
+    single element are replaced by that element, and the lists (or single objects)
+    found at the paths in explode are moved to child tables with one row per element
+    (e.g. cases -> files), linked to their parent by the key column.
+    Other lists with several elements are kept as they are.
+    Constructor parameters:
+        key: column of the hits copied to every child row (e.g. "case_id")
+        explode: paths of the lists moved to child tables. Paths of nested lists
+        (e.g. "files.cases") are exploded into tables of their own as well.
+        sep: separator used for nested column names
+    '''
+
+    def __init__(self, key="case_id", explode=("files",), sep="."):
+        self.key = key
+        self.explode = tuple(explode)
+        self.sep = sep
+        self.table = ColumnBuilder()
+        self.children = {path: ColumnBuilder() for path in self.explode}
+
+    def add(self, hit):
+        '''
+        Flattens a hit into a new row of the main table
+        '''
+        self.walkFields(hit, "", "", self.table, hit.get(self.key))
+        self.table.endRow()
+
+    def addAll(self, hits):
+        for hit in hits:
+            self.add(hit)
+        return self
+
+    def join(self, prefix, name):
+        return name if prefix == "" else prefix + self.sep + name
+
+    def walk(self, value, name, path, builder, keyValue):
+        '''
+        Writes value into the current row of builder. name is the column name
+        relative to the table being built and path the position of the value from
+        the root of the hit, which is matched against the explode paths.
+        '''
+        if isinstance(value, list) and len(value) == 1:
+            value = value[0]
+        if path in self.children:
+            child = self.children[path]
+            for element in (value if isinstance(value, list) else [value]):
+                if element is None:
+                    continue
+                child.set(self.key, keyValue)
+                if isinstance(element, dict):
+                    self.walkFields(element, "", path, child, keyValue)
+                else:
+                    child.set(path.split(self.sep)[-1], element)
+                child.endRow()
+        elif isinstance(value, dict):
+            self.walkFields(value, name, path, builder, keyValue)
+        else:
+            builder.set(name, value)
+
+    def walkFields(self, record, name, path, builder, keyValue):
+        for k, v in record.items():
+            self.walk(v, self.join(name, k), self.join(path, k), builder, keyValue)
+
+    def getTable(self):
+        return self.table.toDataFrame()
+
+    def getChild(self, path):
+        return self.children[path].toDataFrame()
+
+
+def flatten_hits(hits, key="case_id", explode=("files",), sep="."):
+    '''
+    Flattens an iterable of nested hits (see HitFlattener).
+    Returns a tuple with the main table and a dictionary mapping each explode path to
+    its child table
+    '''
+    flattener = HitFlattener(key, explode, sep).addAll(hits)
+    return flattener.getTable(), {path: flattener.getChild(path) for path in flattener.explode}
+
+
+def frame_memory(frame):
+    '''
+    Returns the memory used by a DataFrame, in bytes, including the Python objects it
+    references
+    '''
+    return int(frame.memory_usage(deep=True).sum())
+
+
+def compact_frame(frame, maxUniqueRatio=0.5, verbose=False):
+    '''
+    Returns a copy of a flattened table with compact column types: string columns
+    with few distinct values (at most maxUniqueRatio of the rows, e.g. data_type,
+    project_id or vital_status) become categoricals and integer columns are
+    downcast to the smallest integer type that holds them. Columns with lists or
+    mixed values and float columns are kept as they are.
+    '''
+    columns = {}
+    for name in frame.columns:
+        column = frame[name]
+        if pd.api.types.is_integer_dtype(column.dtype) and not isinstance(column.dtype, pd.CategoricalDtype):
+            column = pd.to_numeric(column, downcast="integer")
+        elif pd.api.types.is_object_dtype(column.dtype) or pd.api.types.is_string_dtype(column.dtype):
+            if pd.api.types.infer_dtype(column, skipna=True) == "string" and \
+                    column.nunique() <= maxUniqueRatio * len(column):
+                column = column.astype("category")
+        columns[name] = column
+    compact = pd.DataFrame(columns, index=frame.index)
+    if verbose:
+        log.info("Compacted table with %d columns: %.1f MB -> %.1f MB", frame.shape[1],
+                 frame_memory(frame) / 1048576.0, frame_memory(compact) / 1048576.0)
+    return compact
@@ -0,0 +1,110 @@
+import os
+from os.path import exists
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from file_utils import md5
+
+
+class Md5Manifest(object):
+    '''
+    Sidecar index of verified checksums for the files in a folder. For every file it
+    records the GDC file_id, the size and modification time of the file when it was
+    hashed, and its md5 checksum, so files that have not changed since can be
+    validated with a stat call instead of being read again.
+    Constructor parameters:
+        folder: folder holding the files (used as a prefix, like writeFolder)
+        force: ignore the recorded checksums and hash every file again
+    '''
+    FILENAME = ".gdc_manifest.tsv"
+    COLUMNS = ("file_name", "file_id", "size", "mtime_ns", "md5")
+
+    def __init__(self, folder="", force=False):
+        self.folder = folder
+        self.force = force
+        self.path = folder + Md5Manifest.FILENAME
+        self.entries = {}
+        self.modified = False
+        self.__lock = Lock()
+        if exists(self.path):
+            self.load()
+
+    def load(self):
+        with open(self.path, "r") as f:
+            for line in f.read().split("\n")[1:]:
+                fields = line.split("\t")
+                if len(fields) == len(Md5Manifest.COLUMNS):
+                    self.entries[fields[0]] = (fields[1], int(fields[2]), int(fields[3]), fields[4])
+
+    def save(self):
+        '''
+        Writes the manifest to disk if any entry changed since it was loaded
+        '''
+        with self.__lock:
+            if not self.modified:
+                return
+            lines = ["\t".join(Md5Manifest.COLUMNS)]
+            lines += ["\t".join([name] + [str(v) for v in entry]) for name, entry in sorted(self.entries.items())]
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(tmp, self.path)
+            self.modified = False
+
+    def record(self, file_name, file_id, md5sum):
+        '''
+        Stores the checksum of a file that was just written or verified
+        '''
+        stat = os.stat(self.folder + file_name)
+        with self.__lock:
+            self.entries[file_name] = (str(file_id), stat.st_size, stat.st_mtime_ns, md5sum)
+            self.modified = True
+
+    def lookup(self, file_name):
+        '''
+        Returns the recorded checksum of a file if it is still valid (same size and
+        modification time), or None
+        '''
+        if self.force:
+            return None
+        entry = self.entries.get(file_name)
+        if entry is None:
+            return None
+        try:
+            stat = os.stat(self.folder + file_name)
+        except OSError:
+            return None
+        if stat.st_size == entry[1] and stat.st_mtime_ns == entry[2]:
+            return entry[3]
+        return None
+
+    def checksum(self, file_name, file_id=None):
+        '''
+        Returns the md5 checksum of a file, hashing it only if it changed since the
+        last time it was recorded
+        '''
+        chksm = self.lookup(file_name)
+        if chksm is None:
+            chksm = md5(self.folder + file_name)
+            self.record(file_name, file_id, chksm)
+        return chksm
+
+    def verify(self, file_name, md5sum, file_id=None):
+        '''
+        Returns True if the file exists and its checksum matches md5sum
+        '''
+        return exists(self.folder + file_name) and self.checksum(file_name, file_id) == md5sum
+
+    def verifyAll(self, records, workers=4):
+        '''
+        Verifies many files, hashing those without a valid recorded checksum in
+        parallel threads.
+        Parameters:
+            records: iterable of (file_id, file_name, md5sum) tuples
+            workers: number of files hashed concurrently
+        Returns a dictionary mapping each file_name to True if it is valid
+        '''
+        records = list(records)
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            valid = list(executor.map(lambda r: self.verify(r[1], r[2], r[0]), records))
+        self.save()
+        return {r[1]: v for r, v in zip(records, valid)}
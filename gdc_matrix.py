@@ -0,0 +1,286 @@
+import hashlib
+import multiprocessing
+import os
+from threading import Lock, Condition
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from file_utils import read_bytes, lazy_import
+from gdc_metrics import get_logger, get_metrics
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+log = get_logger("matrix")
+metrics = get_metrics()
+
+
+def process_context():
+    '''
+    Returns the multiprocessing context of the parse pools. Pools may be started from
+    a thread (e.g. by a download callback), and a process forked while other threads
+    hold locks can deadlock, so workers are forked from a forkserver where available,
+    with the parsing modules preloaded. As with spawn, scripts that parse files in
+    parallel must guard their entry point with if __name__ == "__main__".
+    '''
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context()
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(["numpy", "gdc_parsers"])
+    return context
+
+
+def tokenize_feature_file(path, dtype="float64", positions=None):
+    '''
+    Reads a headerless, tab separated file with a feature identifier column followed
+    by a value column (e.g. HTSeq FPKM/count files). Compressed files are handled
+    according to their extension.
+    If positions is given, only the values of the features at those positions are
+    converted and returned.
+    Returns a tuple with the identifiers (list of bytes) and the values
+    '''
+    tokens = read_bytes(path).split()
+    try:
+        if len(tokens) % 2 != 0:
+            raise ValueError("Unexpected number of fields")
+        values = tokens[1::2]
+        if positions is not None:
+            values = [values[i] for i in positions]
+        return tokens[0::2], np.array(values).astype(dtype)
+    except ValueError:
+        # missing values, extra columns or identifiers with spaces
+        df = pd.read_csv(path, sep="\t", header=None, usecols=[0, 1], dtype={0: str, 1: dtype},
+                         compression="infer")
+        values = df[1].to_numpy(dtype=dtype)
+        return [i.encode("utf-8") for i in df[0]], values[positions] if positions is not None else values
+
+
+def read_feature_file(path, dtype="float64"):
+    '''
+    Reads a feature file (see tokenize_feature_file).
+    Returns a tuple with the identifiers (array of str) and the values
+    '''
+    ids, values = tokenize_feature_file(path, dtype)
+    return np.array([i.decode("utf-8") for i in ids], dtype=object), values
+
+
+def feature_digest(ids):
+    '''
+    Returns a digest of a list of identifiers (as bytes), used to compare the
+    identifier columns of different files without sending them between processes
+    '''
+    return hashlib.md5(b"\n".join(ids)).hexdigest()
+
+
+def parse_feature_values(path, dtype="float64", verify=True, positions=None, parser=None):
+    '''
+    Reads the values of a feature file (at positions, if given), its number of
+    features and the digest of its identifier column if verify is True. Runs in the
+    worker processes of build_matrix.
+    '''
+    ids, values = (parser or tokenize_feature_file)(path, dtype, positions)
+    return values, len(ids), feature_digest(ids) if verify else None
+
+
+class FeatureMismatchError(ValueError):
+    pass
+
+
+def feature_positions(ids, features, key=None):
+    '''
+    Returns the positions of features in ids, in the order of features. Features
+    not found are left out (with a message). key is applied to every identifier
+    before matching (e.g. to remove version suffixes from Ensembl ids). If several
+    identifiers have the same key (e.g. ENSG00000002586.20 and its _PAR_Y copy in
+    STAR files), the first one is used.
+    '''
+    keys = pd.Index([key(i) for i in ids] if key is not None else ids)
+    first = ~keys.duplicated()
+    if not first.all():
+        log.info("%d identifiers repeat the key of a previous one and are not matched", (~first).sum())
+    unique = np.flatnonzero(first)
+    found = keys[unique].get_indexer(pd.Index(features))
+    found = np.where(found >= 0, unique[found], -1)
+    if (found < 0).any():
+        log.info("%d of %d requested features were not found", (found < 0).sum(), len(found))
+    return found[found >= 0]
+
+
+def build_matrix(paths, dtype="float64", workers=None, verify=True, features=None, key=None, allocate=None,
+                 parser=None):
+    '''
+    Assembles a sample x feature matrix from feature files sharing the same identifier
+    column, in the same order. The identifiers are read once from the first file and
+    the values of every file are written directly into a preallocated array, one row
+    per file.
+    Parameters:
+        paths: list of file paths, in the order of the rows of the matrix
+        dtype: NumPy type of the matrix (np.float32 halves its memory use)
+        workers: number of processes used to parse files (None uses every CPU, 1
+        parses in the calling process)
+        verify: check that every file has the same identifiers as the first one.
+        If False, only the number of values is checked.
+        features: optional list of identifiers of the features to keep, in the order
+        of the columns of the matrix. Only their values are converted.
+        key: function applied to the identifiers of the files before they are matched
+        with features
+        allocate: function called with the shape and dtype of the matrix that returns
+        the array to fill (np.empty by default), e.g. a memory-mapped array created
+        with gdc_dataset.create_matrix for matrices that do not fit in memory
+        parser: function reading a file, called like tokenize_feature_file (the
+        default). It must be picklable to be used with several workers (see
+        gdc_parsers for the parsers of other file formats).
+    Returns a tuple with the feature identifiers and the matrix
+    '''
+    if len(paths) == 0:
+        return np.array([], dtype=str), np.empty((0, 0), dtype=dtype)
+    with metrics.timer("parse"):
+        ids, matrix = _build_matrix(paths, dtype, workers, verify, features, key, allocate, parser or
+                                    tokenize_feature_file)
+    metrics.count("files_parsed", len(paths))
+    return ids, matrix
+
+
+def _build_matrix(paths, dtype, workers, verify, features, key, allocate, parser):
+    tokens, values = parser(paths[0], dtype)
+    ids = np.array([i.decode("utf-8") for i in tokens], dtype=object)
+    positions = feature_positions(ids, features, key) if features is not None else None
+    if positions is not None:
+        ids, values = ids[positions], values[positions]
+    matrix = (allocate or np.empty)((len(paths), len(ids)), dtype=dtype)
+    matrix[0] = values
+    digest = feature_digest(tokens) if verify else None
+
+    def store(i, result):
+        values, nfeatures, file_digest = result
+        if nfeatures != len(tokens) or file_digest != digest:
+            raise FeatureMismatchError("Features of " + str(paths[i]) + " do not match those of " + str(paths[0]))
+        matrix[i] = values
+
+    rest = paths[1:]
+    if workers == 1:
+        for i, path in enumerate(rest, 1):
+            store(i, parse_feature_values(path, dtype, verify, positions, parser))
+    else:
+        workers = workers if workers is not None else os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers, mp_context=process_context()) as executor:
+            chunksize = max(1, len(rest) // (4 * workers))
+            results = executor.map(parse_feature_values, rest, [dtype] * len(rest), [verify] * len(rest),
+                                   [positions] * len(rest), [parser] * len(rest), chunksize=chunksize)
+            for i, result in enumerate(results, 1):
+                store(i, result)
+    return ids, matrix
+
+
+class MatrixBuilder(object):
+    '''
+    Assembles a sample x feature matrix from files that become available one at a
+    time (e.g. as they are downloaded). Each file handed to add is parsed right away
+    by a worker and its values are written into its row of a preallocated array, so
+    parsing overlaps with the arrival of the remaining files. The first file added
+    is parsed in the calling thread and sets the identifiers and width of the matrix.
+    Constructor parameters:
+        nrows: number of rows (files) of the matrix
+        dtype: NumPy type of the matrix
+        workers: number of processes used to parse files (None uses every CPU, 1
+        parses in a single background thread)
+        verify: check that every file has the same identifiers as the first one
+        features, key, allocate, parser: features to keep, function applied to the
+        identifiers before matching them, function allocating the matrix and file
+        parser (see build_matrix)
+    '''
+
+    def __init__(self, nrows, dtype="float64", workers=None, verify=True, features=None, key=None, allocate=None,
+                 parser=None):
+        self.nrows = nrows
+        self.dtype = dtype
+        self.verify = verify
+        self.features = features
+        self.key = key
+        self.allocate = allocate or np.empty
+        self.parser = parser or tokenize_feature_file
+        self.positions = None
+        self.ids = None
+        self.matrix = None
+        self.filled = np.zeros(nrows, dtype=bool)
+        self.errors = {}
+        self.pending = 0
+        self.__reference = None
+        self.__digest = None
+        self.__nfeatures = None
+        self.__lock = Lock()
+        self.__done = Condition()
+        if workers == 1:
+            self.__executor = ThreadPoolExecutor(max_workers=1)
+        else:
+            self.__executor = ProcessPoolExecutor(max_workers=workers if workers is not None else os.cpu_count() or 1,
+                                                  mp_context=process_context())
+
+    def add(self, i, path):
+        '''
+        Parses the file at path into row i
+        '''
+        with self.__lock:
+            if self.matrix is None:
+                try:
+                    with metrics.timer("parse"):
+                        tokens, values = self.parser(path, self.dtype)
+                    metrics.count("files_parsed")
+                except Exception as e:
+                    self.errors[i] = e
+                    return
+                self.ids = np.array([t.decode("utf-8") for t in tokens], dtype=object)
+                if self.features is not None:
+                    self.positions = feature_positions(self.ids, self.features, self.key)
+                    self.ids, values = self.ids[self.positions], values[self.positions]
+                self.matrix = self.allocate((self.nrows, len(self.ids)), dtype=self.dtype)
+                self.__nfeatures = len(tokens)
+                self.__reference = path
+                self.__digest = feature_digest(tokens) if self.verify else None
+                self.matrix[i] = values
+                self.filled[i] = True
+                return
+        with self.__done:
+            self.pending += 1
+        future = self.__executor.submit(parse_feature_values, path, self.dtype, self.verify, self.positions,
+                                        self.parser)
+        future.add_done_callback(lambda f: self.store(i, path, f))
+
+    def store(self, i, path, future):
+        try:
+            values, nfeatures, file_digest = future.result()
+            if nfeatures != self.__nfeatures or file_digest != self.__digest:
+                raise FeatureMismatchError("Features of " + str(path) + " do not match those of " +
+                                           str(self.__reference))
+            self.matrix[i] = values
+            self.filled[i] = True
+            metrics.count("files_parsed")
+        except Exception as e:
+            self.errors[i] = e
+        finally:
+            with self.__done:
+                self.pending -= 1
+                self.__done.notify_all()
+
+    def fail(self, i, error):
+        '''
+        Records that the file of row i could not be obtained
+        '''
+        self.errors[i] = error
+
+    def finish(self):
+        '''
+        Waits for the pending files to be parsed.
+        Returns a tuple with the feature identifiers and the matrix. Raises the first
+        error found if a row could not be filled.
+        '''
+        # time spent waiting for files still being parsed once every file was added
+        with metrics.timer("parse_wait"), self.__done:
+            self.__done.wait_for(lambda: self.pending == 0)
+        self.__executor.shutdown(wait=True)
+        if self.errors:
+            i = min(self.errors)
+            error = self.errors[i]
+            raise error if isinstance(error, Exception) else IOError("Row " + str(i) + ": " + str(error))
+        if not self.filled.all():
+            raise IOError("No file was added for rows " + str(np.flatnonzero(~self.filled).tolist()))
+        if self.matrix is None:
+            return np.array([], dtype=str), np.empty((0, 0), dtype=self.dtype)
+        return self.ids, self.matrix
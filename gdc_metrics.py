@@ -0,0 +1,177 @@
+import logging
+import sys
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+
+LOGGER_NAME = "gdc"
+
+
+def get_logger(name):
+    '''
+    Returns the logger of a module of the package (a child of the "gdc" logger)
+    '''
+    return logging.getLogger(LOGGER_NAME + "." + name)
+
+
+def enable_logging(level=logging.INFO, stream=None, fmt="%(message)s"):
+    '''
+    Prints the messages of the package (progress, retries, summaries) of at least
+    level to stream (stderr by default). Without it, only warnings are shown.
+    '''
+    logger = logging.getLogger(LOGGER_NAME)
+    handler = logging.StreamHandler(stream if stream is not None else sys.stderr)
+    handler.setFormatter(logging.Formatter(fmt))
+    logger.handlers = [handler]
+    logger.setLevel(level)
+    logger.propagate = False
+    return logger
+
+
+class Metrics(object):
+    '''
+    Thread-safe collection of per-stage timers and counters.
+    Stages (e.g. "fetch", "flatten", "download", "md5", "parse") accumulate their
+    duration and number of calls, summed over the threads that run them (so 4
+    threads downloading for 1s add 4s to "download"); stages timed with span
+    accumulate wall time instead. Counters accumulate values such as bytes
+    downloaded, requests sent or cache hits. Hooks added with addHook are called
+    with (event, name, value) for every update: event is "start" (value None) and
+    "stop" (value is the duration) for stages, and "count" for counters.
+    '''
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.times = {}
+        self.calls = {}
+        self.counters = {}
+        self.hooks = []
+        self.__active = {}
+        self.__spanStart = {}
+
+    def addHook(self, hook):
+        self.hooks.append(hook)
+
+    def removeHook(self, hook):
+        self.hooks.remove(hook)
+
+    def notify(self, event, name, value):
+        for hook in self.hooks:
+            hook(event, name, value)
+
+    def addTime(self, stage, elapsed, calls=1):
+        with self.__lock:
+            self.times[stage] = self.times.get(stage, 0.0) + elapsed
+            self.calls[stage] = self.calls.get(stage, 0) + calls
+        if self.hooks:
+            self.notify("stop", stage, elapsed)
+
+    @contextmanager
+    def timer(self, stage):
+        '''
+        Context manager adding the time spent in its block to stage
+        '''
+        if self.hooks:
+            self.notify("start", stage, None)
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.addTime(stage, perf_counter() - start)
+
+    @contextmanager
+    def span(self, stage):
+        '''
+        Context manager adding to stage the wall time during which at least one of
+        its blocks is running: blocks that overlap, in different threads, are only
+        counted once
+        '''
+        with self.__lock:
+            active = self.__active.get(stage, 0)
+            if active == 0:
+                self.__spanStart[stage] = perf_counter()
+            self.__active[stage] = active + 1
+        try:
+            yield
+        finally:
+            elapsed = None
+            with self.__lock:
+                self.__active[stage] -= 1
+                if self.__active[stage] == 0:
+                    elapsed = perf_counter() - self.__spanStart.pop(stage)
+            if elapsed is not None:
+                self.addTime(stage, elapsed)
+
+    def count(self, name, value=1):
+        with self.__lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        if self.hooks:
+            self.notify("count", name, value)
+
+    def timedIterator(self, iterable, stage):
+        '''
+        Yields the elements of iterable, adding the time spent producing them (e.g.
+        waiting for pages of results) to stage
+        '''
+        iterator = iter(iterable)
+        while True:
+            start = perf_counter()
+            try:
+                element = next(iterator)
+            except StopIteration:
+                self.addTime(stage, perf_counter() - start)
+                return
+            self.addTime(stage, perf_counter() - start, calls=0)
+            yield element
+
+    def snapshot(self):
+        '''
+        Returns a copy of the timers and counters
+        '''
+        with self.__lock:
+            return {"times": dict(self.times), "calls": dict(self.calls), "counters": dict(self.counters)}
+
+    def since(self, snapshot):
+        '''
+        Returns the timers and counters accumulated since snapshot was taken
+        '''
+        current = self.snapshot()
+        return {group: {k: v - snapshot[group].get(k, 0) for k, v in values.items()
+                        if v != snapshot[group].get(k, 0)}
+                for group, values in current.items()}
+
+    def reset(self):
+        with self.__lock:
+            self.times, self.calls, self.counters = {}, {}, {}
+
+    def report(self, since=None):
+        '''
+        Returns a summary of the stages and counters (accumulated since the snapshot
+        since, if given), with the download throughput and cache hit rate. The
+        throughput is computed over the wall time of the downloads (download_wall),
+        not over the per-file download times summed over the worker threads.
+        '''
+        data = self.since(since) if since is not None else self.snapshot()
+        times, calls, counters = data["times"], data["calls"], data["counters"]
+        lines = ["stage".ljust(12) + "time (s)".rjust(10) + "calls".rjust(8)]
+        for stage in sorted(times, key=times.get, reverse=True):
+            lines.append(stage.ljust(12) + "{:.2f}".format(times[stage]).rjust(10) + str(calls.get(stage, 0)).rjust(8))
+        for name in sorted(counters):
+            lines.append(name + ": " + str(counters[name]))
+        elapsed = times.get("download_wall") or times.get("download")
+        if counters.get("bytes_downloaded") and elapsed:
+            lines.append("download throughput: {:.2f} MB/s".format(counters["bytes_downloaded"] / 1048576.0 / elapsed))
+        lookups = counters.get("cache_hits", 0) + counters.get("cache_misses", 0)
+        if lookups:
+            lines.append("cache hit rate: {:.1%}".format(counters.get("cache_hits", 0) / float(lookups)))
+        return "\n".join(lines)
+
+
+METRICS = Metrics()
+
+
+def get_metrics():
+    '''
+    Returns the Metrics instance updated by every module of the package
+    '''
+    return METRICS
@@ -0,0 +1,149 @@
+import gzip
+import os
+from concurrent.futures import ProcessPoolExecutor
+from file_utils import getExtension, lazy_import
+from gdc_matrix import tokenize_feature_file, process_context
+from gdc_metrics import get_metrics
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+
+def count_comment_lines(path, prefix=b"#"):
+    '''
+    Returns the number of lines at the start of a file that begin with prefix
+    (e.g. the "#version 2.4" line of MAF files)
+    '''
+    opener = gzip.open if getExtension(path) == "gz" else open
+    count = 0
+    with opener(path, "rb") as f:
+        for line in f:
+            if not line.startswith(prefix):
+                break
+            count += 1
+    return count
+
+
+class HTSeqParser(object):
+    '''
+    Headerless two column files of the HTSeq workflows (gene id, value)
+    '''
+    kind = "matrix"
+
+    def __call__(self, path, dtype="float64", positions=None):
+        return tokenize_feature_file(path, dtype, positions)
+
+
+class ColumnParser(object):
+    '''
+    Tab separated files with a header, with one row per feature. The identifiers are
+    read from idColumn and the values from valueColumn. Rows whose identifier starts
+    with one of skipPrefixes (e.g. the N_unmapped/N_ambiguous counters of STAR files)
+    are left out.
+    '''
+    kind = "matrix"
+
+    def __init__(self, idColumn, valueColumn, skipPrefixes=()):
+        self.idColumn = idColumn
+        self.valueColumn = valueColumn
+        self.skipPrefixes = tuple(skipPrefixes)
+
+    def __call__(self, path, dtype="float64", positions=None):
+        df = pd.read_csv(path, sep="\t", usecols=[self.idColumn, self.valueColumn],
+                         dtype={self.idColumn: str, self.valueColumn: dtype}, skiprows=count_comment_lines(path),
+                         compression="infer")
+        ids = df[self.idColumn]
+        if self.skipPrefixes:
+            keep = ~ids.str.startswith(self.skipPrefixes).to_numpy()
+            df, ids = df[keep], ids[keep]
+        values = df[self.valueColumn].to_numpy(dtype=dtype)
+        return [i.encode("utf-8") for i in ids], values[positions] if positions is not None else values
+
+
+class TableParser(object):
+    '''
+    Tab separated files with a header and any number of rows per file (e.g. copy
+    number segments or mutations), read into a long-format DataFrame.
+    Only the columns in columns are read (every column if None), with the types in
+    dtypes.
+    '''
+    kind = "table"
+
+    def __init__(self, columns=None, dtypes=None):
+        self.columns = columns
+        self.dtypes = dtypes
+
+    def __call__(self, path):
+        usecols = (lambda c: c in self.columns) if self.columns is not None else None
+        return pd.read_csv(path, sep="\t", usecols=usecols, dtype=self.dtypes, skiprows=count_comment_lines(path),
+                           compression="infer", low_memory=False)
+
+
+SEGMENT_COLUMNS = ["GDC_Aliquot", "Chromosome", "Start", "End", "Num_Probes", "Segment_Mean"]
+MAF_COLUMNS = ["Hugo_Symbol", "Entrez_Gene_Id", "Chromosome", "Start_Position", "End_Position", "Strand",
+               "Variant_Classification", "Variant_Type", "Reference_Allele", "Tumor_Seq_Allele1",
+               "Tumor_Seq_Allele2", "Tumor_Sample_Barcode", "HGVSp_Short", "t_depth", "t_ref_count", "t_alt_count",
+               "IMPACT"]
+
+SEGMENT_PARSER = TableParser(SEGMENT_COLUMNS, {"Chromosome": str})
+
+PARSERS = {
+    ("Gene Expression Quantification", "HTSeq - FPKM"): HTSeqParser(),
+    ("Gene Expression Quantification", "HTSeq - FPKM-UQ"): HTSeqParser(),
+    ("Gene Expression Quantification", "HTSeq - Counts"): HTSeqParser(),
+    ("Gene Expression Quantification", None): HTSeqParser(),
+    ("Gene Expression Quantification", "STAR - Counts"): ColumnParser("gene_id", "unstranded", ("N_",)),
+    ("miRNA Expression Quantification", None): ColumnParser("miRNA_ID", "reads_per_million_miRNA_mapped"),
+    ("Copy Number Segment", None): SEGMENT_PARSER,
+    ("Masked Copy Number Segment", None): SEGMENT_PARSER,
+    ("Masked Somatic Mutation", None): TableParser(MAF_COLUMNS, {"Chromosome": str, "Entrez_Gene_Id": str}),
+}
+
+
+def register_parser(parser, data_type, workflow=None):
+    '''
+    Registers the parser of the files of a data_type (and workflow, or any workflow
+    if None). Matrix parsers are called like gdc_matrix.tokenize_feature_file; table
+    parsers with the path of a file, returning a DataFrame. Parsers must be
+    picklable (e.g. instances of module level classes) to run in worker processes.
+    '''
+    PARSERS[(data_type, workflow)] = parser
+
+
+def get_parser(data_type, workflow=None):
+    '''
+    Returns the parser registered for a data_type and workflow
+    '''
+    if (data_type, workflow) in PARSERS:
+        return PARSERS[(data_type, workflow)]
+    if (data_type, None) in PARSERS:
+        return PARSERS[(data_type, None)]
+    raise KeyError("No parser registered for " + str(data_type) + " files of workflow " + str(workflow))
+
+
+def build_table(paths, parser, labels=None, labelColumn="file_id", workers=None):
+    '''
+    Reads files with a table parser, in parallel, into a single long-format DataFrame.
+    Parameters:
+        paths: list of file paths
+        parser: table parser (see TableParser)
+        labels: optional list with a label for each file (e.g. its file_id), stored
+        in labelColumn
+        workers: number of processes used to parse files (None uses every CPU, 1
+        parses in the calling process)
+    '''
+    metrics = get_metrics()
+    with metrics.timer("parse"):
+        if workers == 1:
+            tables = [parser(path) for path in paths]
+        else:
+            workers = workers if workers is not None else os.cpu_count() or 1
+            with ProcessPoolExecutor(max_workers=workers, mp_context=process_context()) as executor:
+                tables = list(executor.map(parser, paths, chunksize=max(1, len(paths) // (4 * workers))))
+    metrics.count("files_parsed", len(paths))
+    if labels is not None:
+        for table, label in zip(tables, labels):
+            table.insert(0, labelColumn, label)
+    if len(tables) == 0:
+        return pd.DataFrame(columns=([labelColumn] if labels is not None else []))
+    return pd.concat(tables, ignore_index=True)
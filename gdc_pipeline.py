@@ -0,0 +1,249 @@
+import json
+import os
+from os.path import exists
+from threading import Lock, BoundedSemaphore
+from time import time
+from concurrent.futures import ThreadPoolExecutor
+from file_utils import lazy_import
+from gdc_rest import singleProjectSearchOperation, check_downloads, BASE_URL
+from gdc_data_processing import GDCCaseMetadataHandler, GeneExpressionQuantification
+from gdc_dataset import save_dataset, METADATA_FILE
+from gdc_metrics import get_logger
+
+pd = lazy_import("pandas")
+
+CASE_FIELDS = ["annotations",
+               "demographic",
+               "diagnoses",
+               "diagnoses.treatments",
+               "exposures",
+               "family_histories",
+               "files",
+               "files.analysis",
+               "files.cases.samples",
+               "summary",
+               "tissue_source_site"]
+
+OUTPUTS = ["cases.samples.sample_type",
+           "demographic.ethnicity",
+           "demographic.race",
+           "demographic.year_of_birth",
+           "demographic.year_of_death",
+           "diagnoses.age_at_diagnosis",
+           "diagnoses.tumor_stage",
+           "diagnoses.vital_status",
+           "exposures.bmi"]
+
+log = get_logger("pipeline")
+
+
+class ProjectPipeline(object):
+    '''
+    Builds gene expression datasets for several GDC projects, running the stages of
+    each project as a chain (metadata -> download -> build -> write) while stages of
+    different projects overlap: the metadata of a project is fetched while the files
+    of another are downloaded, and files are parsed while the next project
+    downloads. Each stage has its own thread pool and a global semaphore bounds the
+    number of stages running at the same time.
+
+    Progress is saved to <parentFolder>pipeline_state.json after every stage, and
+    a run resumes from it: projects whose dataset was written are skipped, the
+    metadata of a project is read back from its metadata.csv and GEQ_filedata.csv
+    instead of being requested again, and its download stage is skipped if every
+    file is on disk (downloads are otherwise resumed from the files and partial
+    files already there). The matrix is not saved between runs, so an
+    interrupted build is redone. A project fails if any of its files cannot be
+    downloaded or fails its MD5 check.
+
+    Constructor parameters:
+        parentFolder: folder where each project gets a <projectId>/ subfolder
+        stageWorkers: dictionary with the number of threads of each stage
+        maxConcurrency: maximum number of stages running at once, over all projects
+        downloadWorkers: threads used to download the files of a project
+        parseWorkers: processes used to parse the files of a project
+        casefields, dataParams, outputs: case fields to expand, file filters and
+        output vectors (defaults as in tests/data_download_example.py)
+        cache: gdc_cache.ResponseCache for the metadata requests
+        baseUrl, session: passed to the metadata handlers (see GDCCaseMetadataHandler)
+    '''
+    STAGES = ("metadata", "download", "build", "write")
+    STATE_FILE = "pipeline_state.json"
+
+    def __init__(self, parentFolder, stageWorkers=None, maxConcurrency=4, downloadWorkers=4, parseWorkers=None,
+                 casefields=CASE_FIELDS, dataParams=None, outputs=OUTPUTS, cache=None, verbose=True, baseUrl=BASE_URL,
+                 session=None):
+        self.parentFolder = parentFolder
+        self.stageWorkers = {"metadata": 2, "download": 2, "build": 1, "write": 1}
+        self.stageWorkers.update(stageWorkers or {})
+        self.downloadWorkers = downloadWorkers
+        self.parseWorkers = parseWorkers
+        self.casefields = casefields
+        self.dataParams = dataParams if dataParams is not None else {"analysis.workflow_type": "HTSeq - FPKM"}
+        self.outputs = outputs
+        self.cache = cache
+        self.verbose = verbose
+        self.baseUrl = baseUrl
+        self.session = session
+        self.statePath = parentFolder + ProjectPipeline.STATE_FILE
+        self.state = self.loadState()
+        self.__semaphore = BoundedSemaphore(maxConcurrency)
+        self.__lock = Lock()
+
+    def loadState(self):
+        if exists(self.statePath):
+            with open(self.statePath, "r") as f:
+                return json.load(f)
+        return {}
+
+    def saveState(self):
+        with self.__lock:
+            tmp = self.statePath + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.state, f, indent=1)
+            os.replace(tmp, self.statePath)
+
+    def projectFolder(self, projectId):
+        return self.parentFolder + projectId + "/"
+
+    def datasetPath(self, projectId):
+        return self.projectFolder(projectId) + "GEQ/Datasets/geq_data"
+
+    def isDone(self, projectId, stage):
+        return stage in self.state.get(projectId, {}).get("completed", [])
+
+    def isComplete(self, projectId):
+        return self.isDone(projectId, "write") and exists(self.datasetPath(projectId) + "/" + METADATA_FILE)
+
+    # Stages: each one receives the project id and the result of the previous stage
+
+    def metadata(self, projectId, previous=None):
+        folder = self.projectFolder(projectId)
+        if not exists(folder):
+            os.makedirs(folder)
+        casefilt = singleProjectSearchOperation(projectId=projectId, dataCategory="Transcriptome Profiling")
+        tables = None
+        if self.isDone(projectId, "metadata") and exists(folder + "metadata.csv") and \
+                exists(folder + "GEQ_filedata.csv"):
+            log.info("[%s] reading the metadata saved by a previous run", projectId)
+            files = pd.read_csv(folder + "GEQ_filedata.csv", index_col=0)
+            metadata = pd.read_csv(folder + "metadata.csv", index_col=0)
+            cases = metadata[["case_id"] + [c for c in metadata.columns if c not in files.columns]]
+            tables = (cases.drop_duplicates("case_id").reset_index(drop=True), {"files": files})
+        mh = GDCCaseMetadataHandler(filter=casefilt, expand=self.casefields, cache=self.cache, baseUrl=self.baseUrl,
+                                    session=self.session, tables=tables)
+        fh = GeneExpressionQuantification(mh, "case_id", filterparams=self.dataParams)
+        if tables is None:
+            fh.getMetadata().to_csv(folder + "metadata.csv")
+            fh.getFileData().to_csv(folder + "GEQ_filedata.csv")
+        return fh
+
+    def download(self, projectId, fh):
+        folder = self.projectFolder(projectId) + "GEQ/"
+        if self.isDone(projectId, "download") and all(exists(folder + f) for f in fh.getFileData()["file_name"]):
+            log.info("[%s] every file was downloaded by a previous run", projectId)
+            return fh
+        if not exists(folder):
+            os.makedirs(folder)
+        # raises a DownloadError if any file could not be downloaded or failed its MD5 check
+        check_downloads(fh.confirmLocalStorage(folder, workers=self.downloadWorkers))
+        return fh
+
+    def build(self, projectId, fh):
+        X = fh.getDataMatrix(self.projectFolder(projectId) + "GEQ/", parseWorkers=self.parseWorkers, download=False)
+        return fh, X
+
+    def write(self, projectId, previous):
+        fh, X = previous
+        Dy = {output: fh.getOutputVector(output) for output in self.outputs}
+        save_dataset(self.datasetPath(projectId), X, Dy)
+        return None
+
+    def runStage(self, stage, projectId, previous):
+        '''
+        Runs a stage of a project, recording its duration and completion
+        '''
+        with self.__semaphore:
+            start = time()
+            if self.verbose:
+                log.info("[%s] %s started", projectId, stage)
+            result = getattr(self, stage)(projectId, previous)
+            elapsed = time() - start
+        with self.__lock:
+            entry = self.state.setdefault(projectId, {"completed": [], "timings": {}})
+            if stage not in entry["completed"]:
+                entry["completed"].append(stage)
+            entry["timings"][stage] = elapsed
+            entry.pop("error", None)
+        self.saveState()
+        if self.verbose:
+            log.info("[%s] %s finished in %.1fs", projectId, stage, elapsed)
+        return result
+
+    def run(self, projectIds, force=False):
+        '''
+        Runs the pipeline for a list of project ids, resuming the projects of previous
+        runs (every stage is run again if force is True). Returns a dictionary
+        mapping each project id to "done", "skipped" or the error that stopped it.
+        '''
+        outcome = {}
+        todo = []
+        for projectId in projectIds:
+            if self.isComplete(projectId) and not force:
+                outcome[projectId] = "skipped"
+            else:
+                if force or projectId not in self.state:
+                    self.state[projectId] = {"completed": [], "timings": {}}
+                todo.append(projectId)
+        pools = {stage: ThreadPoolExecutor(max_workers=self.stageWorkers[stage]) for stage in self.STAGES}
+        done = {projectId: pools["metadata"].submit(self.chain, pools, projectId) for projectId in todo}
+        try:
+            # chain returns the future of the next stage until the last one
+            for projectId in todo:
+                future = done[projectId]
+                try:
+                    while future is not None:
+                        future = future.result()
+                    outcome[projectId] = "done"
+                except Exception as e:
+                    outcome[projectId] = e
+                    with self.__lock:
+                        self.state[projectId]["error"] = str(e)
+                    self.saveState()
+                    log.warning("[%s] failed: %s", projectId, e)
+        finally:
+            for pool in pools.values():
+                pool.shutdown(wait=True)
+        return {projectId: outcome[projectId] for projectId in projectIds}
+
+    def chain(self, pools, projectId, stage="metadata", previous=None):
+        '''
+        Runs a stage and submits the next one to its pool. Returns the future of the
+        next stage, or None after the last one.
+        '''
+        result = self.runStage(stage, projectId, previous)
+        position = self.STAGES.index(stage)
+        if position + 1 == len(self.STAGES):
+            return None
+        following = self.STAGES[position + 1]
+        return pools[following].submit(self.chain, pools, projectId, following, result)
+
+    def report(self):
+        '''
+        Returns a table with the duration of each stage of each project
+        '''
+        lines = ["project".ljust(14) + "".join(stage.rjust(10) for stage in self.STAGES)]
+        for projectId, entry in sorted(self.state.items()):
+            timings = entry.get("timings", {})
+            lines.append(projectId.ljust(14) + "".join(
+                ("{:.1f}s".format(timings[stage]) if stage in timings else "-").rjust(10) for stage in self.STAGES))
+        return "\n".join(lines)
+
+
+def run_projects(projectIds, parentFolder, **options):
+    '''
+    Runs a ProjectPipeline over projectIds and logs the per-stage timings
+    '''
+    pipeline = ProjectPipeline(parentFolder, **options)
+    outcome = pipeline.run(projectIds)
+    log.info("Pipeline timings:\n" + pipeline.report())
+    return outcome
@@ -0,0 +1,435 @@
+from functools import reduce
+from gdc_rest import Operation, FieldValuePair, http_post
+from gdc_flatten import flatten_hits
+from file_utils import lazy_import
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+
+class ColumnIndex(object):
+    '''
+    Hash index over a column: the column is factorized into integer codes once and
+    the rows are grouped by code, so the rows holding given values are found without
+    comparing every cell again.
+    '''
+
+    def __init__(self, column):
+        self.codes, uniques = pd.factorize(column, use_na_sentinel=True)
+        self.lookup = {value: code for code, value in enumerate(uniques)}
+        self.order = np.argsort(self.codes, kind="stable")
+        self.bounds = np.searchsorted(self.codes[self.order], np.arange(len(uniques) + 1))
+
+    def valueCodes(self, values):
+        return np.array([self.lookup[v] for v in values if v in self.lookup], dtype=np.int64)
+
+    def positions(self, values):
+        '''
+        Returns the ascending positions of the rows holding any of values
+        '''
+        codes = self.valueCodes(values)
+        if len(codes) == 0:
+            return np.array([], dtype=np.int64)
+        if len(codes) == 1:
+            return self.order[self.bounds[codes[0]]:self.bounds[codes[0] + 1]]
+        return np.sort(np.concatenate([self.order[self.bounds[c]:self.bounds[c + 1]] for c in codes]))
+
+    def mask(self, values):
+        '''
+        Returns a boolean array that is True for the rows holding any of values
+        '''
+        return np.isin(self.codes, self.valueCodes(values))
+
+
+class FrameIndex(object):
+    '''
+    Set of hash indexes over the columns of a DataFrame that are filtered often.
+    Indexes are built on first use, for the columns given at construction (or any
+    column if columns is None).
+    '''
+    DEFAULT_COLUMNS = ("case_id", "file_id", "project_id", "project.project_id", "data_type", "data_category",
+                       "access", "analysis.workflow_type")
+
+    def __init__(self, frame, columns=DEFAULT_COLUMNS):
+        self.frame = frame
+        self.columns = columns
+        self.indexes = {}
+
+    def get(self, column):
+        '''
+        Returns the ColumnIndex of column, or None if the column is not indexed
+        '''
+        if column not in self.indexes:
+            if (self.columns is not None and column not in self.columns) or column not in self.frame.columns:
+                return None
+            try:
+                self.indexes[column] = ColumnIndex(self.frame[column])
+            except TypeError:
+                # unhashable values (e.g. lists)
+                self.indexes[column] = None
+        return self.indexes[column]
+
+
+FIELD_ROOTS = ("cases", "files")
+
+
+def resolve_field(columns, field, prefixes=FIELD_ROOTS):
+    '''
+    Maps a field of an API query to a column of a local table. Fields are matched
+    as is, or without one of the leading components in prefixes (by default the
+    roots of the case and file endpoints, so that "cases.project.project_id" and
+    "files.data_type" match the "project.project_id" and "data_type" columns).
+    Other components are never dropped: a field of a nested entity (e.g.
+    "diagnoses.state") does not match a column of its parent ("state").
+    '''
+    if field in columns:
+        return field
+    for prefix in prefixes:
+        if field.startswith(prefix + ".") and field[len(prefix) + 1:] in columns:
+            return field[len(prefix) + 1:]
+    raise KeyError("Field not found in the local table: " + field)
+
+
+def holds_lists(column):
+    '''
+    Returns True if a column has list cells (e.g. nested entities with several
+    elements, which HitFlattener keeps as lists)
+    '''
+    if column.dtype != object:
+        return False
+    return bool(column.map(lambda v: isinstance(v, list)).any())
+
+
+def as_list(value):
+    return list(value) if isinstance(value, (list, tuple, set)) else [value]
+
+
+def child_field(field, prefix):
+    '''
+    Returns the part of field after an explicit child prefix (e.g. "data_type" for
+    "files.data_type" or "cases.files.data_type" with prefix "files"), or None if
+    field does not refer to that child
+    '''
+    parts = field.split(".")
+    if parts[0] == "cases":
+        parts = parts[1:]
+    prefixParts = prefix.split(".")
+    if parts[:len(prefixParts)] != prefixParts or len(parts) == len(prefixParts):
+        return None
+    return ".".join(parts[len(prefixParts):])
+
+
+def normalize_field(field):
+    return field[len("cases."):] if field.startswith("cases.") else field
+
+
+def implies(operation, scope):
+    '''
+    Returns True if every row satisfying operation is known to satisfy scope (both
+    Operation trees, scope None meaning every row). The test is conservative: it
+    only recognizes scope as a conjunct of operation, possibly with a subset of the
+    values of an "="/"in" condition (e.g. project.project_id in [A] implies
+    project.project_id in [A, B]).
+    '''
+    if scope is None:
+        return True
+    soperator, qoperator = scope.getOperator(), operation.getOperator()
+    if soperator == "and":
+        return all(implies(operation, operand) for operand in scope.getOperands())
+    if qoperator == "or":
+        return all(implies(operand, scope) for operand in operation.getOperands())
+    if qoperator == "and":
+        return any(implies(operand, scope) for operand in operation.getOperands())
+    if soperator == "or":
+        return any(implies(operation, operand) for operand in scope.getOperands())
+    qpair, spair = operation.getOperands()[0], scope.getOperands()[0]
+    if not isinstance(qpair, FieldValuePair) or not isinstance(spair, FieldValuePair) or \
+            normalize_field(qpair.field) != normalize_field(spair.field):
+        return False
+    if qoperator in ("=", "in") and soperator in ("=", "in"):
+        try:
+            return set(as_list(qpair.value)) <= set(as_list(spair.value))
+        except TypeError:
+            return False
+    return qoperator == soperator and qpair.value == spair.value
+
+
+def field_mask(frame, operator, field, value, index=None):
+    '''
+    Evaluates a single condition (an Operation with a FieldValuePair operand) over
+    every row of frame. Returns a boolean array.
+    '''
+    column = resolve_field(frame.columns, field)
+    if operator in ("=", "in", "!=", "exclude"):
+        values = as_list(value)
+        column_index = index.get(column) if index is not None else None
+        if column_index is not None:
+            mask = column_index.mask(values)
+        else:
+            mask = frame[column].isin(values).to_numpy()
+        return ~mask if operator in ("!=", "exclude") else mask
+    if operator in ("is", "not"):
+        missing = frame[column].isna().to_numpy()
+        if str(value).lower() != "missing":
+            raise ValueError("Only the 'missing' value is supported with the " + operator + " operator")
+        return missing if operator == "is" else ~missing
+    data = frame[column]
+    if isinstance(data.dtype, pd.CategoricalDtype):
+        # unordered categoricals (see gdc_flatten.compact_frame) cannot be compared
+        data = data.astype(data.cat.categories.dtype)
+    data = pd.to_numeric(data, errors="coerce") if not isinstance(value, str) else data
+    comparisons = {"<": data.lt, "<=": data.le, ">": data.gt, ">=": data.ge}
+    if operator not in comparisons:
+        raise ValueError("Unsupported operator: " + str(operator))
+    return comparisons[operator](value).to_numpy()
+
+
+def evaluate_operation(frame, operation, index=None):
+    '''
+    Evaluates an Operation tree (as sent in the filters parameter of a query) over the
+    rows of a local table, one vectorized comparison per condition.
+    Parameters:
+        frame: DataFrame with the metadata
+        operation: Operation instance
+        index: optional FrameIndex of frame, used for equality and membership tests
+    Returns a boolean NumPy array with one value per row
+    '''
+    operator = operation.getOperator()
+    operands = operation.getOperands()
+    if operator in ("and", "or"):
+        masks = [evaluate_operation(frame, operand, index) for operand in operands]
+        return reduce(np.logical_and if operator == "and" else np.logical_or, masks)
+    pair = operands[0]
+    if not isinstance(pair, FieldValuePair):
+        raise ValueError("The " + operator + " operator expects a field/value operand")
+    return field_mask(frame, operator, pair.field, pair.value, index)
+
+
+def conditions_mask(frame, operator_function, conditions, index=None):
+    '''
+    Evaluates a dictionary of {column: value} equality conditions (values can be
+    lists of accepted values), combined with operator_function (e.g. operator.and_)
+    '''
+    masks = [field_mask(frame, "=", k, v, index) for k, v in conditions.items()]
+    return reduce(operator_function, masks)
+
+
+def predicate_mask(frame, predicate, index=None):
+    '''
+    Evaluates a row predicate over frame: an Operation, a dictionary of {column: value}
+    conditions or a function taking the DataFrame and returning a boolean vector.
+    Returns a boolean NumPy array
+    '''
+    if isinstance(predicate, Operation):
+        return evaluate_operation(frame, predicate, index)
+    if isinstance(predicate, dict):
+        return conditions_mask(frame, np.logical_and, predicate, index)
+    return np.asarray(predicate(frame), dtype=bool)
+
+
+def filter_frame(frame, conditions, operator_function=None, index=None):
+    '''
+    Returns the rows of frame (in their original order) that satisfy conditions, an
+    Operation or a dictionary of {column: value} conditions (combined with
+    operator_function, np.logical_and by default)
+    '''
+    if isinstance(conditions, Operation):
+        mask = evaluate_operation(frame, conditions, index)
+    else:
+        mask = conditions_mask(frame, operator_function or np.logical_and, conditions, index)
+    return frame[mask]
+
+
+class LocalQueryPlanner(object):
+    '''
+    Answers Operation queries from locally cached metadata (e.g. the tables of a
+    GDCCaseMetadataHandler) and only sends them to the API when they use fields that
+    are not available locally or may select entities outside the local table.
+    Constructor parameters:
+        table: DataFrame with one row per entity (e.g. the case table)
+        key: column identifying the rows of table (e.g. "case_id")
+        children: dictionary mapping a field prefix (e.g. "files") to a child table
+        with a key column. A condition on a child field (e.g. "files.data_type")
+        selects the rows of table with at least one matching child row ("!=" and
+        "exclude" select the rows with no matching child row, as the API does).
+        endpoint: RequestEndpoint used for queries that cannot be answered locally
+        (with the same fields/expand parameters used to build the local tables)
+        scope: Operation the table was retrieved with (None if it holds every
+        entity). Only queries restricted to scope (see implies) are answered locally.
+        complete: False if the table may lack some entities of scope (e.g. it was
+        retrieved with maxEntries), in which case every query goes to the API
+    '''
+    SUPPORTED = ("=", "!=", "in", "exclude", "<", "<=", ">", ">=", "is", "not", "and", "or")
+
+    def __init__(self, table, key="case_id", children=None, endpoint=None, scope=None, complete=True):
+        self.table = table
+        self.key = key
+        self.children = children if children is not None else {}
+        self.endpoint = endpoint
+        self.scope = scope
+        self.complete = complete
+        self.index = FrameIndex(table, columns=None)
+        self.childIndexes = {prefix: FrameIndex(child, columns=None) for prefix, child in self.children.items()}
+        self.lastSource = None
+        self.__lists = {}
+
+    @classmethod
+    def fromHandler(cls, handler, explode=("files",)):
+        '''
+        Builds a planner over the case and child tables of a GDCCaseMetadataHandler,
+        scoped to the filter the handler retrieved them with
+        '''
+        children = {path: handler.getBranch(path, "case_id") for path in explode}
+        return cls(handler.getData(), "case_id", children, handler.req, handler.filter, handler.complete)
+
+    def locate(self, field):
+        '''
+        Returns (table, index, column, prefix) for a field, where prefix is None for
+        fields of the main table. Fields with the prefix of a child table (e.g.
+        "files.state") are only looked up in that table. Raises KeyError if the field
+        is not available, or if it or one of its parents (e.g. "diagnoses" for
+        "diagnoses.state") holds lists, whose elements cannot be compared locally.
+        '''
+        for prefix, child in self.children.items():
+            name = child_field(field, prefix)
+            if name is not None:
+                column = resolve_field(child.columns, name, prefixes=())
+                self.checkScalar(prefix, child, column)
+                return child, self.childIndexes[prefix], column, prefix
+        try:
+            # "files." is only dropped through a child table declared for it
+            column = resolve_field(self.table.columns, field, prefixes=("cases",))
+        except KeyError:
+            raise KeyError("Field not found in the local tables: " + field)
+        self.checkScalar(None, self.table, column)
+        return self.table, self.index, column, None
+
+    def checkScalar(self, prefix, table, column):
+        '''
+        Raises KeyError if column, or a column holding its parent entity, has list
+        cells (the result is cached)
+        '''
+        if (prefix, column) not in self.__lists:
+            parts = column.split(".")
+            names = [".".join(parts[:i]) for i in range(1, len(parts) + 1)]
+            self.__lists[(prefix, column)] = any(holds_lists(table[name]) for name in names if name in table.columns)
+        if self.__lists[(prefix, column)]:
+            raise KeyError("Field with several values per row in the local table: " + column)
+
+    def canAnswer(self, operation):
+        '''
+        Returns True if operation only selects entities of the local table (see
+        scope) and every one of its conditions can be evaluated locally
+        '''
+        if not self.complete or not implies(operation, self.scope):
+            return False
+        return self.canEvaluate(operation)
+
+    def canEvaluate(self, operation):
+        '''
+        Returns True if every condition of operation can be evaluated locally
+        '''
+        operator = operation.getOperator()
+        if operator not in LocalQueryPlanner.SUPPORTED:
+            return False
+        if operator in ("and", "or"):
+            return all(self.canEvaluate(operand) for operand in operation.getOperands())
+        try:
+            self.locate(operation.getOperands()[0].field)
+            return True
+        except (KeyError, AttributeError, IndexError):
+            return False
+
+    def cost(self, operation):
+        '''
+        Rough evaluation cost used to order the operands of "and"/"or": indexed
+        equality tests first, then other conditions, then nested operations
+        '''
+        if operation.getOperator() in ("and", "or"):
+            return 2
+        if operation.getOperator() in ("=", "in"):
+            table, index, column, prefix = self.locate(operation.getOperands()[0].field)
+            return 0 if prefix is None and index.get(column) is not None else 1
+        return 1
+
+    def leaf(self, operation, candidates):
+        '''
+        Evaluates a single condition over the candidate rows (ascending positions of
+        the main table, or None for every row). Returns the matching positions.
+        '''
+        operator = operation.getOperator()
+        pair = operation.getOperands()[0]
+        table, index, column, prefix = self.locate(pair.field)
+        if prefix is not None:
+            # rows with at least one matching child row; negations select the rows
+            # with no matching child row
+            negated = operator in ("!=", "exclude")
+            positive = {"!=": "=", "exclude": "in"}.get(operator, operator)
+            child = table[field_mask(table, positive, column, pair.value, index)]
+            keys = child[self.key].unique()
+            key_index = self.index.get(self.key)
+            positions = key_index.positions(keys) if key_index is not None else \
+                np.flatnonzero(self.table[self.key].isin(keys).to_numpy())
+            if negated:
+                rows = candidates if candidates is not None else np.arange(self.table.shape[0])
+                return np.setdiff1d(rows, positions, assume_unique=True)
+            return positions if candidates is None else np.intersect1d(candidates, positions, assume_unique=True)
+        column_index = index.get(column)
+        if operator in ("=", "in") and column_index is not None:
+            positions = column_index.positions(as_list(pair.value))
+            return positions if candidates is None else np.intersect1d(candidates, positions, assume_unique=True)
+        if candidates is None:
+            return np.flatnonzero(field_mask(table, operator, column, pair.value, index))
+        subset = table.iloc[candidates]
+        return candidates[field_mask(subset, operator, column, pair.value)]
+
+    def positions(self, operation, candidates=None):
+        '''
+        Returns the ascending positions of the rows of the main table (restricted to
+        candidates, if given) that satisfy operation. "and" narrows the candidates
+        operand by operand and stops as soon as none remain; "or" only tests the rows
+        that no previous operand matched.
+        '''
+        operator = operation.getOperator()
+        if operator not in ("and", "or"):
+            return self.leaf(operation, candidates)
+        operands = sorted(operation.getOperands(), key=self.cost)
+        if operator == "and":
+            for operand in operands:
+                candidates = self.positions(operand, candidates)
+                if len(candidates) == 0:
+                    break
+            return candidates
+        remaining = candidates if candidates is not None else np.arange(self.table.shape[0])
+        matched = []
+        for operand in operands:
+            found = self.positions(operand, remaining)
+            matched.append(found)
+            remaining = np.setdiff1d(remaining, found, assume_unique=True)
+            if len(remaining) == 0:
+                break
+        return np.sort(np.concatenate(matched)) if matched else remaining[:0]
+
+    def evaluate(self, operation):
+        '''
+        Returns the rows of the main table that satisfy operation
+        '''
+        return self.table.iloc[self.positions(operation)]
+
+    def query(self, operation, f=None, explode=("files",), **options):
+        '''
+        Returns the rows satisfying operation, from the local tables when possible
+        and from the API otherwise (as a flattened table, see gdc_flatten). The
+        source used is stored in lastSource ("local" or "api").
+        Other arguments are passed to RequestEndpoint.iterHits.
+        '''
+        if self.canAnswer(operation):
+            self.lastSource = "local"
+            return self.evaluate(operation)
+        if self.endpoint is None:
+            raise KeyError("The query uses fields that are not available locally and no endpoint was given")
+        self.lastSource = "api"
+        params = dict(self.endpoint.params)
+        params["filters"] = operation.toJSON()
+        hits = self.endpoint.iterHits(f if f is not None else http_post, params=params, **options)
+        return flatten_hits(hits, key=self.key, explode=explode)[0]
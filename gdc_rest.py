@@ -1,27 +1,48 @@
 import requests
 import json
 from json import loads
-import pandas as pd
 from io import StringIO
-from os.path import exists
+import os
+from os.path import exists, getsize
+from time import time, sleep, monotonic
+from random import uniform
+from functools import partial
+from threading import Lock, BoundedSemaphore
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import hashlib
-from file_utils import read_file
+import codecs
+import tarfile
+from file_utils import read_file, file_hasher, md5, resource_path, lazy_import
+from gdc_metrics import get_logger, get_metrics
+
+pd = lazy_import("pandas")
+log = get_logger("rest")
+metrics = get_metrics()
 
 
 to_json = json.JSONEncoder().encode
 from_json = json.JSONDecoder().decode
 BASE_URL = "https://api.gdc.cancer.gov/"
 
-class Fields(object):
-    CASE = read_file("resources/fields/casefields.txt").split("\n")[:-1]
+class ResourceList(object):
+    '''
+    List of lines of a resource file, read the first time it is accessed
+    '''
 
+    def __init__(self, *parts):
+        self.path = resource_path(*parts)
+        self.lines = None
 
-def md5(fname):
-    hash_md5 = hashlib.md5()
-    with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+    def __get__(self, instance, owner):
+        if self.lines is None:
+            self.lines = read_file(self.path).split("\n")[:-1]
+        return self.lines
+
+
+class Fields(object):
+    CASE = ResourceList("fields", "casefields.txt")
 
 
 def validate_response(response, raw=False):
@@ -34,48 +55,648 @@ def validate_response(response, raw=False):
         response.raise_for_status()
 
 
-def http_post(url, params=None, json=None, headers=None, stream=False):
-    response = requests.post(url, data=params, json=json,
-                             headers=headers, stream=stream)
+class RetryPolicy(object):
+    '''
+    Exponential backoff with jitter for failed HTTP requests.
+    Constructor parameters:
+        retries: maximum number of retries after the first attempt
+        backoff: base delay in seconds; retry n waits up to backoff * 2 ** n
+        maxBackoff: upper bound on a single delay
+        jitter: if True, delays are drawn uniformly from [0, delay] ("full jitter")
+        statuses: HTTP status codes that trigger a retry
+    '''
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, retries=5, backoff=0.5, maxBackoff=60.0, jitter=True, statuses=RETRY_STATUSES):
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.jitter = jitter
+        self.statuses = statuses
+
+    def delay(self, attempt, response=None):
+        '''
+        Seconds to wait before retry number attempt (starting at 0). A Retry-After
+        header with a number of seconds takes precedence over the computed delay.
+        '''
+        if response is not None and response.headers.get("Retry-After", "").isdigit():
+            return min(float(response.headers["Retry-After"]), self.maxBackoff)
+        delay = min(self.backoff * (2 ** attempt), self.maxBackoff)
+        return uniform(0, delay) if self.jitter else delay
+
+    def shouldRetry(self, response):
+        return response.status_code in self.statuses
+
+
+class TokenBucket(object):
+    '''
+    Thread-safe token bucket rate limiter.
+    Constructor parameters:
+        rate: tokens added per second (i.e. sustained requests per second)
+        capacity: maximum number of tokens, allowing bursts (defaults to rate)
+    '''
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self.__tokens = self.capacity
+        self.__last = monotonic()
+        self.__lock = Lock()
+
+    def acquire(self, tokens=1):
+        '''
+        Blocks until tokens are available and consumes them
+        '''
+        while True:
+            with self.__lock:
+                now = monotonic()
+                self.__tokens = min(self.capacity, self.__tokens + (now - self.__last) * self.rate)
+                self.__last = now
+                if self.__tokens >= tokens:
+                    self.__tokens -= tokens
+                    return
+                wait = (tokens - self.__tokens) / self.rate
+            sleep(wait)
+
+
+class GDCSession(object):
+    '''
+    Reusable HTTP client for the GDC API. Keeps connections alive in a pool shared by
+    every request (and thread) using the session, retries 429/5xx responses and
+    connection errors according to a RetryPolicy, and optionally limits the request
+    rate with a TokenBucket.
+    Constructor parameters:
+        poolSize: maximum number of pooled connections per host
+        retryPolicy: RetryPolicy instance (defaults to RetryPolicy())
+        rateLimit: maximum requests per second, or None for no limit
+        timeout: (connect, read) timeout in seconds passed to every request
+    '''
+
+    def __init__(self, poolSize=16, retryPolicy=None, rateLimit=None, timeout=(10, 120)):
+        self.retryPolicy = retryPolicy if retryPolicy is not None else RetryPolicy()
+        self.limiter = TokenBucket(rateLimit) if rateLimit is not None else None
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method, url, **kwargs):
+        '''
+        Sends a request, retrying it as defined by the retry policy. Returns the last
+        response, which may still have an error status once retries are exhausted.
+        '''
+        kwargs.setdefault("timeout", self.timeout)
+        attempt = 0
+        while True:
+            if self.limiter is not None:
+                self.limiter.acquire()
+            metrics.count("requests")
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.retryPolicy.retries:
+                    raise
+                delay = self.retryPolicy.delay(attempt)
+                log.warning("Retrying request in %.1fs - Error: %s", delay, e)
+            else:
+                if not self.retryPolicy.shouldRetry(response) or attempt >= self.retryPolicy.retries:
+                    return response
+                delay = self.retryPolicy.delay(attempt, response)
+                response.close()
+                log.warning("Retrying request in %.1fs - Status: %s", delay, response.status_code)
+            metrics.count("retries")
+            sleep(delay)
+            attempt += 1
+
+    def get(self, url, params=None, stream=False, headers=None):
+        return self.request("GET", url, params=params, stream=stream, headers=headers)
+
+    def post(self, url, params=None, json=None, headers=None, stream=False):
+        return self.request("POST", url, data=params, json=json, headers=headers, stream=stream)
+
+    def close(self):
+        self.session.close()
+
+
+_default_session = None
+_default_session_lock = Lock()
+
+
+def get_session():
+    '''
+    Returns the module-wide GDCSession used when no session is given, creating it
+    on first use
+    '''
+    global _default_session
+    with _default_session_lock:
+        if _default_session is None:
+            _default_session = GDCSession()
+        return _default_session
+
+
+def set_session(session):
+    '''
+    Replaces the module-wide GDCSession (e.g. to change its retry or rate limits)
+    '''
+    global _default_session
+    with _default_session_lock:
+        _default_session = session
+
+
+def http_post(url, params=None, json=None, headers=None, stream=False, session=None):
+    session = session if session is not None else get_session()
+    response = session.post(url, params=params, json=json,
+                            headers=headers, stream=stream)
     return validate_response(response, stream)
 
 
-def http_get(url, params=None, stream=False):
-    response = requests.get(url, params=params, stream=stream)
+def http_get(url, params=None, stream=False, headers=None, session=None):
+    session = session if session is not None else get_session()
+    response = session.get(url, params=params, stream=stream, headers=headers)
     return validate_response(response, stream)
 
 
-def stream_to_file(request, path, chunk_size=1024):
-    with open(path, "wb") as f:
+def stream_to_file(request, path, chunk_size=1048576, hasher=None, mode="wb"):
+    '''
+    Writes the content of a streamed response to path in chunks of chunk_size bytes.
+    If hasher (e.g. hashlib.md5()) is given, it is updated with every chunk written,
+    so the checksum is available without reading the file again. Use mode="ab" to
+    append to an existing partial file.
+    '''
+    with open(path, mode) as f:
         for chunk in request.iter_content(chunk_size):
             f.write(chunk)
+            metrics.count("bytes_downloaded", len(chunk))
+            if hasher is not None:
+                hasher.update(chunk)
     return path
 
 
-def download_from_stream(link, path, httpfun, retries=3, md5sum=None):
+def content_length(link, httpfun):
+    '''
+    Returns the size in bytes of the resource at link, or None if the server does not
+    support range requests. Uses a one byte range request instead of HEAD.
+    '''
+    response = httpfun(url=link, stream=True, headers={"Range": "bytes=0-0"})
+    response.close()
+    content_range = response.headers.get("Content-Range", "")
+    if response.status_code != 206 or "/" not in content_range:
+        return None
+    total = content_range.split("/")[-1]
+    return int(total) if total.isdigit() else None
+
+
+def download_segment(link, path, httpfun, start, end, retries=3, retryPolicy=None, chunk_size=1048576):
+    '''
+    Downloads bytes start to end (inclusive) of link into the same positions of the
+    preallocated file path. After a failure the transfer resumes from the last byte
+    written.
+    '''
+    retryPolicy = retryPolicy if retryPolicy is not None else get_session().retryPolicy
+    position = start
+    tries = 0
+    while position <= end:
+        try:
+            response = httpfun(url=link, stream=True, headers={"Range": "bytes={}-{}".format(position, end)})
+            if response.status_code != 206:
+                response.close()
+                raise IOError("Server ignored the range request for " + link)
+            with open(path, "r+b") as f:
+                f.seek(position)
+                for chunk in response.iter_content(chunk_size):
+                    f.write(chunk[:end + 1 - position])
+                    metrics.count("bytes_downloaded", min(len(chunk), end + 1 - position))
+                    position += len(chunk)
+        except Exception as e:
+            tries = tries + 1
+            if tries >= retries:
+                raise
+            log.warning("Retrying segment %d-%d from byte %d - Error: %s", start, end, position, e)
+            sleep(retryPolicy.delay(tries - 1))
+
+
+def download_segmented(link, path, httpfun, size, segments, retries=3, retryPolicy=None):
+    '''
+    Downloads link into path as `segments` byte ranges fetched in parallel.
+    Returns the md5 hash object of the resulting file.
+    '''
+    with open(path, "wb") as f:
+        f.truncate(size)
+    bounds = [(size * i) // segments for i in range(segments + 1)]
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        futures = [executor.submit(download_segment, link, path, httpfun, bounds[i], bounds[i + 1] - 1, retries,
+                                   retryPolicy)
+                   for i in range(segments) if bounds[i + 1] > bounds[i]]
+        for future in futures:
+            future.result()
+    # segments complete out of order, so the checksum is computed once at the end
+    return file_hasher(path)
+
+
+def download_from_stream(link, path, httpfun, retries=3, md5sum=None, retryPolicy=None, resume=True, segments=1,
+                         fileSize=None, minSegmentSize=67108864):
+    '''
+    Streams the content of link into path, retrying on errors and checksum mismatches.
+    Retries wait as defined by retryPolicy (defaults to the default session's policy).
+
+    Data is written to path + ".part" and moved to path once complete. If resume is
+    True, a failed (or previously interrupted) transfer continues from the end of the
+    partial file with an HTTP Range request instead of starting over. The MD5
+    checksum is computed while the data is written.
+
+    If segments > 1 and the file is at least 2 * minSegmentSize bytes long (fileSize,
+    or the size reported by the server), the file is instead split in byte ranges
+    downloaded in parallel (see download_segmented).
+
+    Returns True when the written file matches md5sum (or md5sum is None) and False when
+    every attempt produced a mismatching file. If the last attempt fails with an
+    exception, that exception is raised.
+    '''
+    retryPolicy = retryPolicy if retryPolicy is not None else get_session().retryPolicy
+    part = path + ".part"
+    if segments > 1:
+        size = fileSize if fileSize is not None else content_length(link, httpfun)
+        if size is None or size < 2 * minSegmentSize:
+            segments = 1
+        else:
+            segments = min(segments, size // minSegmentSize)
     tries = 0
     done = False
     while (tries < retries) and not done:
         try:
-            response = httpfun(url=link, stream=True)
-            stream_to_file(response, path)
+            if segments > 1:
+                hasher = download_segmented(link, part, httpfun, size, segments, retries, retryPolicy)
+            else:
+                offset = getsize(part) if resume and exists(part) else 0
+                headers = {"Range": "bytes={}-".format(offset)} if offset > 0 else None
+                response = httpfun(url=link, stream=True, headers=headers)
+                if offset > 0 and response.status_code != 206:
+                    # the server sent the whole file
+                    offset = 0
+                hasher = file_hasher(part) if offset > 0 else hashlib.md5()
+                stream_to_file(response, part, hasher=hasher, mode="ab" if offset > 0 else "wb")
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 416 and exists(part):
+                # the partial file already holds every byte of the resource
+                hasher = file_hasher(part)
+            else:
+                tries = tries + 1
+                if tries >= retries:
+                    raise
+                log.warning("Retrying... unable to download/save. %d - Error: %s", tries, e)
+                sleep(retryPolicy.delay(tries - 1))
+                continue
         except Exception as e:
             tries = tries + 1
-            print("Retrying... unable to download/save.", tries, "- Error:", e.message)
+            if tries >= retries:
+                raise
+            log.warning("Retrying... unable to download/save. %d - Error: %s", tries, e)
+            sleep(retryPolicy.delay(tries - 1))
             continue
 
-        done = md5(path) == md5sum and exists(path)
+        done = md5sum is None or hasher.hexdigest() == md5sum
         if not done:
             tries = tries + 1
-            print("Retrying... unable to validate MD5 checksum", tries, "- Error:", e.message)
+            if tries < retries:
+                log.warning("Retrying... unable to validate MD5 checksum %d", tries)
+                os.remove(part)
+                sleep(retryPolicy.delay(tries - 1))
+            else:
+                log.error("Unable to validate MD5 checksum of %s after %d attempts", path, tries)
+        # the file is kept even if its checksum does not match after the last attempt
+        if done or tries >= retries:
+            os.replace(part, path)
 
     return done
 
 
+class DownloadStatus(object):
+    OK = "ok"
+    SKIPPED = "skipped"
+    MD5_FAILED = "md5-failed"
+    ERROR = "error"
+
+
+class DownloadResult(object):
+    '''
+    Outcome of a single file download.
+    Attributes:
+        file_id, file_name - identifiers of the downloaded file
+        status - one of the DownloadStatus values
+        nbytes - size of the file on disk (0 if it could not be written)
+        elapsed - seconds spent on the file, including checksum validation
+        error - error message when status is DownloadStatus.ERROR
+    '''
+
+    def __init__(self, file_id, file_name, status, nbytes=0, elapsed=0.0, error=None):
+        self.file_id = file_id
+        self.file_name = file_name
+        self.status = status
+        self.nbytes = nbytes
+        self.elapsed = elapsed
+        self.error = error
+
+    def toDict(self):
+        return {"file_id": self.file_id, "file_name": self.file_name, "status": self.status,
+                "nbytes": self.nbytes, "elapsed": self.elapsed, "error": self.error}
+
+    def __repr__(self):
+        return "DownloadResult(" + str(self.file_name) + ", " + self.status + ")"
+
+
+class DownloadError(IOError):
+    '''
+    Raised by check_downloads when some files could not be downloaded or failed
+    their MD5 check. results holds the DownloadResult of each of those files.
+    '''
+
+    def __init__(self, results):
+        self.results = results
+        names = ", ".join(str(r.file_name) + " (" + str(r.error or r.status) + ")" for r in results[:5])
+        more = " and {} more".format(len(results) - 5) if len(results) > 5 else ""
+        super(DownloadError, self).__init__("Unable to download {} files: {}{}".format(len(results), names, more))
+
+
+def check_downloads(results):
+    '''
+    Raises a DownloadError if any of the DownloadResult objects in results is not
+    OK or SKIPPED. Returns results otherwise.
+    '''
+    failed = [r for r in results if r.status not in (DownloadStatus.OK, DownloadStatus.SKIPPED)]
+    if failed:
+        raise DownloadError(failed)
+    return results
+
+
+def quarantine(path):
+    '''
+    Moves a file that failed its MD5 check out of the way (to path + ".invalid"), so
+    it is neither read as valid data nor mistaken for a complete download
+    '''
+    if exists(path):
+        os.replace(path, path + ".invalid")
+
+
+class DownloadProgress(object):
+    '''
+    Thread-safe aggregate progress of a multi-file download. Logs a line with the
+    number of finished files, transferred bytes and throughput every `every` files.
+    The number of files with each status is also added to the files_<status>
+    counters of gdc_metrics.
+    '''
+
+    def __init__(self, total, every=25, verbose=True):
+        self.total = total
+        self.every = every
+        self.verbose = verbose
+        self.done = 0
+        self.nbytes = 0
+        self.counts = {}
+        self.start = time()
+        self.__lock = Lock()
+
+    def update(self, result):
+        with self.__lock:
+            self.done += 1
+            self.counts[result.status] = self.counts.get(result.status, 0) + 1
+            if result.status == DownloadStatus.OK:
+                self.nbytes += result.nbytes
+            if self.verbose and (self.done % self.every == 0 or self.done == self.total):
+                log.info(self.summary())
+        metrics.count("files_" + result.status.replace("-", "_"))
+
+    def throughput(self):
+        '''
+        Downloaded bytes per second since the progress object was created
+        '''
+        elapsed = time() - self.start
+        return self.nbytes / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        counts = ", ".join(k + ": " + str(v) for k, v in sorted(self.counts.items()))
+        return "Progress: {}/{} files ({}) - {:.1f} MB at {:.2f} MB/s".format(
+            self.done, self.total, counts, self.nbytes / 1e6, self.throughput() / 1e6)
+
+
+def batch_records(records, maxBatchBytes=None, maxBatchFiles=None):
+    '''
+    Groups (file_id, file_name, md5sum, file_size) records into consecutive batches
+    whose total size does not exceed maxBatchBytes and whose length does not exceed
+    maxBatchFiles. A file larger than maxBatchBytes gets a batch of its own.
+    Records with an unknown (None or NaN) size count as zero bytes.
+    '''
+    batches = []
+    batch, total = [], 0
+    for record in records:
+        size = record[3] if record[3] == record[3] and record[3] is not None else 0
+        full = (maxBatchFiles is not None and len(batch) >= maxBatchFiles) or \
+               (maxBatchBytes is not None and total + size > maxBatchBytes)
+        if batch and full:
+            batches.append(batch)
+            batch, total = [], 0
+        batch.append(record)
+        total += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def extract_tar_stream(response, writeFolder, expected, extracted=None, chunk_size=1048576):
+    '''
+    Extracts the members of a gzipped tar archive streamed in a response, without
+    storing the archive. Members are expected to be named <file_id>/<file_name>, as
+    returned by the GDC data endpoint; members of other files (e.g. MANIFEST.txt)
+    are ignored. Each member is written to <file_name>.part and moved to file_name
+    only if its MD5 checksum matches; otherwise it is moved to <file_name>.invalid.
+    Parameters:
+        response - streamed response (as returned by http_post with stream=True)
+        writeFolder - folder where the files will be written
+        expected - dictionary mapping file_id to (file_name, md5sum)
+        extracted - dictionary updated as each member is extracted, so that the
+        members extracted before an error are known
+    Returns a dictionary mapping each extracted file_id to (nbytes, md5 checksum)
+    '''
+    response.raw.decode_content = True
+    extracted = extracted if extracted is not None else {}
+    with tarfile.open(fileobj=response.raw, mode="r|gz") as tar:
+        for member in tar:
+            file_id = member.name.split("/")[0]
+            if not member.isfile() or file_id not in expected:
+                continue
+            file_name, md5sum = expected[file_id]
+            path = writeFolder + file_name
+            source = tar.extractfile(member)
+            hash_md5 = hashlib.md5()
+            nbytes = 0
+            with open(path + ".part", "wb") as f:
+                for chunk in iter(lambda: source.read(chunk_size), b""):
+                    hash_md5.update(chunk)
+                    f.write(chunk)
+                    nbytes += len(chunk)
+            metrics.count("bytes_downloaded", nbytes)
+            chksm = hash_md5.hexdigest()
+            os.replace(path + ".part", path if md5sum is None or md5sum == chksm else path + ".invalid")
+            extracted[file_id] = (nbytes, chksm)
+    return extracted
+
+
 def json_convert(x):
     return loads(x)['data']['hits']
 
 
+def json_page_convert(x):
+    '''
+    Returns the hits and the pagination block (from, size, total, ...) of a JSON response
+    '''
+    data = loads(x)['data']
+    return data['hits'], data.get('pagination', {})
+
+
+class JSONHitStream(object):
+    '''
+    Incremental parser for the data.hits array of a JSON API response. Iterating over
+    it yields the hits one at a time (or in lists of batchSize hits) while the
+    response is still being received, so only the current hit, not the whole body,
+    is held in memory. Once iteration is complete, the pagination attribute holds
+    the pagination block of the response (if present). The keys of the response
+    (data, hits, pagination, warnings, ...) may come in any order.
+    Constructor parameters:
+        chunks: iterable of bytes (e.g. response.iter_content(chunkSize))
+        batchSize: if given, hits are yielded in lists of (at most) this size
+    '''
+
+    def __init__(self, chunks, batchSize=None):
+        self.chunks = iter(chunks)
+        self.batchSize = batchSize
+        self.pagination = {}
+        self.__decoder = json.JSONDecoder()
+        self.__text = codecs.getincrementaldecoder("utf-8")()
+        self.__buffer = ""
+        self.__position = 0
+        self.__exhausted = False
+
+    def __read(self):
+        '''
+        Appends the next chunk to the buffer. Returns False at the end of the stream
+        '''
+        for chunk in self.chunks:
+            if chunk:
+                self.__buffer += self.__text.decode(chunk)
+                return True
+        if not self.__exhausted:
+            self.__buffer += self.__text.decode(b"", final=True)
+            self.__exhausted = True
+        return False
+
+    def __grow(self):
+        '''
+        Reads until the buffer is (at least) twice as long. Returns False if nothing
+        could be read
+        '''
+        target = max(2 * len(self.__buffer), len(self.__buffer) + 1)
+        grown = False
+        while len(self.__buffer) < target and self.__read():
+            grown = True
+        return grown
+
+    def __skip(self):
+        '''
+        Moves past whitespace and commas. Returns the next character ("" at the end
+        of the stream)
+        '''
+        while True:
+            while self.__position < len(self.__buffer) and self.__buffer[self.__position] in " \t\r\n,":
+                self.__position += 1
+            if self.__position < len(self.__buffer):
+                return self.__buffer[self.__position]
+            if not self.__read():
+                return ""
+
+    def __expect(self, token):
+        if self.__skip() != token:
+            raise ValueError("Expected " + token + " in the response at: " +
+                             self.__buffer[self.__position:self.__position + 40])
+        self.__position += 1
+
+    def __value(self):
+        '''
+        Decodes the JSON value at the current position. The buffer is doubled
+        between failed attempts, so a value spanning many chunks (e.g. a case with
+        thousands of files) is decoded a logarithmic number of times rather than once
+        per chunk.
+        '''
+        self.__skip()
+        while True:
+            try:
+                value, end = self.__decoder.raw_decode(self.__buffer, self.__position)
+            except ValueError:
+                if not self.__grow():
+                    raise
+                continue
+            if end >= len(self.__buffer) and self.__read():
+                # a number may continue in the next chunk
+                continue
+            break
+        self.__position = end
+        if self.__position > len(self.__buffer) // 2:
+            # drop the parsed text
+            self.__buffer = self.__buffer[self.__position:]
+            self.__position = 0
+        return value
+
+    def __key(self):
+        '''
+        Returns the next key of the current object, or None at its end
+        '''
+        if self.__skip() == "}":
+            self.__position += 1
+            return None
+        key = self.__value()
+        self.__expect(":")
+        return key
+
+    def hits(self):
+        if self.__skip() == "":
+            return
+        self.__expect("{")
+        while True:
+            key = self.__key()
+            if key is None:
+                return
+            if key != "data":
+                self.__value()
+                continue
+            self.__expect("{")
+            while True:
+                key = self.__key()
+                if key is None:
+                    break
+                if key == "hits":
+                    self.__expect("[")
+                    while self.__skip() != "]":
+                        yield self.__value()
+                    self.__position += 1
+                elif key == "pagination":
+                    self.pagination = self.__value()
+                else:
+                    self.__value()
+
+    def __iter__(self):
+        if self.batchSize is None:
+            for hit in self.hits():
+                yield hit
+            return
+        batch = []
+        for hit in self.hits():
+            batch.append(hit)
+            if len(batch) >= self.batchSize:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
 class FieldValuePair(object):
     '''
     Object representing a field and corresponding values associated with it.
@@ -113,6 +734,12 @@ class Operation(object):
         self.__operator = operator
         self.__operands = operands
 
+    def getOperator(self):
+        return self.__operator
+
+    def getOperands(self):
+        return self.__operands
+
     def toJSON(self):
         '''
         Convert Operation of JSON payload
@@ -135,7 +762,7 @@ class Operation(object):
         return d
 
     def __repr__(self):
-        return
+        return "Operation(" + self.toJSON() + ")"
 
 
 def simple_op(field, op, value):
@@ -150,6 +777,15 @@ class RequestEndpoint(object):
         endpoint: A string specifying the REST endpoint from which the data
         will be accessed
 
+        baseUrl: Root URL of the API (defaults to BASE_URL). Can point to a
+        local server serving the same endpoints.
+
+        session: GDCSession used for every request and download. If None, the
+        module-wide session returned by get_session() is used.
+
+        cache: gdc_cache.ResponseCache used to store metadata responses. If None,
+        every request goes to the API.
+
         Other arguments can be passed as avaliable by the REST API. Thus far,
         the keys of the RequestEndpoint.PARAM_CONFIG dictionary are validated
         and supported.
@@ -176,9 +812,12 @@ class RequestEndpoint(object):
     MAPPING = "files/_mapping"
     DOWNLOAD = "data/"
 
-    def __init__(self, endpoint, **kwargs):
+    def __init__(self, endpoint, baseUrl=BASE_URL, session=None, cache=None, **kwargs):
         self.endpoint = endpoint
-        self.url = BASE_URL + self.endpoint
+        self.base_url = baseUrl
+        self.session = session
+        self.cache = cache
+        self.url = self.base_url + self.endpoint
         # self.reqfun = lambda x: f(url=self.url, data=x)
         self.params = {}
         if not (self.validateParameters()):
@@ -207,7 +846,27 @@ class RequestEndpoint(object):
         '''
         return to_json(self.params)
 
-    def request(self, f, params=None, convert=True):
+    def bind(self, f):
+        '''
+        Returns the http function f bound to this endpoint's session
+        '''
+        return partial(f, session=self.session) if self.session is not None else f
+
+    def fetch(self, f, params, refresh=False):
+        '''
+        Returns the content of the response to the query, from the cache if
+        available. If refresh is True, the cached response is ignored and replaced.
+        '''
+        if self.cache is not None and not refresh:
+            content = self.cache.get(self.url, params)
+            if content is not None:
+                return content
+        content = self.bind(f)(self.url, params)
+        if self.cache is not None:
+            self.cache.put(self.url, params, content)
+        return content
+
+    def request(self, f, params=None, convert=True, refresh=False):
         '''
         Connects to the endpoint and returns the response.
         Parameters:
@@ -215,16 +874,116 @@ class RequestEndpoint(object):
             params: The dictionary containing the query's parameters
             convert: Defines whether the result will be converted according
             to its format or kept as text
+            refresh: Bypass the cache (if any) and store the new response
         '''
         if params == None:
             params = self.params
-        content = f(self.url, params)
+        content = self.fetch(f, params, refresh)
         if convert:
             return RequestEndpoint.OUTPUT_FUNC[params["format"]](content)
         else:
             return content
 
-    def downloadFile(self, file_id, file_name, httpfun, md5sum=None, writeFolder="", skipIfExists=True, retries=3):
+    def requestPage(self, f, start, size, params=None, refresh=False):
+        '''
+        Requests a single page of JSON results.
+        Parameters:
+            f: http_get or http_post
+            start: offset of the first hit (the "from" parameter)
+            size: number of hits in the page
+            params: query parameters (defaults to the endpoint's parameters)
+            refresh: bypass the cache (if any) and store the new response
+        Returns a tuple with the list of hits and the pagination dictionary
+        '''
+        params = dict(params if params is not None else self.params)
+        params.update({"from": start, "size": size, "format": "json"})
+        return json_page_convert(self.fetch(f, params, refresh))
+
+    def iterPages(self, f=http_post, pageSize=1000, maxEntries=None, workers=4, ordered=False, params=None,
+                  refresh=False):
+        '''
+        Iterates over all the results of the query, page by page. The first page is
+        fetched alone to read the total number of hits from its pagination block; the
+        remaining pages are then fetched concurrently and each one is yielded (as a
+        list of hits) as soon as it arrives, so callers can start processing before
+        the last page lands.
+        Parameters:
+            f: http_get or http_post
+            pageSize: number of hits requested per page
+            maxEntries: maximum number of hits to retrieve (None retrieves all of them)
+            workers: number of pages fetched concurrently
+            ordered: if True, pages are yielded in offset order instead of arrival order
+            params: query parameters (defaults to the endpoint's parameters). Use a
+            "sort" parameter if the order of hits across pages must be stable.
+            refresh: bypass the cache (if any) and store the new responses
+        '''
+        first = pageSize if maxEntries is None else min(pageSize, maxEntries)
+        hits, pagination = self.requestPage(f, 0, first, params, refresh)
+        total = pagination.get("total", len(hits))
+        if maxEntries is not None:
+            total = min(total, maxEntries)
+        yield hits[:total]
+
+        # the server may return smaller pages than requested
+        step = len(hits) if 0 < len(hits) < first else first
+        offsets = list(range(step, total, step))
+        if not offsets:
+            return
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            submit = lambda o: executor.submit(self.requestPage, f, o, min(step, total - o), params, refresh)
+            # keep a bounded number of pages in flight to limit memory use
+            window = max(workers, 1) * 2
+            pending = [submit(o) for o in offsets[:window]]
+            queued = offsets[window:]
+            while pending:
+                if ordered:
+                    future = pending.pop(0)
+                else:
+                    future = next(as_completed(pending))
+                    pending.remove(future)
+                if queued:
+                    pending.append(submit(queued.pop(0)))
+                yield future.result()[0]
+
+    def requestStream(self, f=http_post, params=None, batchSize=None, chunkSize=65536):
+        '''
+        Sends a JSON query and returns a JSONHitStream that parses its hits while the
+        response is received. Streamed responses are not cached.
+        '''
+        params = dict(params if params is not None else self.params)
+        params["format"] = "json"
+        response = self.bind(f)(self.url, params, stream=True)
+        return JSONHitStream(response.iter_content(chunkSize), batchSize)
+
+    def iterHits(self, f=http_post, pageSize=1000, maxEntries=None, workers=4, ordered=False, params=None,
+                 refresh=False, stream=False):
+        '''
+        Iterates over all the hits of the query, one at a time (see iterPages).
+        If stream is True, pages are requested one after the other and each one is
+        parsed incrementally from the response (see requestStream), so memory use
+        does not depend on pageSize; workers, ordered and refresh are then ignored.
+        '''
+        if stream:
+            offset = 0
+            while maxEntries is None or offset < maxEntries:
+                size = pageSize if maxEntries is None else min(pageSize, maxEntries - offset)
+                page = dict(params if params is not None else self.params)
+                page.update({"from": offset, "size": size})
+                hits = self.requestStream(f, page)
+                count = 0
+                for hit in hits:
+                    count += 1
+                    yield hit
+                offset += count
+                if count == 0 or offset >= hits.pagination.get("total", offset):
+                    return
+            return
+        for page in self.iterPages(f, pageSize, maxEntries, workers, ordered, params, refresh):
+            for hit in page:
+                yield hit
+
+    def downloadFile(self, file_id, file_name, httpfun, md5sum=None, writeFolder="", skipIfExists=True, retries=3,
+                     semaphore=None, fileSize=None, segments=1, resume=True, manifest=None):
         '''
         Downloads a single file and writes it
         Parameters:
@@ -232,45 +991,263 @@ class RequestEndpoint(object):
             file_name - Name of the file (used for saving)
             httpfun - http_get or http_post
             writeFolder - folder where the file will be written
+            semaphore - optional semaphore held while the file is transferred
+            fileSize - size of the file in bytes, if known
+            segments - number of parallel byte-range segments used for large files
+            resume - continue interrupted transfers from their partial file
+            manifest - gdc_manifest.Md5Manifest of writeFolder. Existing files whose
+            size and modification time match the manifest are not hashed again.
+        Returns a DownloadResult. Files that fail their MD5 check, and existing
+        invalid files that could not be replaced, are moved to <file_name>.invalid.
         '''
-        link = BASE_URL + RequestEndpoint.DOWNLOAD + str(file_id)
-        if exists(writeFolder + file_name):
-            chksm = md5(writeFolder + file_name)
+        link = self.base_url + RequestEndpoint.DOWNLOAD + str(file_id)
+        path = writeFolder + file_name
+        start = time()
+        stale = False
+        if exists(path):
+            chksm = manifest.checksum(file_name, file_id) if manifest is not None else md5(path)
             valid = md5sum == chksm
-            if not valid:
-                print("MD5 checksum for", file_name, "does not match:", md5sum, "!=", chksm)
-                status = download_from_stream(link, writeFolder + file_name, httpfun, md5sum=md5sum, retries=retries)
-                if status:
-                    print("\tCorrupted file redownloaded successfully!")
-            elif valid and skipIfExists:
-                pass
-                #print("Skipping", writeFolder + file_name)
-
+            if valid and skipIfExists:
+                return DownloadResult(file_id, file_name, DownloadStatus.SKIPPED, getsize(path), time() - start)
+            elif not valid:
+                stale = True
+                log.warning("MD5 checksum for %s does not match: %s != %s", file_name, md5sum, chksm)
             else:
-                print("Overwriting valid file:", file_name)
-                download_from_stream(link, writeFolder + file_name, httpfun, md5sum=md5sum, retries=retries)
+                log.info("Overwriting valid file: %s", file_name)
+        httpfun = self.bind(httpfun)
+        policy = self.session.retryPolicy if self.session is not None else None
+        try:
+            if semaphore is None:
+                with metrics.timer("download"):
+                    done = download_from_stream(link, path, httpfun, retries, md5sum, policy, resume, segments,
+                                                fileSize)
+            else:
+                with semaphore, metrics.timer("download"):
+                    done = download_from_stream(link, path, httpfun, retries, md5sum, policy, resume, segments,
+                                                fileSize)
+        except Exception as e:
+            log.warning("Unable to download %s - Error: %s", file_name, e)
+            if stale:
+                quarantine(path)
+            return DownloadResult(file_id, file_name, DownloadStatus.ERROR, 0, time() - start, str(e))
+
+        nbytes = getsize(path) if exists(path) else 0
+        if done:
+            log.debug("Successfully downloaded %s", file_name)
+            status = DownloadStatus.OK
+            if manifest is not None and md5sum is not None:
+                manifest.record(file_name, file_id, md5sum)
         else:
-            download_from_stream(link, writeFolder + file_name, httpfun, md5sum=md5sum, retries=retries)
-            print("Successfully downloaded ", file_name)
+            status = DownloadStatus.MD5_FAILED
+            quarantine(path)
+        return DownloadResult(file_id, file_name, status, nbytes, time() - start)
+
+    def downloadFiles(self, records, httpfun=http_get, writeFolder="", skipIfExists=True, retries=3, workers=1,
+                      maxPerHost=None, verbose=True, segments=1, manifest=None, callback=None):
+        '''
+        Downloads multiple files, optionally in parallel.
+        Parameters:
+            records - iterable of (file_id, file_name, md5sum) or
+            (file_id, file_name, md5sum, file_size) tuples
+            workers - number of threads used to download files concurrently
+            maxPerHost - maximum number of simultaneous transfers to the API host
+            (None means no limit other than workers)
+            verbose - log aggregate progress and throughput
+            segments - number of parallel byte-range segments used for large files
+            manifest - gdc_manifest.Md5Manifest used to skip hashing unchanged files.
+            Checks of existing files run on the worker threads, so workers > 1 also
+            parallelizes hashing.
+            callback - function called with the position of a record and its
+            DownloadResult as soon as the file is downloaded (or found valid), from
+            the thread that downloaded it
+        Returns a list of DownloadResult objects in the same order as records
+        '''
+        records = list(records)
+        progress = DownloadProgress(len(records), verbose=verbose)
+        semaphore = BoundedSemaphore(maxPerHost) if maxPerHost is not None else None
+        if verbose and semaphore is not None:
+            log.info("Downloading %d files from %s with %d workers (at most %d concurrent transfers)", len(records),
+                     urlparse(self.base_url).netloc, workers, maxPerHost)
+
+        def task(i, record):
+            file_id, file_name, md5sum = record[:3]
+            size = record[3] if len(record) > 3 and record[3] == record[3] else None
+            result = self.downloadFile(file_id, file_name, httpfun, md5sum, writeFolder, skipIfExists, retries,
+                                       semaphore, size, segments, manifest=manifest)
+            progress.update(result)
+            if callback is not None:
+                callback(i, result)
+            return result
+
+        # wall time of the transfers, for the throughput over every worker
+        with metrics.span("download_wall"):
+            if workers <= 1:
+                results = [task(i, r) for i, r in enumerate(records)]
+            else:
+                results = [None] * len(records)
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    futures = {executor.submit(task, i, r): i for i, r in enumerate(records)}
+                    for future in as_completed(futures):
+                        results[futures[future]] = future.result()
+        if manifest is not None:
+            manifest.save()
+        return results
+
+    def downloadBatch(self, records, httpfun=http_post, writeFolder="", retries=3, manifest=None):
+        '''
+        Downloads several files in a single request to the data endpoint, which returns
+        them as a gzipped tar archive that is extracted on the fly (see
+        extract_tar_stream). If the transfer fails, the files that were not extracted
+        yet are requested again, waiting as defined by the session's RetryPolicy.
+        Parameters:
+            records - list of (file_id, file_name, md5sum) tuples
+            httpfun - must be http_post, since the ids are sent as a JSON payload
+            manifest - gdc_manifest.Md5Manifest in which the verified files are recorded
+        Returns a list of DownloadResult objects in the same order as records
+        '''
+        expected = {str(r[0]): (r[1], r[2]) for r in records}
+        link = self.base_url + RequestEndpoint.DOWNLOAD
+        start = time()
+        httpfun = self.bind(httpfun)
+        policy = self.session.retryPolicy if self.session is not None else get_session().retryPolicy
+        extracted, error = {}, None
+        for tries in range(retries):
+            ids = [file_id for file_id in expected if file_id not in extracted]
+            try:
+                with metrics.timer("download"):
+                    response = httpfun(link, json={"ids": ids}, stream=True)
+                    extract_tar_stream(response, writeFolder, expected, extracted)
+                error = None
+                break
+            except Exception as e:
+                error = str(e)
+                if tries + 1 >= retries:
+                    log.error("Unable to download/extract batch after %d attempts - Error: %s", retries, e)
+                else:
+                    log.warning("Retrying... unable to download/extract batch. %d - Error: %s", tries + 1, e)
+                    sleep(policy.delay(tries))
+        elapsed = time() - start
+
+        results = []
+        for file_id, (file_name, md5sum) in expected.items():
+            if file_id not in extracted:
+                status = DownloadStatus.ERROR
+                results.append(DownloadResult(file_id, file_name, status, 0, elapsed,
+                                              error or "File missing from the downloaded archive"))
+                continue
+            nbytes, chksm = extracted[file_id]
+            status = DownloadStatus.OK if md5sum is None or md5sum == chksm else DownloadStatus.MD5_FAILED
+            if manifest is not None and status == DownloadStatus.OK and md5sum is not None:
+                manifest.record(file_name, file_id, chksm)
+            results.append(DownloadResult(file_id, file_name, status, nbytes, elapsed))
+        return results
+
+    def downloadBatches(self, records, writeFolder="", skipIfExists=True, retries=3, maxBatchBytes=500000000,
+                        maxBatchFiles=1000, workers=1, retryFailed=True, verbose=True, manifest=None, callback=None):
+        '''
+        Downloads multiple files grouped in size-bounded batches, each fetched as a
+        single tar archive (see downloadBatch).
+        Parameters:
+            records - iterable of (file_id, file_name, md5sum, file_size) tuples
+            maxBatchBytes - upper bound on the summed file_size of a batch
+            maxBatchFiles - upper bound on the number of files in a batch
+            workers - number of batches downloaded concurrently
+            retryFailed - download files that failed inside a batch individually
+            manifest - gdc_manifest.Md5Manifest used to skip hashing unchanged files
+            callback - function called with the position of a record and its
+            DownloadResult as soon as the file is extracted (or found valid)
+        Returns a list of DownloadResult objects in the same order as records
+        '''
+        records = list(records)
+        progress = DownloadProgress(len(records), verbose=verbose)
+        positions = {str(r[0]): i for i, r in enumerate(records)}
+        results = {}
+        pending = []
+        for record in records:
+            path = writeFolder + record[1]
+            if manifest is not None:
+                valid = exists(path) and manifest.checksum(record[1], record[0]) == record[2]
+            else:
+                valid = exists(path) and md5(path) == record[2]
+            if skipIfExists and valid:
+                result = DownloadResult(record[0], record[1], DownloadStatus.SKIPPED, getsize(path))
+                results[str(record[0])] = result
+                progress.update(result)
+                if callback is not None:
+                    callback(positions[str(record[0])], result)
+            else:
+                pending.append(record)
+
+        batches = batch_records(pending, maxBatchBytes, maxBatchFiles)
+        if verbose and batches:
+            log.info("Downloading %d files in %d batches", len(pending), len(batches))
+
+        def task(batch):
+            if len(batch) == 1:
+                # the data endpoint returns single files as is, not as an archive
+                file_id, file_name, md5sum = batch[0][:3]
+                batch_results = [self.downloadFile(file_id, file_name, http_get, md5sum, writeFolder, False, retries,
+                                                   manifest=manifest)]
+            else:
+                batch_results = self.downloadBatch([r[:3] for r in batch], http_post, writeFolder, retries, manifest)
+            for record, result in zip(batch, batch_results):
+                if retryFailed and result.status != DownloadStatus.OK and len(batch) > 1:
+                    result = self.downloadFile(record[0], record[1], http_get, record[2], writeFolder, False,
+                                               retries, manifest=manifest)
+                progress.update(result)
+                results[str(record[0])] = result
+                if callback is not None:
+                    callback(positions[str(record[0])], result)
+
+        with metrics.span("download_wall"):
+            if workers <= 1:
+                for batch in batches:
+                    task(batch)
+            else:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    for future in [executor.submit(task, batch) for batch in batches]:
+                        future.result()
+        if manifest is not None:
+            manifest.save()
+        return [results[str(r[0])] for r in records]
 
     def downloadFromTSVMetadata(self, request, colnm_file_id="file_id", colnm_file_name="file_name", httpfun=http_get,
-                                writeFolder="", skipIfExists=True):
+                                writeFolder="", skipIfExists=True, workers=1, maxPerHost=None, segments=1,
+                                colnm_file_size="file_size", manifest=None, callback=None):
+        '''
+        Downloads multiple files with UUIDs from previously requested TSV metadata
+        to the GDC servers. Returns a list of DownloadResult objects
+        '''
+        columns = [colnm_file_id, colnm_file_name, "md5sum"]
+        if colnm_file_size in request.columns:
+            columns.append(colnm_file_size)
+        records = request[columns].itertuples(index=False, name=None)
+        return self.downloadFiles(records, httpfun, writeFolder, skipIfExists, 3, workers, maxPerHost,
+                                  segments=segments, manifest=manifest, callback=callback)
+
+    def downloadBatchesFromTSVMetadata(self, request, colnm_file_id="file_id", colnm_file_name="file_name",
+                                       colnm_file_size="file_size", writeFolder="", skipIfExists=True,
+                                       maxBatchBytes=500000000, maxBatchFiles=1000, workers=1, manifest=None,
+                                       callback=None):
         '''
         Downloads multiple files with UUIDs from previously requested TSV metadata
-        to the GDC servers
+        in size-bounded tar archives (see downloadBatches). If the metadata has no
+        colnm_file_size column, batches are bounded by maxBatchFiles only.
         '''
-        return [self.downloadFile(x[1][colnm_file_id], x[1][colnm_file_name], httpfun, x[1]["md5sum"], writeFolder,
-                                  skipIfExists, 3) for x in
-                request[[colnm_file_id, colnm_file_name, "md5sum"]].iterrows()]
+        df = request[[colnm_file_id, colnm_file_name, "md5sum"]].copy()
+        df["size"] = request[colnm_file_size] if colnm_file_size in request.columns else None
+        records = df.itertuples(index=False, name=None)
+        return self.downloadBatches(records, writeFolder, skipIfExists, 3, maxBatchBytes, maxBatchFiles, workers,
+                                    manifest=manifest, callback=callback)
 
     def downloadFromJSONMetadata(self, request, colnm_file_id="file_id", colnm_file_name="file_name", httpfun=http_get,
-                                 writeFolder="", skipIfExists=True):
+                                 writeFolder="", skipIfExists=True, workers=1, maxPerHost=None):
         '''
-        Downloads multiple files with UUIDs from previously requested JSON metadata
+        Downloads multiple files with UUIDs from previously requested JSON metadata.
+        Returns a list of DownloadResult objects
         '''
-        return [
-            self.downloadFile(r[colnm_file_id], r[colnm_file_name], httpfun, r["md5sum"], writeFolder, skipIfExists, 3)
-            for r in request]
+        records = ((r[colnm_file_id], r[colnm_file_name], r["md5sum"]) for r in request)
+        return self.downloadFiles(records, httpfun, writeFolder, skipIfExists, 3, workers, maxPerHost)
 
 
 def singleProjectSearchOperation(projectId, dataCategory):
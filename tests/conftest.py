@@ -0,0 +1,37 @@
+import os
+import sys
+import pytest
+
+# the modules of the package are at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.mock_gdc import MockGDC
+
+
+@pytest.fixture(scope="session")
+def mock_gdc():
+    '''
+    Local mock of the GDC API (see benchmarks.mock_gdc) with a few small files
+    '''
+    with MockGDC(ncases=6, filesPerCase=2, ngenes=500) as gdc:
+        yield gdc
+
+
+@pytest.fixture(scope="session")
+def mock_files(mock_gdc):
+    '''
+    File hits of the mock server (file_id, file_name, md5sum, file_size, ...)
+    '''
+    from gdc_rest import RequestEndpoint, http_post
+    return RequestEndpoint(RequestEndpoint.FILES, baseUrl=mock_gdc.url, size=1000).request(http_post)
+
+
+@pytest.fixture
+def endpoint(mock_gdc):
+    '''
+    RequestEndpoint of the mock server whose retries do not wait
+    '''
+    from gdc_rest import RequestEndpoint, GDCSession, RetryPolicy
+    session = GDCSession(retryPolicy=RetryPolicy(retries=2, backoff=0.0))
+    yield RequestEndpoint(RequestEndpoint.CASES, baseUrl=mock_gdc.url, session=session)
+    session.close()
@@ -1,5 +1,8 @@
 from gdc_data_processing import GDCCaseMetadataHandler, GeneExpressionQuantification
 from gdc_rest import singleProjectSearchOperation
+from gdc_dataset import save_dataset
+from gdc_pipeline import run_projects
+from gdc_metrics import enable_logging
 from os.path import exists
 from os import makedirs
 
@@ -28,7 +31,7 @@ def get_project_geq_data(projID):
 
     casefilt = singleProjectSearchOperation(projectId=projID, dataCategory="Transcriptome Profiling")  # search filter
     mh = GDCCaseMetadataHandler(filter=casefilt, expand=casefields,
-                                maxEntries=1500)  # metadata handler object that will fetch the data
+                                maxEntries=1500, report=True)  # metadata handler object that will fetch the data
 
     dataParams = {"analysis.workflow_type": "HTSeq - FPKM"}  # Parameters for the gene expression data search
     fh = GeneExpressionQuantification(mh, "case_id", filterparams=dataParams)
@@ -49,11 +52,19 @@ def get_project_geq_data(projID):
                "exposures.bmi"] # each field corresponds to a desired output vector
 
 
-    X = fh.getDataMatrix(geq_main_folder) # assemble the gene expression matrix from local files (downloaded if missing)
+    X = fh.getDataMatrix(geq_main_folder, report=True) # assemble the gene expression matrix from local files (downloaded if missing)
     Dy = {output: fh.getOutputVector(output) for output in outputs} # dictionary linking output fields with their vectors
 
-    # Write the gene expression matrix and output vectors to a file for later use
-    X.to_csv(geq_dfs_folder + "geq_data.csv")
-    [output.to_csv(geq_dfs_folder + "geq_output_" + y + ".csv") for y, output in Dy.items()]
+    # Write the gene expression matrix and output vectors to a binary dataset for later use
+    # (load it with gdc_dataset.load_dataset)
+    save_dataset(geq_dfs_folder + "geq_data", X, Dy)
 
-[get_project_geq_data(projID) for projID in ["TCGA-COAD","TCGA-BRCA","TCGA-OV"]]
\ No newline at end of file
+if __name__ == "__main__":  # files are parsed in worker processes, which import this module
+    enable_logging() # show progress messages and the summaries of report=True (time per stage, bytes, cache hits)
+
+    # Single project, step by step
+    # get_project_geq_data("TCGA-COAD")
+
+    # Several projects at once: metadata, downloads and parsing of different projects overlap, and an
+    # interrupted run picks up where it stopped when called again (see gdc_pipeline.ProjectPipeline)
+    run_projects(["TCGA-COAD", "TCGA-BRCA", "TCGA-OV"], "/path/to/file", maxConcurrency=4, downloadWorkers=4)
@@ -0,0 +1,11 @@
+import numpy as np
+import pandas as pd
+from bio_utils import GeneIndex
+
+
+def test_positions_with_an_empty_identifier_column():
+    index = GeneIndex.fromTable(pd.DataFrame({"symbol": ["A", "B"], "ensembl_gene_id": ["E1", "E2"],
+                                              "prev_symbol": [None, None]}))
+    assert index.positions(["A", "X"], "prev_symbol").tolist() == [-1, -1]
+    assert index.positions(["B", "X", "A"], "symbol").tolist() == [1, -1, 0]
+    assert list(index.convert(np.array(["E2", "E3"]), "ensembl_gene_id", "symbol")) == ["B", None]
@@ -0,0 +1,95 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import gdc_dataset
+from gdc_dataset import save_dataset, load_dataset, update_dataset, finish_update, create_matrix, \
+    write_dataset_labels, UPDATE_FILE
+
+
+def frame(cases, offset=0.0):
+    index = pd.MultiIndex.from_arrays([cases, ["f" + c for c in cases]], names=["case_id", "file_id"])
+    values = np.arange(len(cases) * 3, dtype=float).reshape(len(cases), 3) + offset
+    return pd.DataFrame(values, index=index, columns=["g1", "g2", "g3"])
+
+
+def outputs(X):
+    return {"label": pd.Series(range(X.shape[0]), index=X.index)}
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    X = frame(["c1", "c2", "c3", "c4"])
+    path = str(tmp_path / "dataset")
+    save_dataset(path, X, outputs(X))
+    return path, X
+
+
+def test_update_keeps_appends_and_leaves_mapped_views_unchanged(dataset):
+    path, X = dataset
+    before, _ = load_dataset(path)
+    snapshot = before.to_numpy().copy()
+    new = frame(["c5", "c6"], offset=100.0)
+    expected = pd.concat([X.iloc[[1, 3]], new])
+    update_dataset(path, [1, 3], new, outputs(expected), {"version": 2})
+    after, vectors = load_dataset(path)
+    assert after.equals(expected)
+    assert list(vectors["label"]) == [0, 1, 2, 3]
+    assert gdc_dataset.read_dataset_metadata(path)["extra"] == {"version": 2}
+    assert np.array_equal(before.to_numpy(), snapshot)
+
+
+def test_interrupted_update_is_detected_and_completed(dataset, monkeypatch):
+    path, X = dataset
+    moves = []
+
+    def failing_replace(source, target):
+        if moves and not source.endswith(UPDATE_FILE + ".tmp"):
+            raise KeyboardInterrupt()
+        moves.append(target)
+        replace(source, target)
+
+    replace = gdc_dataset.replace
+    monkeypatch.setattr(gdc_dataset, "replace", failing_replace)
+    new = frame(["c5"], offset=100.0)
+    with pytest.raises(KeyboardInterrupt):
+        update_dataset(path, [0, 2], new)
+    monkeypatch.setattr(gdc_dataset, "replace", replace)
+    with pytest.raises(IOError):
+        load_dataset(path)
+    finish_update(path)
+    assert load_dataset(path)[0].equals(pd.concat([X.iloc[[0, 2]], new]))
+
+
+def test_update_interrupted_before_the_moves_leaves_the_dataset(dataset, monkeypatch):
+    path, X = dataset
+
+    def failing_dump(*args):
+        raise KeyboardInterrupt()
+
+    monkeypatch.setattr(gdc_dataset.json, "dump", failing_dump)
+    with pytest.raises(KeyboardInterrupt):
+        update_dataset(path, [0], frame(["c5"]))
+    monkeypatch.undo()
+    assert load_dataset(path)[0].equals(X)
+    update_dataset(path, [3], frame(["c5"]))
+    assert list(load_dataset(path)[0].index.get_level_values(0)) == ["c4", "c5"]
+
+
+def test_rebuild_replaces_the_dataset_only_when_complete(dataset):
+    path, X = dataset
+    before, _ = load_dataset(path)
+    new = frame(["c5", "c6", "c7", "c8", "c9"], offset=100.0)
+    matrix = create_matrix(path, new.shape)
+    matrix[:] = new.to_numpy()
+    del matrix
+    # the build failed before its labels were written
+    assert load_dataset(path)[0].equals(X)
+    matrix = create_matrix(path, new.shape)
+    matrix[:] = new.to_numpy()
+    matrix.flush()
+    write_dataset_labels(path, new.columns, new.index, "float64", outputs(new))
+    del matrix
+    assert load_dataset(path)[0].equals(new)
+    assert before.equals(X)
+    assert not any(name.endswith(".tmp") for name in os.listdir(path))
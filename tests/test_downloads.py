@@ -0,0 +1,82 @@
+import os
+import pytest
+import gdc_rest
+from file_utils import md5
+from gdc_manifest import Md5Manifest
+from gdc_data_processing import GDCCaseMetadataHandler, GeneExpressionQuantification
+from gdc_rest import http_get, http_post, DownloadStatus, DownloadError, check_downloads
+
+
+def test_download_resumes_from_partial_file(endpoint, mock_files, mock_gdc, tmp_path):
+    f = mock_files[0]
+    folder = str(tmp_path) + "/"
+    with open(os.path.join(mock_gdc.folder, "data", f["file_id"]), "rb") as source:
+        content = source.read()
+    with open(folder + f["file_name"] + ".part", "wb") as part:
+        part.write(content[:len(content) // 3])
+    result = endpoint.downloadFile(f["file_id"], f["file_name"], http_get, f["md5sum"], folder)
+    assert result.status == DownloadStatus.OK
+    assert md5(folder + f["file_name"]) == f["md5sum"]
+    assert not os.path.exists(folder + f["file_name"] + ".part")
+    skipped = endpoint.downloadFile(f["file_id"], f["file_name"], http_get, f["md5sum"], folder)
+    assert skipped.status == DownloadStatus.SKIPPED
+
+
+def test_md5_failure_is_quarantined_and_raised(endpoint, mock_files, tmp_path, caplog):
+    f = mock_files[1]
+    folder = str(tmp_path) + "/"
+    with caplog.at_level("WARNING", logger="gdc"):
+        result = endpoint.downloadFile(f["file_id"], f["file_name"], http_get, "0" * 32, folder, retries=2)
+    assert result.status == DownloadStatus.MD5_FAILED
+    assert [(r.levelname, r.getMessage().startswith("Retrying")) for r in caplog.records] == \
+        [("WARNING", True), ("ERROR", False)]
+    assert not os.path.exists(folder + f["file_name"])
+    assert os.path.exists(folder + f["file_name"] + ".invalid")
+    with pytest.raises(DownloadError) as error:
+        check_downloads([result])
+    assert error.value.results == [result]
+
+
+def test_failed_download_removes_stale_file(endpoint, tmp_path):
+    folder = str(tmp_path) + "/"
+    with open(folder + "missing.txt", "w") as stale:
+        stale.write("stale content")
+    result = endpoint.downloadFile("no-such-file", "missing.txt", http_get, "0" * 32, folder)
+    assert result.status == DownloadStatus.ERROR
+    assert not os.path.exists(folder + "missing.txt")
+
+
+def test_batch_keeps_only_verified_files(endpoint, mock_files, tmp_path, monkeypatch):
+    folder = str(tmp_path) + "/"
+    records = [(f["file_id"], f["file_name"], f["md5sum"]) for f in mock_files[:3]]
+    records[1] = records[1][:2] + ("0" * 32,)
+    requested, delays = [], []
+
+    def flaky_post(url, json=None, **options):
+        requested.append(list(json["ids"]))
+        if len(requested) == 1:
+            raise IOError("connection reset")
+        return http_post(url, json=json, **options)
+
+    monkeypatch.setattr(gdc_rest, "sleep", delays.append)
+    manifest = Md5Manifest(folder)
+    results = endpoint.downloadBatch(records, flaky_post, folder, retries=3, manifest=manifest)
+    assert [r.status for r in results] == [DownloadStatus.OK, DownloadStatus.MD5_FAILED, DownloadStatus.OK]
+    assert len(requested) == 2 and len(delays) == 1
+    assert not os.path.exists(folder + records[1][1])
+    assert os.path.exists(folder + records[1][1] + ".invalid")
+    assert not any(name.endswith(".part") for name in os.listdir(folder))
+    assert sorted(manifest.entries) == sorted([records[0][1], records[2][1]])
+
+
+def test_data_matrix_raises_on_failed_downloads(mock_gdc, tmp_path):
+    handler = GDCCaseMetadataHandler(pageSize=100, baseUrl=mock_gdc.url)
+    data = GeneExpressionQuantification(handler, "case_id")
+    folder = str(tmp_path) + "/"
+    X = data.getDataMatrix(folder, downloadWorkers=2)
+    assert X.shape == (data.getFileData().shape[0], 500)
+    first = data.getFileData().index[0]
+    data.getFileData().loc[first, "md5sum"] = "0" * 32
+    for pipelined in (False, True):
+        with pytest.raises(IOError):
+            data.getDataMatrix(folder, pipelined=pipelined, parseWorkers=1)
@@ -0,0 +1,57 @@
+import hashlib
+import random
+import pandas as pd
+import pytest
+from gdc_data_processing import MaskedSomaticMutation
+from benchmarks.synthetic import make_maf_file
+
+
+class TableHandler(object):
+    '''
+    Case metadata handler serving a fixed file table
+    '''
+
+    def __init__(self, files, cases):
+        self.files, self.cases = files, cases
+
+    def getBranch(self, identifier, metacolumn):
+        return self.files.copy()
+
+    def getData(self):
+        return self.cases
+
+
+@pytest.fixture
+def shared_maf(tmp_path):
+    folder = str(tmp_path) + "/"
+    rng = random.Random(0)
+    rows = []
+    for k, cases in enumerate([["c1", "c2"], ["c3"]]):
+        name = "mutations_%d.maf.gz" % k
+        make_maf_file(folder + name, rng)
+        with open(folder + name, "rb") as f:
+            md5sum = hashlib.md5(f.read()).hexdigest()
+        rows += [{"case_id": c, "file_id": "maf%d" % k, "file_name": name, "md5sum": md5sum, "access": "open",
+                  "data_type": "Masked Somatic Mutation"} for c in cases]
+    cases = pd.DataFrame({"case_id": ["c1", "c2", "c3"], "files": [[]] * 3, "sex": ["f", "m", "f"]})
+    return folder, MaskedSomaticMutation(TableHandler(pd.DataFrame(rows), cases), "case_id")
+
+
+def test_shared_file_rows_are_kept_for_each_case(shared_maf):
+    folder, mm = shared_maf
+    table = mm.getDataTable(folder, download=False, parseWorkers=1, metaColumns=["sex"])
+    per_case = table.groupby(["file_id", "case_id"]).size()
+    assert list(per_case.index) == [("maf0", "c1"), ("maf0", "c2"), ("maf1", "c3")]
+    assert per_case["maf0"]["c1"] == per_case["maf0"]["c2"]
+    assert set(table[table["case_id"] == "c2"]["sex"]) == {"m"}
+    counts = mm.getMutationMatrix(folder, download=False, parseWorkers=1)
+    assert counts.shape[0] == 3 and (counts.iloc[0] == counts.iloc[1]).all()
+    assert counts.sum(axis=1).tolist() == [per_case["maf0"]["c1"], per_case["maf0"]["c2"], per_case["maf1"]["c3"]]
+
+
+def test_unknown_data_type_has_no_parser(shared_maf):
+    folder, mm = shared_maf
+    files = mm.getFileData().assign(data_type="Unknown")
+    with pytest.raises(KeyError):
+        mm.getParser(files)
+    assert mm.getParser(files.drop(columns="data_type")) is None
@@ -0,0 +1,30 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# pandas is first used by several threads at once, in a new interpreter where
+# nothing imported it yet
+THREADED_FIRST_USE = """
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from threading import Barrier
+import gdc_flatten
+assert "pandas.core.frame" not in sys.modules
+barrier = Barrier(4)
+
+def flatten(k):
+    barrier.wait()
+    data, branches = gdc_flatten.flatten_hits([{"case_id": "c%d" % k, "files": [{"file_id": "f"}]}], key="case_id")
+    return data.shape[0]
+
+with ThreadPoolExecutor(max_workers=4) as executor:
+    assert list(executor.map(flatten, range(4))) == [1, 1, 1, 1]
+"""
+
+
+def test_lazy_import_is_thread_safe():
+    for _ in range(3):
+        result = subprocess.run([sys.executable, "-c", THREADED_FIRST_USE], cwd=ROOT, capture_output=True, text=True)
+        assert result.returncode == 0, result.stderr
@@ -0,0 +1,25 @@
+from gdc_data_processing import strip_revision
+from gdc_matrix import build_matrix, feature_positions
+from gdc_parsers import get_parser
+
+STAR_IDS = ["ENSG00000000003.15", "ENSG00000002586.20", "ENSG00000002586.20_PAR_Y", "ENSG00000005022.6"]
+
+
+def write_star_file(path, counts):
+    lines = ["# gene-model: GENCODE v36", "gene_id\tgene_name\tunstranded", "N_unmapped\t\t7"]
+    lines += ["%s\tG\t%d" % (g, c) for g, c in zip(STAR_IDS, counts)]
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def test_duplicate_keys_match_their_first_identifier(tmp_path):
+    assert list(feature_positions(STAR_IDS, ["ENSG00000002586", "ENSG00000000003", "ENSG0"], strip_revision)) == \
+        [1, 0]
+    paths = [str(tmp_path / "a.tsv"), str(tmp_path / "b.tsv")]
+    write_star_file(paths[0], [1, 2, 0, 4])
+    write_star_file(paths[1], [5, 6, 0, 8])
+    parser = get_parser("Gene Expression Quantification", "STAR - Counts")
+    ids, matrix = build_matrix(paths, workers=1, parser=parser, features=["ENSG00000002586", "ENSG00000005022"],
+                               key=strip_revision)
+    assert list(ids) == ["ENSG00000002586.20", "ENSG00000005022.6"]
+    assert matrix.tolist() == [[2, 4], [6, 8]]
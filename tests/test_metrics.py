@@ -0,0 +1,19 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from gdc_metrics import Metrics
+
+
+def test_throughput_uses_the_wall_time_of_concurrent_downloads():
+    metrics = Metrics()
+
+    def download(k):
+        with metrics.span("download_wall"), metrics.timer("download"):
+            time.sleep(0.2)
+            metrics.count("bytes_downloaded", 1048576)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(download, range(4)))
+    times = metrics.snapshot()["times"]
+    assert times["download"] > 0.75 and times["download_wall"] < 0.35
+    throughput = [line for line in metrics.report().splitlines() if line.startswith("download throughput")]
+    assert throughput == ["download throughput: {:.2f} MB/s".format(4 / times["download_wall"])]
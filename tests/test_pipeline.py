@@ -0,0 +1,48 @@
+import json
+import os
+from gdc_dataset import load_dataset
+from gdc_data_processing import GeneExpressionQuantification
+from gdc_metrics import get_metrics
+from gdc_pipeline import ProjectPipeline
+from gdc_rest import DownloadResult, DownloadStatus, DownloadError
+
+OUTPUTS = ["demographic.race", "project.project_id"]
+
+
+def pipeline(mock_gdc, folder, **options):
+    return ProjectPipeline(folder, parseWorkers=1, downloadWorkers=2, outputs=OUTPUTS, baseUrl=mock_gdc.url,
+                           **options)
+
+
+def test_resumed_run_reuses_saved_stages(mock_gdc, tmp_path):
+    folder = str(tmp_path) + "/"
+    assert pipeline(mock_gdc, folder).run(["TCGA-TEST"]) == {"TCGA-TEST": "done"}
+    X, outputs = load_dataset(folder + "TCGA-TEST/GEQ/Datasets/geq_data", mmap=False)
+    assert pipeline(mock_gdc, folder).run(["TCGA-TEST"]) == {"TCGA-TEST": "skipped"}
+
+    # a run interrupted before the dataset was written
+    with open(folder + ProjectPipeline.STATE_FILE, "r") as f:
+        state = json.load(f)
+    state["TCGA-TEST"]["completed"] = ["metadata", "download"]
+    with open(folder + ProjectPipeline.STATE_FILE, "w") as f:
+        json.dump(state, f)
+    os.remove(folder + "TCGA-TEST/GEQ/Datasets/geq_data/dataset.json")
+    before = get_metrics().snapshot()
+    assert pipeline(mock_gdc, folder).run(["TCGA-TEST"]) == {"TCGA-TEST": "done"}
+    counters = get_metrics().since(before)["counters"]
+    assert counters.get("requests", 0) == 0 and counters.get("files_skipped", 0) == 0
+    Y, resumed = load_dataset(folder + "TCGA-TEST/GEQ/Datasets/geq_data", mmap=False)
+    assert X.equals(Y)
+    assert all(outputs[name].astype(str).equals(resumed[name].astype(str)) for name in OUTPUTS)
+
+
+def test_failed_download_fails_the_project(mock_gdc, tmp_path, monkeypatch):
+    def failing_storage(self, path, **options):
+        fd = self.getFileData()
+        return [DownloadResult(fd["file_id"].iloc[0], fd["file_name"].iloc[0], DownloadStatus.MD5_FAILED)]
+
+    monkeypatch.setattr(GeneExpressionQuantification, "confirmLocalStorage", failing_storage)
+    folder = str(tmp_path) + "/"
+    outcome = pipeline(mock_gdc, folder).run(["TCGA-TEST"])
+    assert isinstance(outcome["TCGA-TEST"], DownloadError)
+    assert not os.path.exists(folder + "TCGA-TEST/GEQ/Datasets")
@@ -0,0 +1,82 @@
+import pandas as pd
+import pytest
+from gdc_flatten import flatten_hits
+from gdc_query import LocalQueryPlanner, implies
+from gdc_rest import RequestEndpoint, Operation, simple_op, singleProjectSearchOperation
+
+
+def make_planner(scope=None, endpoint=None, complete=True):
+    cases = pd.DataFrame({"case_id": ["c0", "c1", "c2", "c3"],
+                          "submitter_id": ["case-0", "case-1", "case-2", "case-3"],
+                          "state": ["released"] * 4,
+                          "project.project_id": ["TCGA-COAD"] * 4})
+    files = pd.DataFrame({"case_id": ["c0", "c0", "c1", "c2"],
+                          "file_id": ["f0", "f1", "f2", "f3"],
+                          "submitter_id": ["file-0", "file-1", "file-2", "file-3"],
+                          "state": ["validated", "released", "released", "validated"],
+                          "data_type": ["Gene Expression Quantification", "Masked Somatic Mutation",
+                                        "Masked Somatic Mutation", "Gene Expression Quantification"],
+                          "access": ["open"] * 4,
+                          "data_category": ["Transcriptome Profiling"] * 4})
+    return LocalQueryPlanner(cases, "case_id", {"files": files}, endpoint, scope, complete)
+
+
+def test_child_prefix_takes_precedence():
+    planner = make_planner()
+    table, index, column, prefix = planner.locate("files.submitter_id")
+    assert prefix == "files" and column == "submitter_id" and table is planner.children["files"]
+    assert planner.locate("cases.files.state")[3] == "files"
+    assert planner.locate("submitter_id")[3] is None
+    result = planner.query(simple_op("files.state", "=", "validated"))
+    assert planner.lastSource == "local"
+    assert result["case_id"].tolist() == ["c0", "c2"]
+
+
+def test_negated_child_condition_means_no_matching_child():
+    planner = make_planner()
+    result = planner.query(simple_op("files.data_type", "exclude", ["Masked Somatic Mutation"]))
+    # c0 and c1 have a mutation file; c3 has no files at all
+    assert result["case_id"].tolist() == ["c2", "c3"]
+    result = planner.query(Operation("and", [simple_op("project.project_id", "=", "TCGA-COAD"),
+                                             simple_op("files.state", "!=", "validated")]))
+    assert result["case_id"].tolist() == ["c1", "c3"]
+
+
+def test_nested_fields_are_not_matched_to_parent_or_list_columns():
+    hits = [{"case_id": "c0", "state": "released", "diagnoses": [{"state": "validated"}, {"state": "validated"}]},
+            {"case_id": "c1", "state": "released", "diagnoses": [{"state": "validated"}]}]
+    cases, children = flatten_hits(hits)
+    planner = LocalQueryPlanner(cases, "case_id", children)
+    # c0 keeps its two diagnoses as a list, which cannot be compared locally
+    assert not planner.canAnswer(simple_op("diagnoses.state", "=", "validated"))
+    assert planner.canAnswer(simple_op("cases.state", "=", "released"))
+    single = LocalQueryPlanner(cases[cases["case_id"] == "c0"].drop(columns="diagnoses.state"), "case_id")
+    # "diagnoses.state" is not the case-level "state"
+    assert not single.canAnswer(simple_op("diagnoses.state", "=", "released"))
+    with pytest.raises(KeyError):
+        single.query(simple_op("diagnoses.state", "=", "released"))
+
+
+def test_queries_outside_the_scope_go_to_the_api(mock_gdc):
+    scope = singleProjectSearchOperation("TCGA-COAD", "Transcriptome Profiling")
+    endpoint = RequestEndpoint(RequestEndpoint.CASES, baseUrl=mock_gdc.url)
+    planner = make_planner(scope, endpoint)
+    planner.query(Operation("and", [scope, simple_op("files.state", "=", "validated")]))
+    assert planner.lastSource == "local"
+    result = planner.query(singleProjectSearchOperation("TCGA-BRCA", "Transcriptome Profiling"), pageSize=100)
+    assert planner.lastSource == "api"
+    assert result.shape[0] > 0
+    # the table may lack cases when it was cut short by maxEntries
+    truncated = make_planner(None, endpoint, complete=False)
+    truncated.query(simple_op("state", "=", "released"), pageSize=100)
+    assert truncated.lastSource == "api"
+
+
+def test_implies():
+    scope = simple_op("project.project_id", "in", ["TCGA-COAD", "TCGA-OV"])
+    assert implies(simple_op("cases.project.project_id", "=", "TCGA-OV"), scope)
+    assert not implies(simple_op("project.project_id", "=", "TCGA-BRCA"), scope)
+    assert not implies(simple_op("demographic.race", "=", "white"), scope)
+    assert implies(Operation("or", [simple_op("project.project_id", "=", "TCGA-OV"),
+                                    simple_op("project.project_id", "=", "TCGA-COAD")]), scope)
+    assert implies(simple_op("state", "=", "released"), None)
@@ -0,0 +1,46 @@
+import json
+from gdc_rest import JSONHitStream, RequestEndpoint, http_post
+
+
+def chunked(text, size):
+    data = text.encode("utf-8")
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def test_pagination_before_hits():
+    hits = [{"case_id": "c%d" % i, "name": "café %d" % i} for i in range(5)]
+    pagination = {"from": 0, "size": 5, "total": 12}
+    body = '{"warnings": {"x": [1, 2]}, "data": {"pagination": %s, "hits": %s}}' % (json.dumps(pagination),
+                                                                                   json.dumps(hits))
+    for size in (1, 7, 4096):
+        stream = JSONHitStream(chunked(body, size))
+        assert list(stream) == hits
+        assert stream.pagination == pagination
+    stream = JSONHitStream(chunked(body, 3), batchSize=2)
+    assert [len(batch) for batch in stream] == [2, 2, 1]
+
+
+def test_large_hit_is_not_decoded_once_per_chunk():
+    hit = {"case_id": "c0", "files": [{"file_id": "f%d" % i, "data_type": "Gene Expression Quantification"}
+                                      for i in range(20000)]}
+    body = json.dumps({"data": {"hits": [hit, {"case_id": "c1"}], "pagination": {"total": 2}}})
+    chunks = chunked(body, 1024)
+    stream = JSONHitStream(chunks)
+    decoder = stream._JSONHitStream__decoder
+    calls = []
+
+    class CountingDecoder(object):
+        def raw_decode(self, text, position):
+            calls.append(position)
+            return decoder.raw_decode(text, position)
+
+    stream._JSONHitStream__decoder = CountingDecoder()
+    assert [h["case_id"] for h in stream] == ["c0", "c1"]
+    assert stream.pagination == {"total": 2}
+    assert len(chunks) > 1000 and len(calls) < 50
+
+
+def test_streamed_pages_from_the_mock_server(mock_gdc):
+    endpoint = RequestEndpoint(RequestEndpoint.CASES, baseUrl=mock_gdc.url)
+    hits = list(endpoint.iterHits(http_post, pageSize=4, stream=True))
+    assert len(hits) == 6 and len({h["case_id"] for h in hits}) == 6